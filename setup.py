@@ -20,7 +20,13 @@ setuptools.setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    install_requires = [
-        "web.py >= 0.6.0"
-    ]
+    install_requires = [],
+    extras_require = {
+        "webpy": ["web.py >= 0.6.0"]
+    },
+    entry_points = {
+        "console_scripts": [
+            "sqlite-rw-replicator = sqlite_rw.replicator:main",
+        ]
+    }
 )
@@ -1,10 +1,22 @@
 # encoding=utf-8
 import sqlite3
-import web
 import logging
 import json
 import threading
 from .async_task import AsyncThread
+from .lock import LockManager
+from . import replication
+from . import counter
+from .backend import create_db, connect, iter_rows, BACKEND_WEBPY, BACKEND_SQLITE3
+from .cache import RowCacheRegistry
+from .replica import ReadReplica, ReplicaSet, ROUTE_ROUND_ROBIN, ROUTE_LEAST_BUSY
+from .replica import MemoryReplicaRegistry, MEMORY_PREFIX, get_memory_uri, is_memory_uri
+from .metrics import MetricsRegistry, timed
+from .router import QueryRouter
+from .group_commit import GroupCommitter
+from .schema import SchemaCache
+from . import binlog
+from .binlog import BINLOG_JSON, BINLOG_COMPACT
 
 
 logger = logging.getLogger("sqlite-rw")
@@ -13,8 +25,17 @@ logger = logging.getLogger("sqlite-rw")
 #     level=logging.DEBUG,
 #     format='%(asctime)s|%(levelname)s|%(filename)s:%(lineno)d|%(message)s')
 
-_async_thread = AsyncThread()
-_async_thread.start()
+# 后台线程在第一次写入(添加异步任务)时启动
+_async_thread = AsyncThread(auto_start = True)
+
+def _collect_process_metrics():
+    MetricsRegistry.set_gauge("sqlite_rw_async_queue_size", _async_thread.qsize())
+    for name, stat in LockManager.get_stats().items():
+        MetricsRegistry.set_gauge("sqlite_rw_lock_wait_count", stat["wait_count"], lock = name)
+        MetricsRegistry.set_gauge("sqlite_rw_lock_wait_seconds", stat["total_wait_time"], lock = name)
+        MetricsRegistry.set_gauge("sqlite_rw_lock_max_wait_seconds", stat["max_wait_time"], lock = name)
+
+MetricsRegistry.register_collector("process", _collect_process_metrics)
 
 def async_func_deco():
     """同步调用转化成异步调用的装饰器"""
@@ -24,13 +45,22 @@ def async_func_deco():
         return handle
     return deco
 
-class LockManager:
-
-    lock = threading.RLock()
-
-    @classmethod
-    def get_lock(cls, dbpath=""):
-        return cls.lock
+def get_read_db_paths(read_db_path):
+    """把读库配置转换成 {name: path}, 支持单个路径、路径列表和字典
+    "memory:<name>" 表示进程内的内存读库, 转换成共享缓存的URI
+    """
+    if isinstance(read_db_path, dict):
+        paths = dict(read_db_path)
+    elif isinstance(read_db_path, (list, tuple)):
+        paths = dict((path, path) for path in read_db_path)
+    elif read_db_path == "" or read_db_path == None:
+        paths = dict()
+    else:
+        paths = {read_db_path: read_db_path}
+    for name, path in paths.items():
+        if path.startswith(MEMORY_PREFIX):
+            paths[name] = get_memory_uri(path[len(MEMORY_PREFIX):])
+    return paths
 
 class SqliteTableManager:
     """检查数据库字段，如果不存在就自动创建"""
@@ -38,16 +68,23 @@ class SqliteTableManager:
     def __init__(self, filename, tablename, pkName=None, pkType=None, no_pk=False, read_db_path=""):
         self.filename = filename
         self.tablename = tablename
+        self.read_db_path = read_db_path
         self.read_db = None
-
-        if read_db_path != "":
-            self.read_db = sqlite3.connect(read_db_path)
+        self.read_dbs = []
+        self.db_paths = dict() # 连接 -> 文件路径, 用于SchemaCache
+
+        # read_db_path 可以是一个路径, 也可以是多个读库的路径列表
+        for path in get_read_db_paths(read_db_path).values():
+            read_db = connect(path)
+            self.read_dbs.append(read_db)
+            self.db_paths[read_db] = path
+        if len(self.read_dbs) > 0:
+            self.read_db = self.read_dbs[0]
         self.db = sqlite3.connect(filename)
+        self.db_paths[self.db] = filename
 
         for db in self._get_db_list():
-            find_sql = "SELECT * FROM sqlite_master WHERE name = %r;" % tablename
-            result = self.do_execute(db, find_sql, silent=True)
-            if len(result) > 0:
+            if SchemaCache.has_table(self.db_paths[db], db, tablename):
                 continue
 
             if no_pk:
@@ -69,17 +106,15 @@ class SqliteTableManager:
         self.close()
 
     def _get_db_list(self):
-        if self.read_db == None:
-            return [self.db]
-        return [self.db, self.read_db]
+        return [self.db] + self.read_dbs
 
     def execute(self, sql, silent=False):
         return self.do_execute(self.db, sql, silent)
 
     def execute_write_and_read(self, sql, silent=False):
         result = self.do_execute(self.db, sql, silent)
-        if self.read_db != None:
-            self.do_execute(self.read_db, sql, silent)
+        for read_db in self.read_dbs:
+            self.do_execute(read_db, sql, silent)
         return result
 
     def do_execute(self, db, sql, silent=False):
@@ -88,19 +123,26 @@ class SqliteTableManager:
             if not silent:
                 logger.info(sql)
             cursorobj.execute(sql)
-            kv_result = []
-            result = cursorobj.fetchall()
-            for single in result:
-                resultMap = {}
-                for i, desc in enumerate(cursorobj.description):
-                    name = desc[0]
-                    resultMap[name] = single[i]
-                kv_result.append(resultMap)
+            kv_result = list(iter_rows(cursorobj, as_dict = True))
             db.commit()
             return kv_result
         except Exception:
             raise
 
+    def iter_execute(self, db, sql, params=(), size=500, as_dict=False):
+        """流式执行查询, 每次fetchmany读取size条, 返回Row的迭代器, as_dict=True时返回dict"""
+        cursorobj = db.cursor()
+        try:
+            cursorobj.execute(sql, params)
+            for row in iter_rows(cursorobj, size, as_dict):
+                yield row
+        finally:
+            cursorobj.close()
+
+    def iter_query(self, sql, params=(), size=500, as_dict=False):
+        """在写库上流式查询, 用于遍历大表"""
+        return self.iter_execute(self.db, sql, params, size, as_dict)
+
     def escape(self, strval):
         strval = strval.replace("'", "''")
         return "'%s'" % strval
@@ -113,10 +155,7 @@ class SqliteTableManager:
 
         for db in self._get_db_list():
             # MySQL 使用 DESC [表名]
-            columns = self.do_execute(
-                db, "pragma table_info('%s')" % self.tablename, silent=True)
-            # print(columns.description)
-            # description结构
+            columns = self.get_columns(db)
             is_col_exists = False
 
             for column in columns:
@@ -136,9 +175,46 @@ class SqliteTableManager:
             if not_null:
                 sql += " NOT NULL"
             self.do_execute(db, sql)
+            if db == self.db and self.has_binlog_triggers():
+                # 触发器需要包含新的字段
+                self.install_binlog_triggers()
     
     add_column = define_column
 
+    def get_columns(self, db=None):
+        """pragma table_info 的结果, 使用进程内的SchemaCache, 执行DDL之后自动失效"""
+        if db == None:
+            db = self.db
+        return SchemaCache.get_columns(self.db_paths[db], db, self.tablename)
+
+    def _get_trigger_name(self, op_type):
+        return replication.get_trigger_name(self.tablename, op_type)
+
+    def has_binlog_triggers(self):
+        sql = "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name = %r" % self._get_trigger_name("insert")
+        return len(self.do_execute(self.db, sql, silent=True)) > 0
+
+    def install_binlog_triggers(self, binlog_table="binlog"):
+        """在写库安装触发器, 由sqlite在同一个事务内直接写入binlog
+        所有的修改(包括直接执行的SQL)都会被同步到读库, 字段变化之后会自动重新安装
+        已经安装的触发器和字段一致时不会重新安装, 避免每次创建表对象都执行DDL
+        """
+        if not SchemaCache.has_table(self.filename, self.db, binlog_table):
+            self.do_execute(self.db, "CREATE TABLE IF NOT EXISTS `%s` (id integer primary key autoincrement, "
+                            "table_name text DEFAULT '', op_type text DEFAULT '', data text DEFAULT '')" % binlog_table)
+        names = [column["name"] for column in self.get_columns()]
+        sql_list = replication.build_trigger_sql(self.tablename, names, binlog_table)
+        installed = set(row[0] for row in self.db.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ?", (self.tablename,)))
+        if all(sql in installed for sql in sql_list if sql.startswith("CREATE")):
+            return
+        for sql in sql_list:
+            self.do_execute(self.db, sql)
+
+    def drop_binlog_triggers(self):
+        for op_type in ("insert", "update", "delete"):
+            self.do_execute(self.db, "DROP TRIGGER IF EXISTS `%s`" % self._get_trigger_name(op_type))
+
     def add_index(self, colname, is_unique=False):
         # sqlite的索引和table是一个级别的schema
         if isinstance(colname, list):
@@ -163,16 +239,18 @@ class SqliteTableManager:
         except Exception as e:
             logger.error("sql:%s, err:%s", sql, e)
 
-    def drop_column(self, colname):
-        # sql = "ALTER TABLE `%s` DROP COLUMN `%s`" % (self.tablename, colname)
-        # sqlite不支持 DROP COLUMN 得使用中间表
-        # TODO
-        pass
+    def drop_column(self, colname, binlog_table="binlog", chunk_size=None):
+        """删除字段, sqlite不支持高效的 DROP COLUMN, 使用中间表在线重建
+        写库和读库按照主键分块复制, 复制期间的写入通过binlog重放, 参考 migration.OnlineMigration
+        """
+        from .migration import OnlineMigration
+        migration = OnlineMigration(self.filename, self.tablename, self.read_db_path,
+                                    binlog_table = binlog_table, chunk_size = chunk_size)
+        migration.drop_columns([colname])
 
     def generate_migrate_sql(self, dropped_names):
         """生成迁移字段的SQL（本质上是迁移）"""
-        columns = self.execute("pragma table_info('%s')" %
-                               self.tablename, silent=True)
+        columns = self.get_columns()
         new_names = []
         old_names = []
         for column in columns:
@@ -191,132 +269,657 @@ class SqliteTableManager:
 
     def close(self):
         self.db.close()
-        if self.read_db != None:
-            self.read_db.close()
-
-
-class SqliteTable:
-    """基于web.db的装饰器
-    SqliteDB是全局唯一的，它的底层使用了连接池技术，每个线程都有独立的sqlite连接
+        for read_db in self.read_dbs:
+            read_db.close()
+
+
+def _copy_row(row):
+    """web.py的Storage是可变的, 返回副本避免缓存被修改"""
+    if isinstance(row, dict):
+        return row.__class__(row)
+    return row
+
+def init_binlog_table(db_file, binlog_table="binlog"):
+    with SqliteTableManager(db_file, binlog_table) as manager:
+        manager.add_column("table_name", "text", "")
+        manager.add_column("op_type", "text", "")
+        manager.add_column("data", "text", "")
+
+# binlog的记录方式
+CAPTURE_PYTHON = "python"   # 写操作之后查询变化的数据写入binlog
+CAPTURE_TRIGGER = "trigger" # 写库的触发器直接写入binlog
+
+# binlog的同步方式
+REPLICATION_LOCAL = "local"       # 每个进程都执行同步
+REPLICATION_LEADER = "leader"     # 通过文件锁选举, 每个写库只有一个进程执行同步
+REPLICATION_EXTERNAL = "external" # 进程内不执行同步, 由独立的 sqlite-rw-replicator 进程同步
+
+class SqliteRWDatabase:
+    """一个写库文件的句柄, 持有写库和读库的连接以及唯一的binlog同步通道, 通过table()获取表
+    同一个文件上的多个表共享连接, 定时同步任务只注册一次
+
+        database = SqliteRWDatabase("write.db", read_db_path = "read.db")
+        user = database.table("user")
+        order = database.table("order", cache_size = 1000)
     """
 
-    def __init__(self, dbpath, tablename, read_db_path="", timeout = 5, default_read_type = "read"):
-        assert read_db_path != "", "read_db_path is empty"
-        self.tablename = tablename
+    copy_batch_size = 1000 # 每次从binlog拉取的记录数
+    compact_binlog = True # 应用binlog之前合并冗余的操作
+    copy_cron_interval = None # 定时同步的间隔, None表示使用AsyncThread.cron_interval
+    leader_poll_interval = 0.5 # leader检查其他进程写入的间隔
+    memory_limit = None # 每个内存读库的最大字节数, None表示不限制
+    binlog_format = BINLOG_JSON # binlog的编码格式, 参考 binlog.py
+    binlog_segment_size = None # binlog分段的记录数, None表示不分段, 逐条删除已经应用的binlog
+
+    def __init__(self, dbpath, read_db_path="", timeout = 5, copy_batch_size = None, copy_cron_interval = None,
+                 read_route_policy = ROUTE_ROUND_ROBIN, max_read_lag = None, dedicated_replicas = None,
+                 replication_mode = REPLICATION_LEADER, backend = None, compact_binlog = None,
+                 leader_poll_interval = None, memory_limit = None, binlog_format = None, binlog_segment_size = None):
+        """参数的含义和SqliteTable一致
+        read_db_path 中 "memory:<name>" 形式的读库是进程内的内存读库, 创建时从写库备份, 之后由当前进程同步,
+        适合很小、读取很频繁的表, name在进程内唯一; memory_limit 限制每个内存读库的大小(字节)
+        binlog_format 为 compact 时binlog只记录字段列表的编号和字段值, 触发器模式仍然使用json
+        binlog_segment_size 不为None时binlog按照记录数分段, 所有读库应用之后整段删除
+        """
+        read_db_paths = get_read_db_paths(read_db_path)
+        assert len(read_db_paths) > 0, "read_db_path is empty"
         self.dbpath = dbpath
-        self.read_db_path = read_db_path
         self.binlog_table = "binlog"
+        self.timeout = timeout
+        self.backend = backend
+        self.replication_mode = replication_mode
+        if copy_batch_size != None:
+            self.copy_batch_size = copy_batch_size
+        if copy_cron_interval != None:
+            self.copy_cron_interval = copy_cron_interval
+        if compact_binlog != None:
+            self.compact_binlog = compact_binlog
+        if leader_poll_interval != None:
+            self.leader_poll_interval = leader_poll_interval
+        if memory_limit != None:
+            self.memory_limit = memory_limit
+        if binlog_format != None:
+            self.binlog_format = binlog_format
+        if binlog_segment_size != None:
+            self.binlog_segment_size = binlog_segment_size
+        assert self.binlog_format in (BINLOG_JSON, BINLOG_COMPACT), "unknown binlog_format:%s" % self.binlog_format
+        self._tables = dict()
+        # table() 创建表对象时会调用 get_group_committer, 需要可重入
+        self._lock = threading.RLock()
+        self._group_committer = None
+
         # SqliteDB 内部使用了threadlocal来实现，是线程安全的，使用全局单实例即可
+        self.db = create_db(dbpath, timeout, backend)
+
+        replicas = []
+        new_memory_replicas = []
+        for name, path in read_db_paths.items():
+            if is_memory_uri(path):
+                if MemoryReplicaRegistry.open(path):
+                    new_memory_replicas.append(name)
+                if self.memory_limit != None:
+                    MemoryReplicaRegistry.set_memory_limit(path, self.memory_limit)
+            read_db = create_db(path, timeout, backend)
+            dedicated = dedicated_replicas != None and name in dedicated_replicas
+            replicas.append(ReadReplica(name, path, read_db, dedicated = dedicated, dbpath = dbpath))
+        self.replicas = ReplicaSet(replicas, read_route_policy, max_read_lag)
+        # 兼容只有一个读库的用法
+        self.read_db_path = replicas[0].path
+        self.read_db = replicas[0].db
+
+        init_binlog_table(dbpath, self.binlog_table)
+        self.replicator = replication.BinlogReplicator(dbpath, self.db, self.replicas, self.binlog_table,
+                                                       self.copy_batch_size, self.compact_binlog,
+                                                       self.binlog_segment_size)
+        self.replicator.init_state_table()
+        for name in new_memory_replicas:
+            self.replicator.resync_replica(self.replicas.get(name))
+        # 读库的位置可能由其他进程推进: 非leader进程、外部同步模式, 以及LOCAL模式下同时同步的其他进程
+        self.replicas.set_refresh_func(self.refresh_positions)
+
+        cron_interval = self.copy_cron_interval
+        if cron_interval == None and self.replication_mode == REPLICATION_LEADER:
+            cron_interval = self.leader_poll_interval
+        _async_thread.put_cron_func(self.dbpath, self.run_copy_cron, cron_interval, lazy = True)
+        MetricsRegistry.register_collector(("replication", self.dbpath), self.collect_metrics)
+
+    def table(self, tablename, **kw):
+        """返回表对象, 参数参考SqliteTable中表级别的参数(default_read_type/capture_mode/cache_size等)
+        没有参数时复用已经创建的表对象
+        """
+        with self._lock:
+            table = self._tables.get(tablename)
+            if table == None or len(kw) > 0:
+                table = SqliteTable(self.dbpath, tablename, database = self, **kw)
+                self._tables[tablename] = table
+            return table
+
+    def get_group_committer(self):
+        """组提交队列, 同一个文件上开启了group_commit的表共享"""
+        with self._lock:
+            if self._group_committer == None:
+                self._group_committer = GroupCommitter(self.dbpath, self.db)
+            return self._group_committer
+
+    def _is_replicating(self):
+        """当前进程是否负责同步文件读库"""
+        if self.replication_mode == REPLICATION_EXTERNAL:
+            return False
+        if self.replication_mode == REPLICATION_LEADER:
+            return self.replicator.is_leader()
+        return True
+
+    def run_copy_cron(self):
+        if not self._is_replicating():
+            # 内存读库只能由当前进程同步
+            if len(self.replicas.get_memory_replicas()) > 0:
+                self.copy_to_memory()
+            return
+        if self.replication_mode == REPLICATION_LEADER:
+            # 其他进程的写入通过data_version感知, 之前同步失败留下的binlog需要继续重试
+            if not self.replicator.has_new_data() and not self.replicator.has_backlog():
+                return
+        logger.info("run_copy_cron")
+        self.copy_to_read()
 
-        self.db = web.db.SqliteDB(db=dbpath, timeout = timeout)
-        self.read_db = web.db.SqliteDB(db=read_db_path, timeout = timeout)
+    def copy_to_memory(self):
+        """只同步当前进程的内存读库"""
+        self.replicator.copy_to_read(self.replicas.get_memory_replicas())
 
-        if default_read_type == "write":
-            self.default_db = self.db
-        else:
-            self.default_db = self.read_db
+    def copy_to_read(self):
+        """把binlog同步到所有的读库, 直到binlog为空"""
+        self.replicator.copy_to_read()
+
+    def copy_to_read_async(self):
+        has_memory_replicas = len(self.replicas.get_memory_replicas()) > 0
+        if self.replication_mode == REPLICATION_EXTERNAL and not has_memory_replicas:
+            return
+        # 有写入之后才启动定时同步, 非leader也需要参与选举
+        _async_thread.ensure_started()
+        if not self._is_replicating():
+            if has_memory_replicas:
+                _async_thread.put_unique_task(("copy_to_memory", self.dbpath), self.copy_to_memory)
+            return
+        # 同一个数据库只保留一个待执行的同步任务
+        _async_thread.put_unique_task(("copy_to_read", self.dbpath), self.copy_to_read)
+
+    def refresh_positions(self):
+        """同步可能由其他进程执行, 从读库读取已经应用的位置"""
+        last_binlog_id = self.replicator.get_last_binlog_id() or 0
+        self.replicas.last_binlog_id = max(self.replicas.last_binlog_id, last_binlog_id)
+        for replica in self.replicas:
+            if replica.memory:
+                # 内存读库只由当前进程同步, 位置总是最新的
+                replica.update_position(replica.applied_id, last_binlog_id)
+                continue
+            applied_id = replication.get_applied_id(replication.get_connection(replica.db), self.dbpath)
+            replica.update_position(max(applied_id, replica.applied_id), last_binlog_id)
+        # 其他进程应用的binlog也需要失效当前进程的缓存
+        self.replicator.sync_row_cache()
+        return last_binlog_id
+
+    def collect_metrics(self):
+        """更新binlog积压和读库延迟的指标"""
+        last_binlog_id = self.refresh_positions()
+        for replica in self.replicas:
+            MetricsRegistry.set_gauge("sqlite_rw_replica_lag_records", replica.lag, db = self.dbpath, replica = replica.name)
+            MetricsRegistry.set_gauge("sqlite_rw_replica_lag_seconds", replica.get_lag_seconds(),
+                                      db = self.dbpath, replica = replica.name)
+            if replica.memory:
+                MetricsRegistry.set_gauge("sqlite_rw_memory_replica_bytes", MemoryReplicaRegistry.get_memory_size(replica.path),
+                                          db = self.dbpath, replica = replica.name)
+        backlog = max(0, last_binlog_id - self.replicas.get_min_applied_id())
+        MetricsRegistry.set_gauge("sqlite_rw_binlog_backlog", backlog, db = self.dbpath)
 
-        self.init_binlog_table(dbpath)
-        _async_thread.put_cron_func(self.dbpath, self.run_copy_cron)
+
+class SqliteTable:
+    """基于web.db(或者原生sqlite3后端)的装饰器
+    SqliteDB是全局唯一的，它的底层使用了连接池技术，每个线程都有独立的sqlite连接
+    """
+
+    copy_batch_size = 1000 # 每次从binlog拉取的记录数
+    compact_binlog = True # 应用binlog之前合并冗余的操作
+    copy_cron_interval = None # 定时同步的间隔, None表示使用AsyncThread.cron_interval
+    read_wait_timeout = 0.1 # 指定了min_seq的读请求等待读库同步的最长时间, 超时从写库读取
+    leader_poll_interval = 0.5 # leader检查其他进程写入的间隔
+
+    def __init__(self, dbpath, tablename, read_db_path="", timeout = 5, default_read_type = "read",
+                 copy_batch_size = None, copy_cron_interval = None,
+                 read_route_policy = ROUTE_ROUND_ROBIN, max_read_lag = None, dedicated_replicas = None,
+                 capture_mode = CAPTURE_PYTHON, replication_mode = REPLICATION_LEADER, backend = None,
+                 cache_size = 0, cache_ttl = None, count_columns = None, database = None, group_commit = False,
+                 memory_limit = None, binlog_format = None, binlog_segment_size = None):
+        """read_db_path 可以是一个路径, 多个读库的路径列表, 或者 {name: path} 字典
+        default_read_type 为 read/write 时读请求默认发到读库/写库, 为 auto 时按照执行计划选择, 参考 router.py
+        dedicated_replicas 中的读库只处理指定了 replica=name 的读请求, 比如用来跑报表的慢查询
+        capture_mode 为 trigger 时由写库的触发器记录binlog, 写操作只需要执行一条SQL
+        replication_mode 控制哪个进程执行binlog同步, 参考 REPLICATION_* 的说明
+        backend 为 BACKEND_WEBPY 或 BACKEND_SQLITE3, 默认安装了web.py时使用web.py
+        cache_size 大于0时缓存 select_first(where=dict(id=...)) 的结果, 读库应用binlog之后失效(包括其他进程执行的同步)
+        count_columns 不为None时在读库中维护计数, count() 和 count(where=dict(col=value)) 不再扫描表,
+            col需要在count_columns中, 空列表表示只维护总数
+        database 为 SqliteRWDatabase 时共享它的连接和binlog同步, 忽略文件级别的参数, 一般通过 database.table() 创建
+        group_commit 为True时并发的insert/update/delete合并到一个事务中提交, 参考 group_commit.py
+        memory_limit 为 "memory:<name>" 内存读库的最大字节数, 参考 SqliteRWDatabase
+        binlog_format/binlog_segment_size 是binlog的编码格式和分段大小, 参考 SqliteRWDatabase
+        """
+        self.tablename = tablename
+        self.default_read_type = default_read_type
+        self.capture_mode = capture_mode
+        self._local = threading.local()
+        self.row_cache = None
+        self.count_columns = None
+        if copy_batch_size != None:
+            self.copy_batch_size = copy_batch_size
+        if copy_cron_interval != None:
+            self.copy_cron_interval = copy_cron_interval
+
+        if database == None:
+            database = SqliteRWDatabase(dbpath, read_db_path, timeout, self.copy_batch_size, self.copy_cron_interval,
+                                        read_route_policy, max_read_lag, dedicated_replicas, replication_mode, backend,
+                                        compact_binlog = self.compact_binlog,
+                                        leader_poll_interval = self.leader_poll_interval,
+                                        memory_limit = memory_limit, binlog_format = binlog_format,
+                                        binlog_segment_size = binlog_segment_size)
+        self.database = database
+        self.dbpath = database.dbpath
+        self.binlog_table = database.binlog_table
+        self.replication_mode = database.replication_mode
+        self.db = database.db
+        self.replicas = database.replicas
+        self.read_db_path = database.read_db_path
+        self.read_db = database.read_db
+        self.replicator = database.replicator
+        if cache_size > 0:
+            self.row_cache = RowCacheRegistry.get(self.dbpath, tablename, cache_size, cache_ttl)
+        self.router = None
+        if default_read_type == "auto":
+            self.router = QueryRouter(self.db, self.replicas, tablename)
+        self.group_committer = None
+        if group_commit:
+            self.group_committer = database.get_group_committer()
+
+        if capture_mode == CAPTURE_TRIGGER:
+            with SqliteTableManager(self.dbpath, tablename) as manager:
+                manager.install_binlog_triggers(self.binlog_table)
+        if count_columns != None:
+            self.enable_count_cache(count_columns)
 
     def run_copy_cron(self):
-        logger.info("run_copy_cron")
-        self.copy_to_read()
+        self.database.run_copy_cron()
 
     def copy_to_read(self):
-        with LockManager.get_lock(self.dbpath):
-            try:
-                db = self.db
-                read_db = self.read_db
-                records = list(db.select(self.binlog_table, limit = 10, order = "id"))
-
-                for record in records:
-                    op_type = record.op_type
-                    data_str = record.data
-                    tablename = record.table_name
-                    data = json.loads(data_str)
-
-                    if op_type == "insert":
-                        # 由于是两个独立的db, 这里可能会重复执行，所以要判断下数据是否已经插入
-                        data_id = data.get("id")
-                        check_old = read_db.select(tablename, where = dict(id=data_id)).first()
-                        if check_old == None:
-                            read_db.insert(tablename, **data)
-                    elif op_type == "update":
-                        data_id = data.get("id")
-                        read_db.update(tablename, where = dict(id=data_id), **data)
-                    elif op_type == "delete_by_ids":
-                        read_db.delete(tablename, where = "id in $ids", vars = dict(ids = data))
-                    else:
-                        raise Exception("unknown op_type:%s" % op_type)
-                    
-                    db.delete(self.binlog_table, where=dict(id=record.id))
-            except sqlite3.OperationalError as e:
-                logger.error("copy_to_read failed, err:%s", e)
+        """把binlog同步到所有的读库, 直到binlog为空"""
+        self.replicator.copy_to_read()
+
+    def copy_batch_to_read(self, replica=None):
+        """同步一批binlog到读库, 返回处理的记录数"""
+        return self.replicator.copy_batch_to_read(replica)
+
+    def get_last_binlog_id(self):
+        return self.replicator.get_last_binlog_id()
+
+    def trim_binlog(self):
+        self.replicator.trim_binlog()
+
+    def resync_read_db(self, replica=None):
+        """用写库的快照重建读库, replica为读库名称, 默认第一个读库"""
+        if replica != None:
+            replica = self.replicas.get(replica)
+        applied_id = self.replicator.resync_replica(replica)
+        self.copy_to_read()
+        return applied_id
+
+    def check_read_db(self, replica=None, chunk_size=1000):
+        """分块比较写库和读库中当前表的数据, 返回不一致的id范围"""
+        if replica != None:
+            replica = self.replicas.get(replica)
+        return self.replicator.checksum_diff(self.tablename, replica, chunk_size)
+
+    def collect_metrics(self):
+        self.database.collect_metrics()
+
+    def enable_count_cache(self, columns=()):
+        """在所有读库中注册当前表的计数, 已经注册过的字段不会重新计算"""
+        for replica in self.replicas:
+            # 初始化期间暂停这个读库的binlog同步
+            with LockManager.get_lock(replica.path):
+                with replication.SafeTransaction(replica.db):
+                    counter.register(replication.get_connection(replica.db), self.tablename, columns)
+        self.count_columns = set(columns)
 
-    @async_func_deco()
     def copy_to_read_async(self):
-        return self.copy_to_read()
+        self.database.copy_to_read_async()
 
     def init_binlog_table(self, db_file):
-        with SqliteTableManager(db_file, "binlog") as manager:
-            manager.add_column("table_name", "text", "")
-            manager.add_column("op_type", "text", "")
-            manager.add_column("data", "text", "")
+        init_binlog_table(db_file, self.binlog_table)
+
+    def _encode_binlog(self, op_type, data):
+        if self.database.binlog_format == BINLOG_COMPACT:
+            return binlog.encode(self.dbpath, replication.get_connection(self.db), self.tablename, op_type, data)
+        return binlog.encode_json(data)
 
     def _insert_binlog(self, op_type, data):
-        # TODO 考虑binlog滚动，支持无限流写入
-        self.db.insert(self.binlog_table, table_name=self.tablename,
-                       op_type=op_type,
-                       data=json.dumps(data))
+        if hasattr(data, "keys"):
+            data = dict(data)
+        binlog_id = self.db.insert(self.binlog_table, table_name=self.tablename,
+                                   op_type=op_type,
+                                   data=self._encode_binlog(op_type, data))
+        self.replicas.set_last_binlog_id(binlog_id)
+        self._local.last_seq = binlog_id
+        return binlog_id
+
+    def _insert_binlog_many(self, op_type, data_list):
+        """批量写入binlog, 需要在写库的事务中调用"""
+        if len(data_list) == 0:
+            return
+        conn = replication.get_connection(self.db)
+        sql = "INSERT INTO %s (table_name, op_type, data) VALUES (?, ?, ?)" % self.binlog_table
+        conn.executemany(sql, [(self.tablename, op_type, self._encode_binlog(op_type, data)) for data in data_list])
+        binlog_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        self.replicas.set_last_binlog_id(binlog_id)
+        self._local.last_seq = binlog_id
+
+    def _record_last_seq(self):
+        """触发器模式下从binlog读取当前事务写入的位置"""
+        binlog_id = self.get_last_binlog_id()
+        self.replicas.set_last_binlog_id(binlog_id)
+        self._local.last_seq = binlog_id
+
+    def get_last_seq(self):
+        """当前线程最近一次写入的binlog位置, 读取时传入min_seq可以读到自己的写入"""
+        return getattr(self._local, "last_seq", 0)
+
+    def wait_replicated(self, seq, timeout=None):
+        """等待任意一个读库同步到seq"""
+        if timeout == None:
+            timeout = self.read_wait_timeout
+        if self.replicas.choose(min_seq = seq) != None:
+            return True
+        self.copy_to_read_async()
+        return self.replicas.wait(seq, timeout) != None
+
+    def _use_group_commit(self):
+        if self.group_committer == None or self.group_committer.in_batch():
+            return False
+        # 调用方自己开启了事务时直接执行
+        return not replication.get_connection(self.db).in_transaction
+
+    def _group_write(self, func, *args, **kw):
+        """交给组提交队列执行, binlog位置在leader线程中产生, 这里记录到调用方线程"""
+        # 批次中直接执行原始的方法, 避免重复记录耗时指标
+        func = getattr(func, "__wrapped__", func)
+        def run():
+            return func(self, *args, **kw), self.get_last_seq()
+        result, seq = self.group_committer.submit(self.tablename, run)
+        self._local.last_seq = seq
+        return result
 
+    @timed("insert")
     def insert(self, *args, **kw):
-        with LockManager.get_lock(self.dbpath):
-            with self.db.transaction():
+        if self._use_group_commit():
+            return self._group_write(self.insert, *args, **kw)
+        with LockManager.get_lock(self.dbpath, self.tablename):
+            with self.transaction():
                 insert_id = self.db.insert(self.tablename, *args, **kw)
+                if self.capture_mode == CAPTURE_TRIGGER:
+                    self._record_last_seq()
+                    self.copy_to_read_async()
+                    return insert_id
                 insert_value = self.db.select(
                     self.tablename, where=dict(id=insert_id)).first()
                 self._insert_binlog(op_type="insert", data=insert_value)
                 self.copy_to_read_async()
                 return insert_id
 
+    def get_read_db(self, replica=None, min_seq=None):
+        """选择读库, 返回 (db, replica)
+        min_seq: 读库至少需要同步到的binlog位置, 会等待最多read_wait_timeout秒
+        没有可用的读库(比如都延迟过大)时从写库读取, 此时replica为None
+        """
+        if replica == None and self.default_read_type == "write":
+            return self.db, None
+        item = self.replicas.choose(replica, min_seq)
+        if item == None and min_seq != None:
+            self.copy_to_read_async()
+            item = self.replicas.wait(min_seq, self.read_wait_timeout, replica)
+        if item == None:
+            return self.db, None
+        return item.db, item
+
+    @property
+    def default_db(self):
+        return self.get_read_db()[0]
+
+    def _read(self, replica, min_seq, func, *args, **kw):
+        db, item = self.get_read_db(replica, min_seq)
+        return self._run_read(db, item, func, *args, **kw)
+
+    def _run_read(self, db, item, func, *args, **kw):
+        if item == None:
+            return func(db, *args, **kw)
+        with item:
+            return func(db, *args, **kw)
+
+    def _read_routed(self, replica, min_seq, build_sql, func, *args, **kw):
+        """default_read_type为auto并且没有指定读库时, 按照build_sql()生成的SQL的执行计划选择数据源"""
+        if self.router == None or replica != None or min_seq != None:
+            return self._read(replica, min_seq, func, *args, **kw)
+        db, item = self.router.route(build_sql())
+        return self._run_read(db, item, func, *args, **kw)
+
+    def get_route_stats(self):
+        if self.router == None:
+            return None
+        return self.router.get_stats()
+
+    @timed("insert_many")
+    def insert_many(self, rows):
+        """批量插入, 返回插入的id列表
+        相同字段的数据使用一次executemany写入, 按id范围一次查出插入的数据写入binlog
+        """
+        if len(rows) == 0:
+            return []
+        groups = dict()
+        for index, row in enumerate(rows):
+            groups.setdefault(tuple(row.keys()), []).append(index)
+
+        ids = [None] * len(rows)
+        with LockManager.get_lock(self.dbpath, self.tablename):
+            with self.transaction():
+                conn = replication.get_connection(self.db)
+                inserted = []
+                for columns, indexes in groups.items():
+                    sql = "INSERT INTO `%s` (%s) VALUES (%s)" % (self.tablename,
+                        ",".join("`%s`" % name for name in columns), ",".join("?" for name in columns))
+                    conn.executemany(sql, [tuple(rows[i][name] for name in columns) for i in indexes])
+                    if "id" in columns:
+                        group_ids = [rows[i]["id"] for i in indexes]
+                        if self.capture_mode == CAPTURE_PYTHON:
+                            inserted += self._select_by_ids(conn, group_ids)
+                    else:
+                        # 同一个事务内, 一次executemany自增生成的id是连续的
+                        last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+                        group_ids = list(range(last_id - len(indexes) + 1, last_id + 1))
+                        if self.capture_mode == CAPTURE_PYTHON:
+                            cursor = conn.execute("SELECT * FROM `%s` WHERE id >= ? AND id <= ? ORDER BY id" % self.tablename,
+                                                  (group_ids[0], group_ids[-1]))
+                            inserted += replication.fetch_dicts(cursor)
+                    for i, data_id in zip(indexes, group_ids):
+                        ids[i] = data_id
+                if self.capture_mode == CAPTURE_TRIGGER:
+                    self._record_last_seq()
+                else:
+                    self._insert_binlog_many("insert", inserted)
+        self.copy_to_read_async()
+        return ids
+
+    def _select_by_ids(self, conn, ids):
+        result = []
+        for chunk in replication.split_list(ids, 500):
+            sql = "SELECT * FROM `%s` WHERE id IN (%s)" % (self.tablename, ",".join("?" for x in chunk))
+            result += replication.fetch_dicts(conn.execute(sql, chunk))
+        return result
+
+    @timed("update_many")
+    def update_many(self, rows):
+        """按id批量更新, 每一行必须包含id字段, 返回更新的行数"""
+        if len(rows) == 0:
+            return 0
+        groups = dict()
+        for row in rows:
+            assert "id" in row, "id is required"
+            columns = tuple(name for name in row.keys() if name != "id")
+            groups.setdefault(columns, []).append(row)
+
+        update_count = 0
+        with LockManager.get_lock(self.dbpath, self.tablename):
+            with self.transaction():
+                conn = replication.get_connection(self.db)
+                for columns, group in groups.items():
+                    sql = "UPDATE `%s` SET %s WHERE id = ?" % (self.tablename,
+                        ",".join("`%s` = ?" % name for name in columns))
+                    params = [tuple(row[name] for name in columns) + (row["id"],) for row in group]
+                    update_count += conn.executemany(sql, params).rowcount
+                if self.capture_mode == CAPTURE_TRIGGER:
+                    self._record_last_seq()
+                else:
+                    updated = self._select_by_ids(conn, [row["id"] for row in rows])
+                    self._insert_binlog_many("update", updated)
+        self.copy_to_read_async()
+        return update_count
+
+    @timed("select")
     def select(self, *args, **kw):
-        return self.default_db.select(self.tablename, *args, **kw)
+        replica = kw.pop("replica", None)
+        min_seq = kw.pop("min_seq", None)
+        build_sql = lambda: self.db.select(self.tablename, *args, _test = True, **kw)
+        return self._read_routed(replica, min_seq, build_sql, self._select, *args, **kw)
+
+    def _select(self, db, *args, **kw):
+        return db.select(self.tablename, *args, **kw)
 
     def select_from_write(self, *args, **kw):
         return self.db.select(self.tablename, *args, **kw)
 
+    def iter_select(self, *args, **kw):
+        """流式查询, 参数和select一致, 用于导出大量数据
+        size: 每次fetchmany读取的条数
+        as_dict: 返回dict, 默认返回只读的Row
+        """
+        size = kw.pop("size", 500)
+        as_dict = kw.pop("as_dict", False)
+        replica = kw.pop("replica", None)
+        min_seq = kw.pop("min_seq", None)
+        db, item = self.get_read_db(replica, min_seq)
+        sql_query = db.select(self.tablename, *args, _test = True, **kw)
+        sql = sql_query.query(paramstyle = "qmark")
+        cursor = replication.get_connection(db).cursor()
+        try:
+            cursor.execute(sql, list(sql_query.values()))
+            if item == None:
+                for row in iter_rows(cursor, size, as_dict):
+                    yield row
+            else:
+                with item:
+                    for row in iter_rows(cursor, size, as_dict):
+                        yield row
+        finally:
+            cursor.close()
+
+    @timed("select_first")
     def select_first(self, *args, **kw):
-        return self.default_db.select(self.tablename, *args, **kw).first()
+        if self.row_cache != None and len(args) == 0 and len(kw) == 1:
+            where = kw.get("where")
+            if isinstance(where, dict) and len(where) == 1 and "id" in where:
+                return self._select_first_by_id(where["id"])
+        return self.select(*args, **kw).first()
+
+    def _select_first_by_id(self, data_id):
+        # 按照读库最新的同步位置失效缓存, 有频率限制
+        self.replicas.refresh()
+        value = self.row_cache.get(data_id)
+        if value is not RowCacheRegistry.MISSING:
+            return _copy_row(value)
+        generation = self.row_cache.generation
+        value = self.select(where = dict(id = data_id)).first()
+        self.row_cache.put(data_id, value, generation)
+        return _copy_row(value)
+
+    def get_cache_stats(self):
+        if self.row_cache == None:
+            return None
+        return self.row_cache.get_stats()
     
     def select_first_from_write(self, *args, **kw):
         return self.db.select(self.tablename, *args, **kw).first()
 
+    @timed("query")
     def query(self, *args, **kw):
-        return self.default_db.query(*args, **kw)
+        replica = kw.pop("replica", None)
+        min_seq = kw.pop("min_seq", None)
+        build_sql = lambda: self.db.query(*args, _test = True, **kw)
+        return self._read_routed(replica, min_seq, build_sql, self._query, *args, **kw)
+
+    def _query(self, db, *args, **kw):
+        return db.query(*args, **kw)
     
     def query_from_write(self, *args, **kw):
         return self.db.query(*args, **kw)
 
+    def _count_from_counter(self, db, where):
+        """读库中有维护好的计数时直接返回, 否则返回None"""
+        if self.count_columns == None or db is self.db:
+            return None
+        if where == None or where == "":
+            return counter.get_count(replication.get_connection(db), self.tablename)
+        if isinstance(where, dict) and len(where) == 1:
+            column, value = list(where.items())[0]
+            if column in self.count_columns:
+                return counter.get_count(replication.get_connection(db), self.tablename, column, value)
+        return None
+
     def _count(self, db, where=None, sql=None, vars=None):
         if sql is None:
+            amount = self._count_from_counter(db, where)
+            if amount != None:
+                return amount
             if isinstance(where, dict):
-                return self.select_first(what="COUNT(1) AS amount", where=where).amount
+                return db.select(self.tablename, what="COUNT(1) AS amount", where=where).first().amount
             else:
                 sql = "SELECT COUNT(1) AS amount FROM %s" % self.tablename
                 if where:
                     sql += " WHERE %s" % where
         return db.query(sql, vars=vars).first().amount
 
-    def count(self, where=None, sql=None, vars=None):
-        return self._count(self.default_db, where, sql, vars)
+    @timed("count")
+    def count(self, where=None, sql=None, vars=None, replica=None, min_seq=None):
+        build_sql = lambda: self._build_count_query(where, sql, vars)
+        return self._read_routed(replica, min_seq, build_sql, self._count, where, sql, vars)
+
+    def _build_count_query(self, where=None, sql=None, vars=None):
+        if sql is None:
+            if isinstance(where, dict):
+                return self.db.select(self.tablename, what="COUNT(1) AS amount", where=where, _test=True)
+            sql = "SELECT COUNT(1) AS amount FROM %s" % self.tablename
+            if where:
+                sql += " WHERE %s" % where
+        return self.db.query(sql, vars=vars, _test=True)
     
     def count_from_write(self, where = None, sql = None, vars = None):
         return self._count(self.db, where, sql, vars)
 
+    @timed("update")
     def update(self, where, vars=None, _test=False, **values):
-        with LockManager.get_lock(self.dbpath):
-            with self.db.transaction():
+        if not _test and self._use_group_commit():
+            return self._group_write(self.update, where, vars, **values)
+        with LockManager.get_lock(self.dbpath, self.tablename):
+            with self.transaction():
+                if self.capture_mode == CAPTURE_TRIGGER:
+                    update_result = self.db.update(self.tablename, where, vars, _test, **values)
+                    self._record_last_seq()
+                    self.copy_to_read_async()
+                    return update_result
                 ids_results = self.db.select(self.tablename, what="id", where = where, vars = vars, _test = _test)
                 ids = list(map(lambda x:x.id, ids_results))
                 if len(ids) == 0:
@@ -328,9 +931,17 @@ class SqliteTable:
                 self.copy_to_read_async()
                 return update_result
 
+    @timed("delete")
     def delete(self, *args, **kw):
-        with LockManager.get_lock(self.dbpath):
-            with self.db.transaction():
+        if not kw.get("_test") and self._use_group_commit():
+            return self._group_write(self.delete, *args, **kw)
+        with LockManager.get_lock(self.dbpath, self.tablename):
+            with self.transaction():
+                if self.capture_mode == CAPTURE_TRIGGER:
+                    delete_result = self.db.delete(self.tablename, *args, **kw)
+                    self._record_last_seq()
+                    self.copy_to_read_async()
+                    return delete_result
                 ids_results = self.db.select(self.tablename, what="id", *args, **kw)
                 ids = list(map(lambda x:x.id, ids_results))
                 if len(ids) == 0:
@@ -340,7 +951,7 @@ class SqliteTable:
                 return self.db.delete(self.tablename, where="id in $ids", vars=dict(ids=ids))
     
     def transaction(self):
-        return self.db.transaction()
+        return replication.SafeTransaction(self.db)
 
 
 TableManager = SqliteTableManager
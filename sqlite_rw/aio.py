@@ -0,0 +1,195 @@
+# encoding=utf-8
+"""asyncio接口
+
+AsyncSqliteTable 把 SqliteTable 的调用放到每个数据库文件独立的线程池中执行,
+事件循环不会被sqlite的IO和LockManager的锁阻塞, 线程池的大小是有限的, 并发的请求在线程池中排队
+
+    table = AsyncSqliteTable("write.db", "user", read_db_path = "read.db")
+    data_id = await table.insert(name = "test")
+    await table.wait_replicated(table.get_last_seq())
+    async for row in table.iter_select(where = dict(name = "test")):
+        ...
+"""
+
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from . import SqliteTable
+
+_last_seq = contextvars.ContextVar("sqlite_rw_last_seq", default = 0)
+_STOP = object()
+
+
+class ExecutorRegistry:
+    """每个数据库文件一个线程池"""
+
+    max_workers = 4
+
+    _lock = threading.Lock()
+    _executors = dict()
+
+    @classmethod
+    def get(cls, dbpath, max_workers=None):
+        key = os.path.abspath(dbpath)
+        with cls._lock:
+            executor = cls._executors.get(key)
+            if executor == None:
+                if max_workers == None:
+                    max_workers = cls.max_workers
+                executor = ThreadPoolExecutor(max_workers = max_workers,
+                                              thread_name_prefix = "sqlite-rw-%s" % os.path.basename(dbpath))
+                cls._executors[key] = executor
+            return executor
+
+
+class AsyncSqliteTable:
+    """SqliteTable的asyncio版本, 参数和SqliteTable一致"""
+
+    wait_interval = 0.005 # wait_replicated 轮询的初始间隔
+
+    def __init__(self, dbpath, tablename, *args, **kw):
+        max_workers = kw.pop("max_workers", None)
+        self.table = SqliteTable(dbpath, tablename, *args, **kw)
+        self.tablename = tablename
+        self.executor = ExecutorRegistry.get(dbpath, max_workers)
+
+    async def _run(self, func, *args, **kw):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kw))
+
+    def _write_and_get_seq(self, func, *args, **kw):
+        result = func(*args, **kw)
+        return result, self.table.get_last_seq()
+
+    async def _write(self, func, *args, **kw):
+        # last_seq在SqliteTable中是线程变量, 这里转换成当前协程上下文的变量
+        result, seq = await self._run(self._write_and_get_seq, func, *args, **kw)
+        _last_seq.set(seq)
+        return result
+
+    async def insert(self, *args, **kw):
+        return await self._write(self.table.insert, *args, **kw)
+
+    async def insert_many(self, rows):
+        return await self._write(self.table.insert_many, rows)
+
+    async def update(self, *args, **kw):
+        return await self._write(self.table.update, *args, **kw)
+
+    async def update_many(self, rows):
+        return await self._write(self.table.update_many, rows)
+
+    async def delete(self, *args, **kw):
+        return await self._write(self.table.delete, *args, **kw)
+
+    def _select_list(self, *args, **kw):
+        return list(self.table.select(*args, **kw))
+
+    async def select(self, *args, **kw):
+        return await self._run(self._select_list, *args, **kw)
+
+    async def select_first(self, *args, **kw):
+        return await self._run(self.table.select_first, *args, **kw)
+
+    def _query_list(self, *args, **kw):
+        result = self.table.query(*args, **kw)
+        if isinstance(result, int):
+            return result
+        return list(result)
+
+    async def query(self, *args, **kw):
+        return await self._run(self._query_list, *args, **kw)
+
+    async def count(self, *args, **kw):
+        return await self._run(self.table.count, *args, **kw)
+
+    def get_last_seq(self):
+        """当前协程上下文最近一次写入的binlog位置
+        asyncio.gather/create_task 创建的任务复制了上下文, 它们的写入不会更新调用方的位置
+        """
+        return _last_seq.get()
+
+    def _is_replicated(self, seq):
+        """只比较进程内的同步位置, 不访问sqlite, 可以在事件循环中调用"""
+        for replica in self.table.replicas:
+            if not replica.dedicated and replica.applied_id >= seq:
+                return True
+        return False
+
+    def _prepare_wait(self):
+        self.table.replicas.refresh()
+        self.table.copy_to_read_async()
+
+    async def wait_replicated(self, seq, timeout=None):
+        """等待任意一个读库同步到seq
+        事件循环中只比较内存中的位置, 触发同步和刷新位置都会访问sqlite(队列满时同步会在调用方线程执行),
+        放到线程池中执行
+        """
+        if timeout == None:
+            timeout = self.table.read_wait_timeout
+        if self._is_replicated(seq):
+            return True
+        await self._run(self._prepare_wait)
+        deadline = time.time() + timeout
+        interval = self.wait_interval
+        while not self._is_replicated(seq):
+            if time.time() >= deadline:
+                return False
+            await asyncio.sleep(min(interval, max(0, deadline - time.time())))
+            if not self._is_replicated(seq):
+                await self._run(self.table.replicas.refresh)
+            interval = min(interval * 2, 0.1)
+        return True
+
+    async def iter_select(self, *args, **kw):
+        """流式查询, 查询在线程池中执行, 通过有界队列按块传给事件循环
+        迭代期间会占用线程池的一个线程
+        """
+        size = kw.get("size", 500)
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize = 2)
+        stop = threading.Event()
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def produce():
+            try:
+                chunk = []
+                for row in self.table.iter_select(*args, **kw):
+                    if stop.is_set():
+                        return
+                    chunk.append(row)
+                    if len(chunk) >= size:
+                        put(chunk)
+                        chunk = []
+                if len(chunk) > 0 and not stop.is_set():
+                    put(chunk)
+            except Exception as e:
+                put(e)
+            finally:
+                if not stop.is_set():
+                    put(_STOP)
+
+        future = loop.run_in_executor(self.executor, produce)
+        try:
+            while True:
+                item = await queue.get()
+                if item is _STOP:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                for row in item:
+                    yield row
+        finally:
+            stop.set()
+            # 清空队列, 让阻塞在put上的生产者退出
+            while not future.done():
+                while not queue.empty():
+                    queue.get_nowait()
+                await asyncio.sleep(0.001)
@@ -5,52 +5,138 @@ import logging
 import time
 import traceback
 from collections import deque
+from .metrics import MetricsRegistry
+
+# 任务队列满了之后的处理策略
+OVERFLOW_BLOCK = "block"   # 阻塞调用方, 直到队列有空位(最多等待block_timeout, 超时后在调用方线程执行)
+OVERFLOW_DROP = "drop"     # 丢弃新任务, 适用于幂等的任务(比如copy_to_read, cron会兜底执行)
+OVERFLOW_INLINE = "inline" # 在调用方线程直接执行
 
 class AsyncThread(threading.Thread):
-    
+
     MAX_TASK_QUEUE = 200
     cron_interval = 5 # cron函数运行的间隔
+    overflow_policy = OVERFLOW_INLINE
+    block_timeout = 1
 
-    def __init__(self, name="AsyncThread"):
+    def __init__(self, name="AsyncThread", overflow_policy=None, auto_start=False):
+        """auto_start为True时不需要调用start(), 第一次添加任务时自动启动"""
         super(AsyncThread, self).__init__()
         self.daemon = True # 设置为守护线程，不阻塞进程退出
         self.name = name
         self.task_queue = deque()
+        self.pending_keys = set()
+        self.cond = threading.Condition()
         self.cron_func_dict = dict()
+        self.auto_start = auto_start
+        self.start_lock = threading.Lock()
+        if overflow_policy != None:
+            self.overflow_policy = overflow_policy
+
+    def ensure_started(self):
+        """第一次添加任务时才启动线程, 只读的进程(比如命令行工具)不会创建后台线程"""
+        if not self.auto_start or self.is_alive():
+            return
+        with self.start_lock:
+            if not self.is_alive() and self.ident == None:
+                self.start()
 
     def put_task(self, func, *args, **kw):
-        if len(self.task_queue) > self.MAX_TASK_QUEUE:
-            logging.error("too many log task, size: %s, max_size: %s",
-                           len(self.task_queue), self.MAX_TASK_QUEUE)
-            func(*args, **kw)
-        else:
-            self.task_queue.append([func, args, kw])
-    
-    def put_cron_func(self, key, func):
-        self.cron_func_dict[key] = func
-
-    def run_cron_func(self):
-        for key in self.cron_func_dict:
-            func = self.cron_func_dict.get(key)
-            if func != None:
-                self.put_task(func)
+        return self._put_task(None, func, args, kw)
 
-    def run(self):
-        start_idle_time = time.time()
+    def put_unique_task(self, key, func, *args, **kw):
+        """添加任务, 同一个key在队列中只保留一个待执行的任务"""
+        return self._put_task(key, func, args, kw)
+
+    def _put_task(self, key, func, args, kw):
+        self.ensure_started()
+        run_inline = False
+        with self.cond:
+            if key != None and key in self.pending_keys:
+                # 合并重复的任务
+                return True
+            if len(self.task_queue) >= self.MAX_TASK_QUEUE:
+                logging.error("too many async task, size: %s, max_size: %s, policy: %s",
+                              len(self.task_queue), self.MAX_TASK_QUEUE, self.overflow_policy)
+                MetricsRegistry.inc("sqlite_rw_async_overflow", policy = self.overflow_policy)
+                if self.overflow_policy == OVERFLOW_DROP:
+                    return False
+                if self.overflow_policy == OVERFLOW_BLOCK:
+                    deadline = time.time() + self.block_timeout
+                    while len(self.task_queue) >= self.MAX_TASK_QUEUE:
+                        timeout = deadline - time.time()
+                        if timeout <= 0:
+                            break
+                        self.cond.wait(timeout)
+                run_inline = len(self.task_queue) >= self.MAX_TASK_QUEUE
+
+            if not run_inline:
+                self._append_task(key, func, args, kw)
+                return True
+
+        func(*args, **kw)
+        return True
 
+    def _append_task(self, key, func, args, kw):
+        with self.cond:
+            if key != None:
+                if key in self.pending_keys:
+                    return
+                self.pending_keys.add(key)
+            self.task_queue.append([key, func, args, kw])
+            self.cond.notify_all()
+
+    def qsize(self):
+        return len(self.task_queue)
+
+    def put_cron_func(self, key, func, interval=None, lazy=False):
+        """注册定时任务, interval为None时使用cron_interval
+        lazy为True时不启动线程, 等到第一次添加任务时再开始执行
+        """
+        with self.cond:
+            self.cron_func_dict[key] = [func, interval, time.time()]
+            self.cond.notify_all()
+        if not lazy:
+            self.ensure_started()
+
+    def get_cron_wait_time(self, now):
+        """距离下一次cron执行的时间"""
+        wait_time = self.cron_interval
+        for func, interval, last_time in self.cron_func_dict.values():
+            if interval == None:
+                interval = self.cron_interval
+            wait_time = min(wait_time, last_time + interval - now)
+        return wait_time
+
+    def run_cron_func(self, now=None):
+        if now == None:
+            now = time.time()
+        for key, item in list(self.cron_func_dict.items()):
+            func, interval, last_time = item
+            if interval == None:
+                interval = self.cron_interval
+            if now - last_time >= interval:
+                item[2] = now
+                # cron任务数量有限, 不受队列长度限制
+                self._append_task(("cron", key), func, (), {})
+
+    def run(self):
         while True:
-            # queue.Queue默认是block模式
-            # 但是deque没有block模式，popleft可能抛出IndexError异常
             try:
-                if self.task_queue:
-                    func, args, kw = self.task_queue.popleft()
-                    func(*args, **kw)
-                    start_idle_time = time.time() # 重置 start_idle_time
-                else:
-                    time.sleep(0.01)
-                    idle_time = time.time() - start_idle_time
-                    if idle_time >= self.cron_interval:
-                        self.run_cron_func()
+                with self.cond:
+                    while True:
+                        now = time.time()
+                        if self.get_cron_wait_time(now) <= 0:
+                            self.run_cron_func(now)
+                        if self.task_queue:
+                            break
+                        # 有新任务时会被唤醒, 否则等到下一次cron执行
+                        wait_time = self.get_cron_wait_time(time.time())
+                        self.cond.wait(max(wait_time, 0.001))
+                    key, func, args, kw = self.task_queue.popleft()
+                    self.pending_keys.discard(key)
+                    self.cond.notify_all()
+                func(*args, **kw)
             except Exception as e:
                 exc = traceback.format_exc()
                 logging.error("execute failed, %s", exc)
@@ -0,0 +1,410 @@
+# encoding=utf-8
+"""数据库后端
+
+- webpy: 使用web.db.SqliteDB, 需要安装web.py
+- sqlite3: 直接使用sqlite3, 每个线程一个连接, 缓存固定形状的SQL文本, 返回轻量的Row对象
+
+两种后端提供相同的接口: select/insert/update/delete/query/transaction/get_connection
+"""
+
+import re
+import sqlite3
+import threading
+from functools import lru_cache
+
+try:
+    import web
+except ImportError:
+    web = None
+
+BACKEND_WEBPY = "webpy"
+BACKEND_SQLITE3 = "sqlite3"
+
+if web != None:
+    DEFAULT_BACKEND = BACKEND_WEBPY
+else:
+    DEFAULT_BACKEND = BACKEND_SQLITE3
+
+
+def is_uri(path):
+    return path.startswith("file:")
+
+
+def connect(path, **kw):
+    """sqlite3.connect, file: 开头的路径按照URI打开, 比如内存读库"""
+    if is_uri(path):
+        kw.setdefault("uri", True)
+    return sqlite3.connect(path, **kw)
+
+
+def create_db(path, timeout=5, backend=None, **kw):
+    if is_uri(path):
+        kw.setdefault("uri", True)
+    if backend == None:
+        backend = DEFAULT_BACKEND
+    if backend == BACKEND_WEBPY:
+        assert web != None, "web.py is not installed"
+        return WebpySqliteDB(db=path, timeout = timeout, **kw)
+    if backend == BACKEND_SQLITE3:
+        return NativeSqliteDB(path, timeout = timeout, **kw)
+    raise Exception("unknown backend:%s" % backend)
+
+
+if web != None:
+    class WebpySqliteDB(web.db.SqliteDB):
+
+        def get_connection(self):
+            """当前线程的sqlite3连接"""
+            return self._getctx().db
+
+
+class Row(tuple):
+    """轻量的查询结果, 支持 row.name / row["name"] / row[0] / dict(row)"""
+
+    __slots__ = ()
+    _names = ()
+    _index = dict()
+
+    def __getattr__(self, name):
+        try:
+            return tuple.__getitem__(self, self._index[name])
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return tuple.__getitem__(self, self._index[key])
+        return tuple.__getitem__(self, key)
+
+    def get(self, name, default=None):
+        index = self._index.get(name)
+        if index == None:
+            return default
+        return tuple.__getitem__(self, index)
+
+    def keys(self):
+        return self._names
+
+    def values(self):
+        return tuple(self)
+
+    def items(self):
+        return zip(self._names, self)
+
+    def to_dict(self):
+        return dict(zip(self._names, self))
+
+    def __repr__(self):
+        return "<Row %r>" % self.to_dict()
+
+
+@lru_cache(maxsize=256)
+def make_row_class(names):
+    """每一种字段组合只创建一次Row的子类"""
+    index = dict()
+    for i, name in enumerate(names):
+        index.setdefault(name, i)
+    return type("Row", (Row,), dict(__slots__ = (), _names = names, _index = index))
+
+
+def get_row_class(cursor):
+    return make_row_class(tuple(desc[0] for desc in cursor.description))
+
+
+def iter_rows(cursor, size=500, as_dict=False):
+    """按照fetchmany分块读取游标, 每个游标只计算一次字段映射
+    默认返回Row, as_dict=True时返回dict
+    """
+    if cursor.description == None:
+        return
+    row_class = get_row_class(cursor)
+    names = row_class._names
+    while True:
+        rows = cursor.fetchmany(size)
+        if len(rows) == 0:
+            break
+        for row in rows:
+            if as_dict:
+                yield dict(zip(names, row))
+            else:
+                yield row_class(row)
+
+
+class ResultSet(list):
+
+    def first(self, default=None):
+        if len(self) == 0:
+            return default
+        return self[0]
+
+
+class SqlQuery:
+    """_test=True 时返回的SQL和参数"""
+
+    def __init__(self, sql, params):
+        self.sql = sql
+        self.params = params
+
+    def query(self, paramstyle=None):
+        return self.sql
+
+    def values(self):
+        return self.params
+
+    def __str__(self):
+        return self.sql
+
+
+_VAR_PATTERN = re.compile(r"\$([A-Za-z_][A-Za-z0-9_]*)")
+
+
+def _quote(name):
+    return "`%s`" % name
+
+
+@lru_cache(maxsize=1024)
+def _compile_vars(sql):
+    """把 $name 形式的变量转换成 ? 占位符, 返回 (sql片段列表, 变量名列表)"""
+    parts = []
+    names = []
+    last = 0
+    for match in _VAR_PATTERN.finditer(sql):
+        parts.append(sql[last:match.start()])
+        names.append(match.group(1))
+        last = match.end()
+    parts.append(sql[last:])
+    return tuple(parts), tuple(names)
+
+
+def interpolate(sql, vars):
+    """web.py风格的变量替换, 列表变量展开成 (?, ?, ?)"""
+    if vars == None or "$" not in sql:
+        return sql, []
+    parts, names = _compile_vars(sql)
+    result = [parts[0]]
+    params = []
+    for name, part in zip(names, parts[1:]):
+        value = vars[name]
+        if isinstance(value, (list, tuple, set)):
+            value = list(value)
+            result.append("(%s)" % ",".join("?" for x in value))
+            params.extend(value)
+        else:
+            result.append("?")
+            params.append(value)
+        result.append(part)
+    return "".join(result), params
+
+
+@lru_cache(maxsize=1024)
+def _where_dict_sql(keys):
+    return " AND ".join("%s = ?" % _quote(key) for key in keys)
+
+
+def build_where(where, vars):
+    if where == None or where == "":
+        return "", []
+    if isinstance(where, dict):
+        keys = tuple(where.keys())
+        return _where_dict_sql(keys), [where[key] for key in keys]
+    if isinstance(where, int):
+        return "id = ?", [where]
+    return interpolate(where, vars)
+
+
+@lru_cache(maxsize=1024)
+def _insert_sql(tablename, columns):
+    if len(columns) == 0:
+        return "INSERT INTO %s DEFAULT VALUES" % _quote(tablename)
+    return "INSERT INTO %s (%s) VALUES (%s)" % (_quote(tablename),
+        ",".join(_quote(name) for name in columns), ",".join("?" for name in columns))
+
+
+@lru_cache(maxsize=1024)
+def _update_sql(tablename, columns):
+    return "UPDATE %s SET %s" % (_quote(tablename), ",".join("%s = ?" % _quote(name) for name in columns))
+
+
+class _ConnectionHolder:
+    """线程结束时threading.local被回收, 关闭连接并释放连接池的名额"""
+
+    def __init__(self, conn, semaphore):
+        self.conn = conn
+        self.semaphore = semaphore
+        self.transactions = []
+
+    def __del__(self):
+        try:
+            self.conn.close()
+        finally:
+            self.semaphore.release()
+
+
+class NativeSqliteDB:
+    """直接使用sqlite3的后端, 接口和web.db.SqliteDB保持一致"""
+
+    max_connections = 64 # 每个文件最多的连接数
+    cached_statements = 256 # sqlite3连接内部缓存的编译好的语句数量
+
+    def __init__(self, path, timeout=5, max_connections=None, **connect_kw):
+        self.path = path
+        self.timeout = timeout
+        self.connect_kw = connect_kw
+        if max_connections != None:
+            self.max_connections = max_connections
+        self._local = threading.local()
+        self._semaphore = threading.BoundedSemaphore(self.max_connections)
+
+    def _get_holder(self):
+        holder = getattr(self._local, "holder", None)
+        if holder == None:
+            if not self._semaphore.acquire(timeout = self.timeout):
+                raise sqlite3.OperationalError("too many connections, max_connections:%s" % self.max_connections)
+            try:
+                # isolation_level=None 由 transaction() 显式控制事务
+                # 连接只在创建的线程中使用, 但是可能在其他线程中被回收关闭
+                conn = sqlite3.connect(self.path, timeout = self.timeout, isolation_level = None,
+                                       cached_statements = self.cached_statements,
+                                       check_same_thread = False, **self.connect_kw)
+            except Exception:
+                self._semaphore.release()
+                raise
+            holder = _ConnectionHolder(conn, self._semaphore)
+            self._local.holder = holder
+        return holder
+
+    def get_connection(self):
+        """当前线程的sqlite3连接"""
+        return self._get_holder().conn
+
+    def _execute(self, sql, params):
+        cursor = self.get_connection().execute(sql, params)
+        if cursor.description == None:
+            return cursor
+        row_class = get_row_class(cursor)
+        return ResultSet(row_class(row) for row in cursor.fetchall())
+
+    def query(self, sql_query, vars=None, processed=False, _test=False):
+        sql, params = interpolate(sql_query, vars)
+        if _test:
+            return SqlQuery(sql, params)
+        result = self._execute(sql, params)
+        if isinstance(result, ResultSet):
+            return result
+        return result.rowcount
+
+    def build_select(self, tables, vars=None, what="*", where=None, order=None, group=None,
+                     limit=None, offset=None):
+        where_sql, params = build_where(where, vars)
+        sql = "SELECT %s FROM %s" % (what, tables)
+        if where_sql:
+            sql += " WHERE " + where_sql
+        if group:
+            sql += " GROUP BY %s" % group
+        if order:
+            sql += " ORDER BY %s" % order
+        if limit != None:
+            sql += " LIMIT %d" % int(limit)
+        if offset != None:
+            if limit == None:
+                sql += " LIMIT -1"
+            sql += " OFFSET %d" % int(offset)
+        return sql, params
+
+    def select(self, tables, vars=None, what="*", where=None, order=None, group=None,
+               limit=None, offset=None, _test=False):
+        sql, params = self.build_select(tables, vars, what, where, order, group, limit, offset)
+        if _test:
+            return SqlQuery(sql, params)
+        return self._execute(sql, params)
+
+    def insert(self, tablename, seqname=None, _test=False, **values):
+        columns = tuple(values.keys())
+        sql = _insert_sql(tablename, columns)
+        params = [values[name] for name in columns]
+        if _test:
+            return SqlQuery(sql, params)
+        return self._execute(sql, params).lastrowid
+
+    def update(self, tables, where, vars=None, _test=False, **values):
+        columns = tuple(values.keys())
+        sql = _update_sql(tables, columns)
+        params = [values[name] for name in columns]
+        where_sql, where_params = build_where(where, vars)
+        if where_sql:
+            sql += " WHERE " + where_sql
+        params += where_params
+        if _test:
+            return SqlQuery(sql, params)
+        return self._execute(sql, params).rowcount
+
+    def delete(self, table, where, using=None, vars=None, _test=False):
+        sql = "DELETE FROM %s" % _quote(table)
+        where_sql, params = build_where(where, vars)
+        if where_sql:
+            sql += " WHERE " + where_sql
+        if _test:
+            return SqlQuery(sql, params)
+        return self._execute(sql, params).rowcount
+
+    def transaction(self):
+        return NativeTransaction(self._get_holder())
+
+
+class NativeTransaction:
+    """支持嵌套的事务, 外层使用BEGIN IMMEDIATE, 内层使用SAVEPOINT
+
+    事务都用于写入, 开始时就获取写锁: 延迟事务先读后写(比如update先查询id)时, 如果其他连接正在写入,
+    sqlite为了避免死锁会直接返回 database is locked, 不会按照timeout等待
+    """
+
+    def __init__(self, holder):
+        self.holder = holder
+        self.conn = holder.conn
+        self.depth = len(holder.transactions)
+        if self.depth == 0:
+            self.conn.execute("BEGIN IMMEDIATE")
+        else:
+            self.conn.execute("SAVEPOINT sqlite_rw_sp_%d" % self.depth)
+        holder.transactions.append(self)
+
+    def _is_active(self):
+        return len(self.holder.transactions) > self.depth
+
+    def _finish(self):
+        del self.holder.transactions[self.depth:]
+
+    def commit(self):
+        if not self._is_active():
+            return
+        try:
+            if self.depth == 0:
+                self.conn.execute("COMMIT")
+            else:
+                self.conn.execute("RELEASE SAVEPOINT sqlite_rw_sp_%d" % self.depth)
+        except Exception:
+            self.rollback()
+            raise
+        self._finish()
+
+    def rollback(self):
+        if not self._is_active():
+            return
+        try:
+            if self.depth == 0:
+                if self.conn.in_transaction:
+                    self.conn.execute("ROLLBACK")
+            else:
+                self.conn.execute("ROLLBACK TO SAVEPOINT sqlite_rw_sp_%d" % self.depth)
+                self.conn.execute("RELEASE SAVEPOINT sqlite_rw_sp_%d" % self.depth)
+        finally:
+            self._finish()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type != None:
+            self.rollback()
+        else:
+            self.commit()
@@ -0,0 +1,311 @@
+# encoding=utf-8
+"""binlog的存储格式和分段
+
+编码格式:
+- json: data是完整记录的JSON文本, 触发器模式只能使用这种格式. JSON不能保存二进制,
+  BLOB字段的值记录为只有一个元素的数组 ["<hex>"], 普通字段的值不会是数组, 解码时还原成bytes
+- compact: data是二进制, 由字段列表的编号和按位置排列的字段值组成, 不再重复记录字段名.
+  字段列表保存在写库的 _sqlite_rw_binlog_schema 表中, 编号是内容的哈希, 同样的字段列表在任何文件中编号都相同
+
+两种格式可以混合存在, 读取时按照data的类型(TEXT/BLOB)区分.
+
+分段:
+当前的binlog表写满 segment_size 条记录之后重命名为 <binlog>_seg_<最后的id>, 然后创建新的binlog表继续写入,
+所有读库都应用之后整个分段直接 DROP TABLE, 不再逐条删除, 避免binlog表碎片化
+"""
+
+import hashlib
+import json
+import os
+import struct
+import threading
+
+SCHEMA_TABLE = "_sqlite_rw_binlog_schema"
+
+BINLOG_JSON = "json"
+BINLOG_COMPACT = "compact"
+
+_MAGIC = b"\xb1"
+_DELETE_SCHEMA_ID = 0 # delete_by_ids 的数据是id列表, 没有字段
+
+_TYPE_NULL = 0
+_TYPE_INT = 1
+_TYPE_FLOAT = 2
+_TYPE_TEXT = 3
+_TYPE_BLOB = 4
+
+_DOUBLE = struct.Struct("<d")
+
+
+def _pack_varint(buf, value):
+    while value >= 0x80:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _unpack_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _pack_value(buf, value):
+    if value is None:
+        buf.append(_TYPE_NULL)
+    elif isinstance(value, int):
+        buf.append(_TYPE_INT)
+        # zigzag编码, 小的负数也只占用很少的字节
+        _pack_varint(buf, value * 2 if value >= 0 else -value * 2 - 1)
+    elif isinstance(value, float):
+        buf.append(_TYPE_FLOAT)
+        buf += _DOUBLE.pack(value)
+    elif isinstance(value, str):
+        data = value.encode("utf-8")
+        buf.append(_TYPE_TEXT)
+        _pack_varint(buf, len(data))
+        buf += data
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        data = bytes(value)
+        buf.append(_TYPE_BLOB)
+        _pack_varint(buf, len(data))
+        buf += data
+    else:
+        raise TypeError("unsupported binlog value type: %s" % type(value))
+
+
+def _unpack_value(data, pos):
+    value_type = data[pos]
+    pos += 1
+    if value_type == _TYPE_NULL:
+        return None, pos
+    if value_type == _TYPE_INT:
+        value, pos = _unpack_varint(data, pos)
+        return (value >> 1) if value & 1 == 0 else -((value + 1) >> 1), pos
+    if value_type == _TYPE_FLOAT:
+        return _DOUBLE.unpack_from(data, pos)[0], pos + 8
+    length, pos = _unpack_varint(data, pos)
+    value = data[pos:pos + length]
+    if value_type == _TYPE_TEXT:
+        return value.decode("utf-8"), pos + length
+    return value, pos + length
+
+
+def get_schema_id(tablename, columns):
+    """字段列表的编号, 取内容哈希的前7个字节, 保证是正的64位整数"""
+    digest = hashlib.sha1(("%s\0%s" % (tablename, "\0".join(columns))).encode("utf-8")).digest()
+    return int.from_bytes(digest[:7], "big") + 1
+
+
+def init_schema_table(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS `%s` (id integer primary key, table_name text, columns text)" % SCHEMA_TABLE)
+
+
+class BinlogSchemaRegistry:
+    """compact格式的字段列表缓存"""
+
+    _lock = threading.Lock()
+    _schemas = dict() # schema_id -> (table_name, columns), 编号由内容决定, 所有文件共享
+    _committed = dict() # path -> set(schema_id), 已经提交到写库的编号, 写入时不用重复登记
+
+    @classmethod
+    def load(cls, path, conn):
+        """加载写库中已经登记的字段列表, 创建数据库句柄时调用"""
+        committed = set()
+        for schema_id, tablename, columns in conn.execute("SELECT id, table_name, columns FROM `%s`" % SCHEMA_TABLE):
+            committed.add(schema_id)
+            cls._schemas[schema_id] = (tablename, tuple(json.loads(columns)))
+        with cls._lock:
+            cls._committed[os.path.abspath(path)] = committed
+
+    @classmethod
+    def register(cls, path, conn, tablename, columns):
+        """登记字段列表并返回编号, 在写入binlog的事务中调用
+        事务可能回滚, 所以只有从已提交的数据中读到之后才不再登记
+        """
+        schema_id = get_schema_id(tablename, columns)
+        if schema_id in cls._committed.get(os.path.abspath(path), ()):
+            return schema_id
+        conn.execute("INSERT OR IGNORE INTO `%s` (id, table_name, columns) VALUES (?, ?, ?)" % SCHEMA_TABLE,
+                     (schema_id, tablename, json.dumps(columns)))
+        cls._schemas[schema_id] = (tablename, tuple(columns))
+        return schema_id
+
+    @classmethod
+    def get(cls, conn, schema_id, path=None):
+        """conn是写库的连接, path不为空时表示读到的是已经提交的binlog"""
+        schema = cls._schemas.get(schema_id)
+        if schema == None:
+            row = conn.execute("SELECT table_name, columns FROM `%s` WHERE id = ?" % SCHEMA_TABLE,
+                               (schema_id,)).fetchone()
+            if row == None:
+                raise KeyError("binlog schema not found: %s" % schema_id)
+            schema = (row[0], tuple(json.loads(row[1])))
+            cls._schemas[schema_id] = schema
+        if path != None:
+            with cls._lock:
+                cls._committed.setdefault(os.path.abspath(path), set()).add(schema_id)
+        return schema
+
+
+def encode_json(data):
+    """把一条binlog编码成json格式"""
+    if isinstance(data, dict):
+        data = dict((name, [bytes(value).hex()] if isinstance(value, (bytes, bytearray, memoryview)) else value)
+                    for name, value in data.items())
+    return json.dumps(data)
+
+
+def decode_json(text):
+    data = json.loads(text)
+    if isinstance(data, dict):
+        for name, value in data.items():
+            if isinstance(value, list):
+                data[name] = bytes.fromhex(value[0])
+    return data
+
+
+def encode(path, conn, tablename, op_type, data):
+    """把一条binlog编码成compact格式"""
+    buf = bytearray(_MAGIC)
+    if op_type == "delete_by_ids":
+        _pack_varint(buf, _DELETE_SCHEMA_ID)
+        values = data
+    else:
+        columns = tuple(data.keys())
+        _pack_varint(buf, BinlogSchemaRegistry.register(path, conn, tablename, columns))
+        values = [data[name] for name in columns]
+    for value in values:
+        _pack_value(buf, value)
+    return bytes(buf)
+
+
+def decode(conn, data, path=None):
+    """解码binlog的data字段, 返回dict(增改)或者id列表(删除)"""
+    if not isinstance(data, bytes):
+        return decode_json(data)
+    schema_id, pos = _unpack_varint(data, 1)
+    values = []
+    while pos < len(data):
+        value, pos = _unpack_value(data, pos)
+        values.append(value)
+    if schema_id == _DELETE_SCHEMA_ID:
+        return values
+    tablename, columns = BinlogSchemaRegistry.get(conn, schema_id, path)
+    return dict(zip(columns, values))
+
+
+def get_segment_name(binlog_table, last_id):
+    return "%s_seg_%012d" % (binlog_table, last_id)
+
+
+def list_segments(conn, binlog_table="binlog"):
+    """已经封存的分段 [(name, last_id)], 按照id的顺序排列"""
+    prefix = binlog_table + "_seg_"
+    rows = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND substr(name, 1, ?) = ?",
+                        (len(prefix), prefix)).fetchall()
+    return sorted((name, int(name[len(prefix):])) for name, in rows)
+
+
+def read_rows(conn, binlog_table, after_id, limit, end_id=None):
+    """按照id顺序读取 (after_id, end_id] 之间的binlog [(id, table_name, op_type, data)]
+    依次读取封存的分段和当前的binlog表, 在一个读事务中完成, 不会因为并发的分段切换漏掉记录
+    """
+    own_transaction = not conn.in_transaction
+    if own_transaction:
+        conn.execute("BEGIN")
+    try:
+        tables = [name for name, last_id in list_segments(conn, binlog_table) if last_id > after_id]
+        tables.append(binlog_table)
+        rows = []
+        for name in tables:
+            sql = "SELECT id, table_name, op_type, data FROM `%s` WHERE id > ?" % name
+            params = [after_id]
+            if end_id != None:
+                sql += " AND id <= ?"
+                params.append(end_id)
+            sql += " ORDER BY id LIMIT ?"
+            params.append(limit - len(rows))
+            rows += conn.execute(sql, params).fetchall()
+            if len(rows) >= limit:
+                break
+        return rows
+    finally:
+        if own_transaction:
+            conn.execute("COMMIT")
+
+
+def get_last_id(conn, binlog_table="binlog"):
+    """最新的binlog位置, 当前的binlog表为空(比如刚切换分段)时使用自增序号"""
+    last_id = conn.execute("SELECT MAX(id) FROM `%s`" % binlog_table).fetchone()[0]
+    if last_id != None:
+        return last_id
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (binlog_table,)).fetchone()
+    if row != None:
+        return row[0]
+    segments = list_segments(conn, binlog_table)
+    if len(segments) > 0:
+        return segments[-1][1]
+    return None
+
+
+def get_first_id(conn, binlog_table="binlog"):
+    """最早的还没有被清理的binlog位置"""
+    for name, last_id in list_segments(conn, binlog_table):
+        first_id = conn.execute("SELECT MIN(id) FROM `%s`" % name).fetchone()[0]
+        if first_id != None:
+            return first_id
+    return conn.execute("SELECT MIN(id) FROM `%s`" % binlog_table).fetchone()[0]
+
+
+def get_active_size(conn, binlog_table="binlog"):
+    """当前binlog表中的记录数(按照id范围估算)"""
+    first_id, last_id = conn.execute("SELECT MIN(id), MAX(id) FROM `%s`" % binlog_table).fetchone()
+    if last_id == None:
+        return 0
+    return last_id - first_id + 1
+
+
+def rotate(conn, binlog_table="binlog"):
+    """封存当前的binlog表, 创建新的binlog表并延续自增序号
+    conn需要是 isolation_level=None 的连接, 调用方需要持有写库的独占锁
+    """
+    create_sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+                              (binlog_table,)).fetchone()[0]
+    # 触发器中引用的binlog表名保持不变, 继续写入新的binlog表
+    conn.execute("PRAGMA legacy_alter_table = ON")
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            last_id = conn.execute("SELECT MAX(id) FROM `%s`" % binlog_table).fetchone()[0]
+            if last_id == None:
+                conn.execute("ROLLBACK")
+                return None
+            segment = get_segment_name(binlog_table, last_id)
+            conn.execute("ALTER TABLE `%s` RENAME TO `%s`" % (binlog_table, segment))
+            conn.execute(create_sql)
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (binlog_table, last_id))
+            conn.execute("COMMIT")
+            return segment
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.execute("PRAGMA legacy_alter_table = OFF")
+
+
+def drop_segments(conn, binlog_table, applied_id):
+    """删除所有记录都已经被应用的分段, 返回删除的分段名称"""
+    dropped = []
+    for name, last_id in list_segments(conn, binlog_table):
+        if last_id > applied_id:
+            break
+        conn.execute("DROP TABLE IF EXISTS `%s`" % name)
+        dropped.append(name)
+    return dropped
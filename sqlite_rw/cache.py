@@ -0,0 +1,131 @@
+# encoding=utf-8
+"""主键查询的读缓存
+
+缓存由select_first(where=dict(id=...))填充, binlog同步到读库之后按照(table_name, id)精确失效.
+binlog由其他进程同步时, 当前进程按照读库的同步位置重新读取binlog失效, 参考 BinlogReplicator.sync_row_cache
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class RowCache:
+    """LRU + TTL 缓存"""
+
+    def __init__(self, max_size=10000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl # 过期时间(秒), None表示只依赖binlog失效
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.generation = 0 # 每次失效加1, 用于丢弃失效之前读到的旧数据
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """返回缓存的值, 没有命中返回_MISSING"""
+        with self._lock:
+            item = self.data.get(key)
+            if item != None:
+                value, expire_time = item
+                if expire_time == None or expire_time > time.time():
+                    self.data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.data[key]
+            self.misses += 1
+            return _MISSING
+
+    def put(self, key, value, generation):
+        """generation是读取数据之前的版本, 读取期间发生过失效就不再写入缓存"""
+        with self._lock:
+            if generation != self.generation:
+                return
+            expire_time = None
+            if self.ttl != None:
+                expire_time = time.time() + self.ttl
+            self.data[key] = (value, expire_time)
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last = False)
+
+    def invalidate(self, keys):
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                if self.data.pop(key, None) != None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self.data.clear()
+
+    def get_stats(self):
+        return dict(size = len(self.data), hits = self.hits, misses = self.misses,
+                    invalidations = self.invalidations)
+
+
+class RowCacheRegistry:
+    """按照(写库路径, 表名)注册缓存, 同一个进程内共享"""
+
+    MISSING = _MISSING
+
+    _lock = threading.Lock()
+    _caches = dict() # dbpath -> {tablename: RowCache}
+    _synced_ids = dict() # dbpath -> 缓存已经按照binlog失效到的位置
+
+    @classmethod
+    def get(cls, dbpath, tablename, max_size=10000, ttl=None):
+        key = os.path.abspath(dbpath)
+        with cls._lock:
+            tables = cls._caches.setdefault(key, dict())
+            cache = tables.get(tablename)
+            if cache == None:
+                cache = RowCache(max_size, ttl)
+                tables[tablename] = cache
+            return cache
+
+    @classmethod
+    def has_caches(cls, dbpath):
+        return len(cls._caches.get(os.path.abspath(dbpath), ())) > 0
+
+    @classmethod
+    def get_synced_id(cls, dbpath):
+        return cls._synced_ids.get(os.path.abspath(dbpath))
+
+    @classmethod
+    def set_synced_id(cls, dbpath, binlog_id):
+        key = os.path.abspath(dbpath)
+        with cls._lock:
+            cls._synced_ids[key] = max(cls._synced_ids.get(key) or 0, binlog_id)
+
+    @classmethod
+    def invalidate_records(cls, dbpath, records):
+        """按照binlog记录失效缓存"""
+        tables = cls._caches.get(os.path.abspath(dbpath))
+        if not tables:
+            return
+        keys_by_table = dict()
+        for record in records:
+            if record.table_name not in tables:
+                continue
+            keys = keys_by_table.setdefault(record.table_name, [])
+            if record.op_type == "delete_by_ids":
+                keys.extend(record.data)
+            else:
+                keys.append(record.data.get("id"))
+        for tablename, keys in keys_by_table.items():
+            tables[tablename].invalidate(keys)
+
+    @classmethod
+    def clear(cls, dbpath):
+        tables = cls._caches.get(os.path.abspath(dbpath))
+        if not tables:
+            return
+        for cache in list(tables.values()):
+            cache.clear()
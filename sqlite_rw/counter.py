@@ -0,0 +1,114 @@
+# encoding=utf-8
+"""读库中增量维护的计数
+
+每个表的总数以及注册过的等值过滤条件(比如 where=dict(status=...))的计数保存在读库的计数表中,
+binlog同步的时候根据每条记录变化前后的数据增量更新, count() 只需要查一行数据
+"""
+
+COUNTER_TABLE = "_sqlite_rw_counter"
+COUNTER_DEF_TABLE = "_sqlite_rw_counter_def"
+TOTAL_COLUMN = "" # 总数使用空的字段名
+
+
+def init_tables(conn):
+    # value字段不声明类型, 保留原始数据的类型
+    conn.execute("CREATE TABLE IF NOT EXISTS `%s` (table_name text, column_name text, value, amount integer)" % COUNTER_TABLE)
+    conn.execute("CREATE INDEX IF NOT EXISTS `idx_%s` ON `%s` (table_name, column_name, value)" % (COUNTER_TABLE, COUNTER_TABLE))
+    conn.execute("CREATE TABLE IF NOT EXISTS `%s` (table_name text, column_name text, PRIMARY KEY (table_name, column_name))" % COUNTER_DEF_TABLE)
+
+
+def load_defs(conn):
+    """返回 {table_name: [column_name]}, 总数的字段名为空字符串"""
+    defs = dict()
+    for table_name, column_name in conn.execute("SELECT table_name, column_name FROM `%s`" % COUNTER_DEF_TABLE):
+        defs.setdefault(table_name, []).append(column_name)
+    return defs
+
+
+def register(conn, tablename, columns):
+    """注册计数并用当前数据初始化, 已经注册过的字段跳过, 调用方需要暂停binlog同步"""
+    registered = set(load_defs(conn).get(tablename, []))
+    for column in [TOTAL_COLUMN] + list(columns):
+        if column in registered:
+            continue
+        registered.add(column)
+        if column == TOTAL_COLUMN:
+            sql = "SELECT '' AS value, COUNT(1) AS amount FROM `%s`" % tablename
+        else:
+            sql = "SELECT `%s` AS value, COUNT(1) AS amount FROM `%s` GROUP BY `%s`" % (column, tablename, column)
+        conn.execute("DELETE FROM `%s` WHERE table_name = ? AND column_name = ?" % COUNTER_TABLE, (tablename, column))
+        for value, amount in conn.execute(sql).fetchall():
+            conn.execute("INSERT INTO `%s` (table_name, column_name, value, amount) VALUES (?, ?, ?, ?)" % COUNTER_TABLE,
+                         (tablename, column, value, amount))
+        conn.execute("INSERT INTO `%s` (table_name, column_name) VALUES (?, ?)" % COUNTER_DEF_TABLE, (tablename, column))
+
+
+def get_count(conn, tablename, column=TOTAL_COLUMN, value=""):
+    row = conn.execute("SELECT amount FROM `%s` WHERE table_name = ? AND column_name = ? AND value IS ?" % COUNTER_TABLE,
+                       (tablename, column, value)).fetchone()
+    if row == None:
+        return 0
+    return row[0]
+
+
+def _load_rows(conn, tablename, columns, ids):
+    result = dict()
+    names = ["id"] + [column for column in columns if column != TOTAL_COLUMN]
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i+500]
+        sql = "SELECT %s FROM `%s` WHERE id IN (%s)" % (",".join("`%s`" % name for name in names),
+                                                         tablename, ",".join("?" for x in chunk))
+        for row in conn.execute(sql, chunk):
+            result[row[0]] = dict(zip(names, row))
+    return result
+
+
+def compute_deltas(conn, records, defs):
+    """在应用records之前调用, 返回 {(table_name, column_name, value): delta}"""
+    ids_by_table = dict()
+    for record in records:
+        if record.table_name not in defs:
+            continue
+        ids = ids_by_table.setdefault(record.table_name, [])
+        if record.op_type == "delete_by_ids":
+            ids.extend(record.data)
+        else:
+            ids.append(record.data.get("id"))
+
+    deltas = dict()
+    for tablename, ids in ids_by_table.items():
+        columns = defs[tablename]
+        old_rows = _load_rows(conn, tablename, columns, list(set(ids)))
+        new_rows = dict(old_rows)
+        for record in records:
+            if record.table_name != tablename:
+                continue
+            if record.op_type == "delete_by_ids":
+                for data_id in record.data:
+                    new_rows.pop(data_id, None)
+            else:
+                new_rows[record.data.get("id")] = record.data
+
+        for data_id in set(ids):
+            for rows, sign in ((old_rows, -1), (new_rows, 1)):
+                row = rows.get(data_id)
+                if row == None:
+                    continue
+                for column in columns:
+                    if column == TOTAL_COLUMN:
+                        key = (tablename, column, "")
+                    else:
+                        key = (tablename, column, row.get(column))
+                    deltas[key] = deltas.get(key, 0) + sign
+    return deltas
+
+
+def apply_deltas(conn, deltas):
+    for (tablename, column, value), delta in deltas.items():
+        if delta == 0:
+            continue
+        cursor = conn.execute("UPDATE `%s` SET amount = amount + ? WHERE table_name = ? AND column_name = ? AND value IS ?" % COUNTER_TABLE,
+                              (delta, tablename, column, value))
+        if cursor.rowcount == 0:
+            conn.execute("INSERT INTO `%s` (table_name, column_name, value, amount) VALUES (?, ?, ?, ?)" % COUNTER_TABLE,
+                         (tablename, column, value, delta))
@@ -0,0 +1,75 @@
+# encoding=utf-8
+"""基于文件锁的leader选举
+
+同一个写库只有持有锁文件的进程(leader)执行binlog同步, 进程退出时操作系统自动释放文件锁
+"""
+
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+
+class FileLeaderLock:
+    """进程级别的文件锁, 同一个进程内按照锁文件路径共享"""
+
+    _lock = threading.Lock()
+    _instances = dict()
+
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self.fp = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls, dbpath):
+        lock_path = os.path.abspath(dbpath) + "-replicator.lock"
+        with cls._lock:
+            instance = cls._instances.get(lock_path)
+            if instance == None:
+                instance = FileLeaderLock(lock_path)
+                cls._instances[lock_path] = instance
+            return instance
+
+    def is_leader(self):
+        return self.fp != None
+
+    def try_acquire(self):
+        """尝试成为leader, 不阻塞"""
+        with self._lock:
+            if self.fp != None:
+                return True
+            fp = open(self.lock_path, "a+")
+            try:
+                if fcntl != None:
+                    fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                elif msvcrt != None:
+                    fp.seek(0)
+                    msvcrt.locking(fp.fileno(), msvcrt.LK_NBLCK, 1)
+            except (IOError, OSError):
+                fp.close()
+                return False
+            self.fp = fp
+            return True
+
+    def release(self):
+        with self._lock:
+            if self.fp == None:
+                return
+            try:
+                if fcntl != None:
+                    fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
+                elif msvcrt != None:
+                    self.fp.seek(0)
+                    msvcrt.locking(self.fp.fileno(), msvcrt.LK_UNLCK, 1)
+            finally:
+                self.fp.close()
+                self.fp = None
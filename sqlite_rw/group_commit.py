@@ -0,0 +1,116 @@
+# encoding=utf-8
+"""组提交
+
+并发的单行写入先进入队列, 第一个等待的调用方成为leader, 最多等待max_delay秒或者凑够max_batch个操作,
+然后在一个事务中依次执行(每个操作一个savepoint), 只提交一次; 其他调用方等待leader执行完成后拿到各自的结果或异常
+"""
+
+import threading
+import time
+
+from . import replication
+from .lock import LockManager
+from .metrics import MetricsRegistry, SIZE_BUCKETS
+
+
+class _WriteOp:
+
+    def __init__(self, tablename, func, args, kw):
+        self.tablename = tablename
+        self.func = func
+        self.args = args
+        self.kw = kw
+        self.done = False
+        self.result = None
+        self.error = None
+
+    def get(self):
+        if self.error != None:
+            raise self.error
+        return self.result
+
+
+class GroupCommitter:
+    """一个写库文件的组提交队列"""
+
+    max_delay = 0.002 # leader等待更多写入的最长时间(秒)
+    max_batch = 64 # 一个事务最多包含的写操作数
+
+    def __init__(self, dbpath, db, max_delay=None, max_batch=None):
+        self.dbpath = dbpath
+        self.db = db
+        if max_delay != None:
+            self.max_delay = max_delay
+        if max_batch != None:
+            self.max_batch = max_batch
+        self.pending = []
+        self.cond = threading.Condition()
+        self.leader_active = False
+        self._local = threading.local()
+        self.batch_count = 0
+        self.op_count = 0
+
+    def in_batch(self):
+        """当前线程是否正在执行批次中的写操作"""
+        return getattr(self._local, "running", False)
+
+    def submit(self, tablename, func, *args, **kw):
+        """提交一个写表tablename的操作, 阻塞直到所在的批次提交, 返回func的结果或者抛出func的异常"""
+        op = _WriteOp(tablename, func, args, kw)
+        with self.cond:
+            self.pending.append(op)
+            if len(self.pending) >= self.max_batch:
+                self.cond.notify_all()
+        while True:
+            with self.cond:
+                while not op.done and self.leader_active:
+                    self.cond.wait()
+                if op.done:
+                    return op.get()
+                # 成为leader, 等待更多的写入
+                self.leader_active = True
+                deadline = time.time() + self.max_delay
+                while len(self.pending) < self.max_batch:
+                    wait_time = deadline - time.time()
+                    if wait_time <= 0:
+                        break
+                    self.cond.wait(wait_time)
+                batch = self.pending[:self.max_batch]
+                del self.pending[:self.max_batch]
+            try:
+                self._run_batch(batch)
+            finally:
+                with self.cond:
+                    self.leader_active = False
+                    self.cond.notify_all()
+
+    def _run_batch(self, batch):
+        self._local.running = True
+        try:
+            # 只锁批次中涉及的表, 同一个文件的其他表和binlog同步不受影响
+            with LockManager.get_lock(self.dbpath, sorted(set(op.tablename for op in batch))):
+                with replication.SafeTransaction(self.db):
+                    for op in batch:
+                        try:
+                            with self.db.transaction():
+                                op.result = op.func(*op.args, **op.kw)
+                        except Exception as e:
+                            # 只回滚这个操作的savepoint
+                            op.error = e
+        except Exception as e:
+            # 提交失败, 整个批次都失败了
+            for op in batch:
+                if op.error == None:
+                    op.result = None
+                    op.error = e
+        finally:
+            self._local.running = False
+        self.batch_count += 1
+        self.op_count += len(batch)
+        MetricsRegistry.observe("sqlite_rw_group_commit_size", len(batch), SIZE_BUCKETS, db = self.dbpath)
+        for op in batch:
+            op.done = True
+
+    def get_stats(self):
+        return dict(batch_count = self.batch_count, op_count = self.op_count,
+                    avg_batch_size = self.op_count / max(self.batch_count, 1))
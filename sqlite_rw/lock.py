@@ -0,0 +1,213 @@
+# encoding=utf-8
+"""锁管理
+
+每个数据库文件一把读写锁:
+- DML和binlog同步持有数据库的读锁, 再持有表锁(或者表名哈希的分段锁), 不同的表/文件可以并行
+- DDL、重建读库等需要独占整个数据库的操作持有数据库的写锁
+"""
+
+import os
+import threading
+import time
+import zlib
+
+
+class LockStat:
+
+    def __init__(self):
+        self.acquire_count = 0
+        self.wait_count = 0 # 需要等待的次数
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def add(self, wait_time):
+        self.acquire_count += 1
+        if wait_time > 0:
+            self.wait_count += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def to_dict(self):
+        return dict(acquire_count = self.acquire_count,
+                    wait_count = self.wait_count,
+                    total_wait_time = self.total_wait_time,
+                    max_wait_time = self.max_wait_time)
+
+
+class ReadWriteLock:
+    """可重入的读写锁, 写锁优先
+
+    - 持有写锁的线程可以再次获取读锁和写锁
+    - 持有读锁的线程可以再次获取读锁, 但是不能升级为写锁
+    """
+
+    def __init__(self, name=""):
+        self.name = name
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = dict() # thread_id -> count
+        self.writer = None
+        self.write_count = 0
+        self.waiting_writers = 0
+        self.stat = LockStat()
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        start_time = None
+        with self.cond:
+            while True:
+                if self.writer == me or me in self.readers:
+                    break
+                if self.writer == None and self.waiting_writers == 0:
+                    break
+                if start_time == None:
+                    start_time = time.time()
+                self.cond.wait()
+            self.readers[me] = self.readers.get(me, 0) + 1
+            self.stat.add(0 if start_time == None else time.time() - start_time)
+
+    def release_read(self):
+        me = threading.get_ident()
+        with self.cond:
+            count = self.readers[me] - 1
+            if count == 0:
+                del self.readers[me]
+                self.cond.notify_all()
+            else:
+                self.readers[me] = count
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        start_time = None
+        with self.cond:
+            if self.writer == me:
+                self.write_count += 1
+                self.stat.add(0)
+                return
+            assert me not in self.readers, "can not upgrade read lock to write lock"
+            self.waiting_writers += 1
+            try:
+                while self.writer != None or len(self.readers) > 0:
+                    if start_time == None:
+                        start_time = time.time()
+                    self.cond.wait()
+            finally:
+                self.waiting_writers -= 1
+            self.writer = me
+            self.write_count = 1
+            self.stat.add(0 if start_time == None else time.time() - start_time)
+
+    def release_write(self):
+        with self.cond:
+            assert self.writer == threading.get_ident(), "write lock is not owned"
+            self.write_count -= 1
+            if self.write_count == 0:
+                self.writer = None
+                self.cond.notify_all()
+
+    def is_read_locked(self):
+        """当前线程是否只持有读锁(持有读锁时不能再获取写锁)"""
+        me = threading.get_ident()
+        with self.cond:
+            return me in self.readers and self.writer != me
+
+    def read_lock(self):
+        return _LockGuard([(self.acquire_read, self.release_read)])
+
+    def write_lock(self):
+        return _LockGuard([(self.acquire_write, self.release_write)])
+
+
+class _LockGuard:
+    """按顺序获取多把锁, 逆序释放, 兼容 RLock 的 acquire/release 接口"""
+
+    def __init__(self, steps):
+        self.steps = steps
+
+    def acquire(self):
+        for acquire, release in self.steps:
+            acquire()
+        return True
+
+    def release(self):
+        for acquire, release in reversed(self.steps):
+            release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+
+
+class LockManager:
+
+    stripes = None # None表示每个表一把锁; 设置为整数时表名哈希到固定数量的分段, 限制锁的数量
+
+    _lock = threading.Lock()
+    _db_locks = dict()
+    _stripe_locks = dict()
+
+    @classmethod
+    def _get_key(cls, dbpath):
+        return os.path.abspath(dbpath)
+
+    @classmethod
+    def get_db_lock(cls, dbpath=""):
+        key = cls._get_key(dbpath)
+        with cls._lock:
+            lock = cls._db_locks.get(key)
+            if lock == None:
+                lock = ReadWriteLock(key)
+                cls._db_locks[key] = lock
+            return lock
+
+    @classmethod
+    def get_stripe_lock(cls, dbpath, tablename):
+        key = cls._get_key(dbpath)
+        if cls.stripes == None:
+            stripe = tablename
+        else:
+            # 使用稳定的哈希, 不受进程的hash随机化影响
+            stripe = zlib.crc32(tablename.encode("utf-8")) % max(cls.stripes, 1)
+        with cls._lock:
+            lock = cls._stripe_locks.get((key, stripe))
+            if lock == None:
+                lock = ReadWriteLock("%s#%s" % (key, stripe))
+                cls._stripe_locks[(key, stripe)] = lock
+            return lock
+
+    @classmethod
+    def get_lock(cls, dbpath="", tablename=None):
+        """获取写锁
+        指定tablename时持有数据库读锁+表分段写锁, 否则独占整个数据库
+        tablename 也可以是表名列表(比如组提交的批次), 表锁按照名称排序获取, 避免死锁
+        """
+        db_lock = cls.get_db_lock(dbpath)
+        if tablename == None:
+            return db_lock.write_lock()
+        if isinstance(tablename, (list, tuple, set)):
+            tablenames = tablename
+        else:
+            tablenames = [tablename]
+        stripe_locks = dict()
+        for name in tablenames:
+            lock = cls.get_stripe_lock(dbpath, name)
+            stripe_locks[lock.name] = lock
+        steps = [(db_lock.acquire_read, db_lock.release_read)]
+        for name in sorted(stripe_locks):
+            steps.append((stripe_locks[name].acquire_write, stripe_locks[name].release_write))
+        return _LockGuard(steps)
+
+    @classmethod
+    def get_read_lock(cls, dbpath=""):
+        return cls.get_db_lock(dbpath).read_lock()
+
+    @classmethod
+    def get_stats(cls):
+        """锁等待的统计信息"""
+        result = dict()
+        with cls._lock:
+            locks = list(cls._db_locks.values()) + list(cls._stripe_locks.values())
+        for lock in locks:
+            result[lock.name] = lock.stat.to_dict()
+        return result
@@ -0,0 +1,206 @@
+# encoding=utf-8
+"""运行指标
+
+- Counter: 累加的计数, 比如队列溢出的次数
+- Gauge: 当前值, 比如binlog积压、读库延迟、队列长度
+- Histogram: 分布, 比如每次同步的记录数、每种操作的耗时
+
+Gauge一般由collector在collect()时计算, 热路径上只记录Counter和Histogram;
+通过add_hook注册回调可以把每次记录的数据导出到监控系统
+"""
+
+import bisect
+import logging
+import threading
+import time
+from functools import wraps
+
+# 耗时的分桶(秒)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# 批量大小的分桶
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class Counter:
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def to_dict(self):
+        return dict(value = self.value)
+
+
+class Gauge:
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def to_dict(self):
+        return dict(value = self.value)
+
+
+class Histogram:
+    """固定分桶的直方图, 百分位按照分桶的上界估算"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1) # 最后一个桶是 +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.bucket_counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0
+        target = self.count * p / 100.0
+        total = 0
+        for index, amount in enumerate(self.bucket_counts):
+            total += amount
+            if total >= target:
+                if index < len(self.buckets):
+                    return min(self.buckets[index], self.max)
+                return self.max
+        return self.max
+
+    def to_dict(self):
+        return dict(count = self.count, sum = self.sum, max = self.max,
+                    p50 = self.percentile(50), p99 = self.percentile(99),
+                    buckets = dict(zip(self.buckets + ("+Inf",), self.bucket_counts)))
+
+
+def _make_key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+class MetricsRegistry:
+    """进程内全局的指标注册表"""
+
+    enabled = True # 关闭之后热路径上不再记录指标
+
+    _lock = threading.Lock()
+    _metrics = dict() # (name, labels) -> metric
+    _collectors = dict() # key -> func, collect()时调用, 用于更新Gauge
+    _hooks = []
+
+    @classmethod
+    def _get_metric(cls, metric_class, name, labels, *args):
+        key = _make_key(name, labels)
+        metric = cls._metrics.get(key)
+        if metric == None:
+            with cls._lock:
+                metric = cls._metrics.get(key)
+                if metric == None:
+                    metric = metric_class(*args)
+                    cls._metrics[key] = metric
+        return metric
+
+    @classmethod
+    def counter(cls, name, **labels):
+        return cls._get_metric(Counter, name, labels)
+
+    @classmethod
+    def gauge(cls, name, **labels):
+        return cls._get_metric(Gauge, name, labels)
+
+    @classmethod
+    def histogram(cls, name, buckets=LATENCY_BUCKETS, **labels):
+        return cls._get_metric(Histogram, name, labels, buckets)
+
+    @classmethod
+    def inc(cls, name, amount=1, **labels):
+        if not cls.enabled:
+            return
+        cls.counter(name, **labels).inc(amount)
+        cls._call_hooks(name, amount, labels)
+
+    @classmethod
+    def observe(cls, name, value, buckets=LATENCY_BUCKETS, **labels):
+        if not cls.enabled:
+            return
+        cls.histogram(name, buckets, **labels).observe(value)
+        cls._call_hooks(name, value, labels)
+
+    @classmethod
+    def set_gauge(cls, name, value, **labels):
+        cls.gauge(name, **labels).set(value)
+        cls._call_hooks(name, value, labels)
+
+    @classmethod
+    def add_hook(cls, func):
+        """注册回调 func(name, value, labels), 每次记录指标时调用"""
+        with cls._lock:
+            cls._hooks = cls._hooks + [func]
+
+    @classmethod
+    def remove_hook(cls, func):
+        with cls._lock:
+            cls._hooks = [hook for hook in cls._hooks if hook != func]
+
+    @classmethod
+    def _call_hooks(cls, name, value, labels):
+        for hook in cls._hooks:
+            try:
+                hook(name, value, labels)
+            except Exception as e:
+                logging.error("metrics hook failed, name:%s, err:%s", name, e)
+
+    @classmethod
+    def register_collector(cls, key, func):
+        """注册collector, 相同的key只保留最后一个"""
+        with cls._lock:
+            cls._collectors[key] = func
+
+    @classmethod
+    def collect(cls):
+        """执行所有的collector, 返回 {name: [dict(labels = {...}, ...)]}"""
+        for key, func in list(cls._collectors.items()):
+            try:
+                func()
+            except Exception as e:
+                logging.error("metrics collector failed, key:%s, err:%s", key, e)
+        result = dict()
+        for (name, labels), metric in list(cls._metrics.items()):
+            item = metric.to_dict()
+            item["labels"] = dict(labels)
+            result.setdefault(name, []).append(item)
+        return result
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._metrics = dict()
+
+
+def timed(op_type):
+    """记录SqliteTable方法的耗时, 指标为 sqlite_rw_op_seconds{table, op}"""
+    def deco(func):
+        @wraps(func)
+        def handle(self, *args, **kw):
+            if not MetricsRegistry.enabled:
+                return func(self, *args, **kw)
+            start_time = time.time()
+            try:
+                return func(self, *args, **kw)
+            finally:
+                MetricsRegistry.observe("sqlite_rw_op_seconds", time.time() - start_time,
+                                        table = self.tablename, op = op_type)
+        return handle
+    return deco
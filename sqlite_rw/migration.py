@@ -0,0 +1,259 @@
+# encoding=utf-8
+"""在线迁移
+
+按照主键分块把旧表复制到影子表, 复制期间的写入通过binlog重放到影子表, 最后在一个短事务中
+重放剩余的binlog并用影子表替换旧表. 写库和读库依次迁移:
+
+- 写库: 迁移开始时的binlog最大位置作为起点, 最后持有写库的锁完成切换
+- 读库: 读库已经应用的binlog位置作为起点, 切换时暂停这个读库的同步, 重放到读库当前的位置
+
+迁移期间的binlog会被保留(binlog pin), 不会被trim_binlog清理.
+需要表有id主键, 并且所有的写入都记录了binlog(SqliteTable或者触发器模式)
+"""
+
+import logging
+import time
+
+from . import replication
+from . import counter
+from . import binlog
+from .lock import LockManager
+from .cache import RowCacheRegistry
+from .backend import connect
+
+logger = logging.getLogger("sqlite-rw")
+
+SHADOW_PREFIX = "_sqlite_rw_new_"
+
+
+def _quote(name):
+    return "`%s`" % name
+
+
+def _connect(path, timeout):
+    # 事务由迁移显式控制
+    return connect(path, timeout = timeout, isolation_level = None)
+
+
+class OnlineMigration:
+    """重建一张表, 只保留指定的字段"""
+
+    chunk_size = 1000 # 每次复制的记录数
+    chunk_sleep = 0 # 每次复制之后的休眠时间(秒), 给其他写入让出数据库
+    replay_batch_size = 1000 # 每次重放的binlog记录数
+    cutover_threshold = 100 # 剩余的binlog少于这个数量时开始切换
+
+    def __init__(self, dbpath, tablename, read_db_path="", binlog_table="binlog", timeout=5,
+                 chunk_size=None, chunk_sleep=None):
+        from . import get_read_db_paths
+        self.dbpath = dbpath
+        self.tablename = tablename
+        self.read_db_paths = get_read_db_paths(read_db_path)
+        self.binlog_table = binlog_table
+        self.timeout = timeout
+        self.shadow_table = SHADOW_PREFIX + tablename
+        if chunk_size != None:
+            self.chunk_size = chunk_size
+        if chunk_sleep != None:
+            self.chunk_sleep = chunk_sleep
+
+    def drop_columns(self, names):
+        """删除字段, 字段不存在的库会跳过"""
+        conn = _connect(self.dbpath, self.timeout)
+        try:
+            columns = replication.get_table_columns(conn, self.tablename)
+        finally:
+            conn.close()
+        return self.migrate([name for name in columns if name not in names])
+
+    def migrate(self, keep_columns):
+        """先迁移写库, 再依次迁移读库"""
+        assert "id" in keep_columns, "online migration requires the id column"
+        binlog_conn = _connect(self.dbpath, self.timeout)
+        try:
+            self._migrate_write_db(binlog_conn, keep_columns)
+            for name, path in self.read_db_paths.items():
+                self._migrate_read_db(binlog_conn, name, path, keep_columns)
+        finally:
+            binlog_conn.close()
+        RowCacheRegistry.clear(self.dbpath)
+
+    def _get_last_binlog_id(self, binlog_conn):
+        return binlog.get_last_id(binlog_conn, self.binlog_table) or 0
+
+    def _migrate_write_db(self, conn, keep_columns):
+        columns = replication.get_table_columns(conn, self.tablename)
+        if columns == keep_columns:
+            return
+        pin_name = "migrate:%s" % self.tablename
+        with LockManager.get_lock(self.dbpath, self.tablename):
+            conn.execute("BEGIN IMMEDIATE")
+            start_id = self._get_last_binlog_id(conn)
+            replication.set_binlog_pin(conn, pin_name, start_id)
+            conn.execute("COMMIT")
+
+        def lock():
+            return LockManager.get_lock(self.dbpath)
+
+        def get_end_id():
+            return self._get_last_binlog_id(conn)
+
+        try:
+            self._rebuild(conn, conn, lock, start_id, get_end_id, keep_columns, write_db = True)
+        finally:
+            replication.remove_binlog_pin(conn, pin_name)
+
+    def _migrate_read_db(self, binlog_conn, name, path, keep_columns):
+        conn = _connect(path, self.timeout)
+        pin_name = "migrate:%s:%s" % (self.tablename, name)
+        try:
+            columns = replication.get_table_columns(conn, self.tablename)
+            if columns == keep_columns:
+                return
+            with LockManager.get_lock(path):
+                start_id = replication.get_applied_id(conn, self.dbpath)
+                replication.set_binlog_pin(binlog_conn, pin_name, start_id)
+
+            def lock():
+                return LockManager.get_lock(path)
+
+            def get_end_id():
+                return replication.get_applied_id(conn, self.dbpath)
+
+            self._rebuild(conn, binlog_conn, lock, start_id, get_end_id, keep_columns, write_db = False)
+        finally:
+            replication.remove_binlog_pin(binlog_conn, pin_name)
+            conn.close()
+
+    def _rebuild(self, conn, binlog_conn, lock, start_id, get_end_id, keep_columns, write_db):
+        columns = replication.get_table_columns(conn, self.tablename)
+        dropped = [name for name in columns if name not in keep_columns]
+        conn.execute("DROP TABLE IF EXISTS %s" % _quote(self.shadow_table))
+        conn.execute(self._build_create_sql(conn, keep_columns))
+
+        # 1. 按照主键分块复制
+        names = ",".join(_quote(name) for name in keep_columns)
+        last_id = None
+        while True:
+            with lock():
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    where = "" if last_id == None else "WHERE id > %d" % last_id
+                    row = conn.execute("SELECT MAX(id), COUNT(1) FROM (SELECT id FROM %s %s ORDER BY id LIMIT %d)" % (
+                        _quote(self.tablename), where, self.chunk_size)).fetchone()
+                    if row[1] > 0:
+                        range_where = "id <= %d" % row[0]
+                        if last_id != None:
+                            range_where += " AND id > %d" % last_id
+                        conn.execute("INSERT OR REPLACE INTO %s (%s) SELECT %s FROM %s WHERE %s" % (
+                            _quote(self.shadow_table), names, names, _quote(self.tablename), range_where))
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+            if row[1] == 0:
+                break
+            last_id = row[0]
+            if self.chunk_sleep > 0:
+                time.sleep(self.chunk_sleep)
+
+        # 2. 重放复制期间的binlog, 直到剩余的数量足够少
+        applied_id = start_id
+        while get_end_id() - applied_id > self.cutover_threshold:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                applied_id = self._replay(conn, binlog_conn, applied_id, get_end_id())
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+        # 3. 在一个事务中重放剩余的binlog并替换旧表
+        with lock():
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                end_id = get_end_id()
+                while applied_id < end_id:
+                    applied_id = self._replay(conn, binlog_conn, applied_id, end_id)
+                self._cutover(conn, keep_columns, dropped, write_db)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        logger.info("migrate table:%s done, dropped:%s", self.tablename, dropped)
+
+    def _replay(self, conn, binlog_conn, start_id, end_id):
+        """把 (start_id, end_id] 之间当前表的binlog应用到影子表, 返回重放到的位置"""
+        rows = binlog.read_rows(binlog_conn, self.binlog_table, start_id, self.replay_batch_size, end_id)
+        if len(rows) == 0:
+            return end_id
+        records = []
+        for record in replication.load_records(rows, binlog_conn, self.dbpath):
+            if record.table_name == self.tablename:
+                records.append(record._replace(table_name = self.shadow_table))
+        records = replication.filter_columns(conn, replication.compact_records(records))
+        replication.apply_records(conn, records)
+        return rows[-1][0]
+
+    def _build_create_sql(self, conn, keep_columns):
+        create_sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                  (self.tablename,)).fetchone()[0]
+        autoincrement = "autoincrement" in create_sql.lower()
+        definitions = []
+        for cid, name, type, notnull, default_value, pk in conn.execute("PRAGMA table_info(%s)" % _quote(self.tablename)):
+            if name not in keep_columns:
+                continue
+            if pk and name == "id" and type.lower() == "integer":
+                definition = "`id` integer primary key"
+                if autoincrement:
+                    definition += " autoincrement"
+            else:
+                definition = "%s %s" % (_quote(name), type)
+                if pk:
+                    definition += " primary key"
+                if notnull:
+                    definition += " NOT NULL"
+                if default_value != None:
+                    definition += " DEFAULT %s" % default_value
+            definitions.append(definition)
+        return "CREATE TABLE %s (%s)" % (_quote(self.shadow_table), ", ".join(definitions))
+
+    def _cutover(self, conn, keep_columns, dropped, write_db):
+        tablename = self.tablename
+        indexes = []
+        for index_name, index_sql in conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' "
+                                                  "AND tbl_name = ? AND sql IS NOT NULL", (tablename,)).fetchall():
+            index_columns = [row[2] for row in conn.execute("PRAGMA index_info(%s)" % _quote(index_name))]
+            if all(name in keep_columns for name in index_columns):
+                indexes.append(index_sql)
+        has_triggers = conn.execute("SELECT COUNT(1) FROM sqlite_master WHERE type = 'trigger' AND name = ?",
+                                    (replication.get_trigger_name(tablename, "insert"),)).fetchone()[0] > 0
+        # 保留自增序号, 避免复用被删除的id
+        seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (tablename,)).fetchone() \
+            if self._has_sequence(conn) else None
+
+        conn.execute("DROP TABLE %s" % _quote(tablename))
+        conn.execute("ALTER TABLE %s RENAME TO %s" % (_quote(self.shadow_table), _quote(tablename)))
+        if seq != None:
+            cursor = conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (seq[0], tablename))
+            if cursor.rowcount == 0:
+                conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (tablename, seq[0]))
+        for index_sql in indexes:
+            conn.execute(index_sql)
+        if write_db and has_triggers:
+            for sql in replication.build_trigger_sql(tablename, keep_columns, self.binlog_table):
+                conn.execute(sql)
+        if not write_db and len(dropped) > 0 and self._has_table(conn, counter.COUNTER_DEF_TABLE):
+            # 删除字段上的计数
+            marks = ",".join("?" for name in dropped)
+            conn.execute("DELETE FROM `%s` WHERE table_name = ? AND column_name IN (%s)" % (
+                counter.COUNTER_TABLE, marks), [tablename] + dropped)
+            conn.execute("DELETE FROM `%s` WHERE table_name = ? AND column_name IN (%s)" % (
+                counter.COUNTER_DEF_TABLE, marks), [tablename] + dropped)
+
+    def _has_table(self, conn, name):
+        return conn.execute("SELECT COUNT(1) FROM sqlite_master WHERE type = 'table' AND name = ?",
+                            (name,)).fetchone()[0] > 0
+
+    def _has_sequence(self, conn):
+        return self._has_table(conn, "sqlite_sequence")
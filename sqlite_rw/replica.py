@@ -0,0 +1,271 @@
+# encoding=utf-8
+"""读库(replica)管理和读请求路由
+
+读库可以是文件, 也可以是进程内的共享缓存内存数据库(读库路径写成 "memory:<name>"),
+内存读库启动时从写库备份, 之后和文件读库一样由binlog同步, 每个进程都同步自己的内存读库
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from .lock import LockManager
+
+ROUTE_ROUND_ROBIN = "round_robin"
+ROUTE_LEAST_BUSY = "least_busy"
+
+MEMORY_PREFIX = "memory:"
+
+
+def get_memory_uri(name):
+    return "file:sqlite_rw_%s?mode=memory&cache=shared" % name
+
+
+def is_memory_uri(path):
+    return path.startswith("file:") and "mode=memory" in path
+
+
+class MemoryReplicaRegistry:
+    """内存读库的锚定连接
+    共享缓存的内存数据库在最后一个连接关闭时销毁, 这里为每个内存读库保持一个连接直到进程退出
+    """
+
+    _lock = threading.Lock()
+    _anchors = dict() # uri -> sqlite3连接
+
+    @classmethod
+    def open(cls, uri):
+        """打开内存数据库, 返回是否是新创建的(新创建的需要从写库初始化)"""
+        with cls._lock:
+            if uri in cls._anchors:
+                return False
+            cls._anchors[uri] = sqlite3.connect(uri, uri = True, check_same_thread = False)
+            return True
+
+    @classmethod
+    def set_memory_limit(cls, uri, memory_limit):
+        """限制内存数据库的大小(字节), 超过之后写入会失败(database or disk is full), 读库停止同步"""
+        with cls._lock:
+            conn = cls._anchors[uri]
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            conn.execute("PRAGMA max_page_count = %d" % max(1, memory_limit // page_size))
+
+    @classmethod
+    def get_memory_size(cls, uri):
+        with cls._lock:
+            conn = cls._anchors.get(uri)
+            if conn == None:
+                return 0
+            return conn.execute("PRAGMA page_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+
+    @classmethod
+    def close(cls, uri):
+        with cls._lock:
+            conn = cls._anchors.pop(uri, None)
+        if conn != None:
+            conn.close()
+
+
+class ReplicaPosition:
+    """读库的同步位置, 同一个进程内按照(读库路径, 写库路径)共享, 同步之后唤醒等待的读请求
+    一个读库可以是多个写库的读库, 每个写库的同步位置互相独立
+    """
+
+    _lock = threading.Lock()
+    _instances = dict()
+
+    def __init__(self):
+        self.applied_id = 0
+        self.cond = threading.Condition()
+
+    @classmethod
+    def get(cls, path, dbpath=None):
+        key = (os.path.abspath(path), None if dbpath == None else os.path.abspath(dbpath))
+        with cls._lock:
+            position = cls._instances.get(key)
+            if position == None:
+                position = ReplicaPosition()
+                cls._instances[key] = position
+            return position
+
+    def update(self, applied_id):
+        with self.cond:
+            self.applied_id = applied_id
+            self.cond.notify_all()
+
+    def wait(self, min_id, timeout):
+        """等待读库同步到min_id, 超时返回False"""
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.applied_id < min_id:
+                wait_time = deadline - time.time()
+                if wait_time <= 0:
+                    return False
+                self.cond.wait(wait_time)
+            return True
+
+
+class ReadReplica:
+    """一个读库, 记录自己的同步位置、延迟和正在执行的读请求数"""
+
+    def __init__(self, name, path, db, dedicated=False, dbpath=None):
+        """dbpath 是同步到这个读库的写库路径"""
+        self.name = name
+        self.path = path
+        self.db = db
+        self.dedicated = dedicated # 专用的读库只处理指定了名称的请求
+        self.memory = is_memory_uri(path)
+        self.position = ReplicaPosition.get(path, dbpath)
+        self.lag = 0 # 落后写库的binlog记录数
+        self.caught_up_time = time.time() # 最近一次追平写库的时间
+        self.busy = 0
+        self._lock = threading.Lock()
+
+    @property
+    def applied_id(self):
+        return self.position.applied_id
+
+    def update_position(self, applied_id, last_binlog_id):
+        if applied_id != self.position.applied_id:
+            self.position.update(applied_id)
+        self.lag = max(0, (last_binlog_id or 0) - applied_id)
+        if self.lag == 0:
+            self.caught_up_time = time.time()
+
+    def get_lag_seconds(self):
+        if self.lag == 0:
+            return 0
+        return time.time() - self.caught_up_time
+
+    def __enter__(self):
+        if self.memory:
+            # 共享缓存模式下读写冲突会直接报错(database table is locked), 读取期间暂停同步
+            LockManager.get_db_lock(self.path).acquire_read()
+        with self._lock:
+            self.busy += 1
+        return self
+
+    def __exit__(self, type, value, traceback):
+        with self._lock:
+            self.busy -= 1
+        if self.memory:
+            LockManager.get_db_lock(self.path).release_read()
+
+
+class ReplicaSet:
+    """多个读库的集合, 按照轮询或者最空闲的策略选择读库, 跳过延迟过大的读库"""
+
+    refresh_interval = 0.02 # 从读库刷新同步位置的最小间隔(秒)
+
+    def __init__(self, replicas, policy=ROUTE_ROUND_ROBIN, max_lag=None):
+        assert policy in (ROUTE_ROUND_ROBIN, ROUTE_LEAST_BUSY), "unknown policy:%s" % policy
+        self.replicas = replicas
+        self.policy = policy
+        self.max_lag = max_lag # 最大允许落后的binlog记录数, None表示不限制
+        self.last_binlog_id = 0 # 当前进程看到的最新binlog位置
+        self._index = 0
+        self.refresh_func = None
+        self._refresh_time = 0
+        self._refresh_lock = threading.Lock()
+
+    def set_refresh_func(self, func):
+        """同步由其他进程执行时, 当前进程的同步位置需要通过func()从读库读取"""
+        self.refresh_func = func
+
+    def refresh(self):
+        """刷新同步位置, 限制频率, 同一时间只有一个线程刷新"""
+        if self.refresh_func == None:
+            return
+        now = time.time()
+        if now - self._refresh_time < self.refresh_interval:
+            return
+        if not self._refresh_lock.acquire(blocking = False):
+            return
+        try:
+            self._refresh_time = now
+            self.refresh_func()
+        except Exception as e:
+            logging.error("refresh replica position failed, err:%s", e)
+        finally:
+            self._refresh_lock.release()
+
+    def __iter__(self):
+        return iter(self.replicas)
+
+    def __len__(self):
+        return len(self.replicas)
+
+    def get(self, name):
+        for replica in self.replicas:
+            if replica.name == name:
+                return replica
+        raise KeyError("replica not found: %s" % name)
+
+    def set_last_binlog_id(self, last_binlog_id):
+        """写入binlog之后更新各个读库的延迟"""
+        self.last_binlog_id = max(self.last_binlog_id, last_binlog_id or 0)
+        for replica in self.replicas:
+            replica.update_position(replica.applied_id, last_binlog_id)
+
+    def get_memory_replicas(self):
+        return [replica for replica in self.replicas if replica.memory]
+
+    def get_min_applied_id(self):
+        return min(replica.applied_id for replica in self.replicas)
+
+    def get_least_lagging(self):
+        """延迟最小的非专用读库"""
+        candidates = [replica for replica in self.replicas if not replica.dedicated]
+        if len(candidates) == 0:
+            return None
+        return min(candidates, key = lambda x: x.lag)
+
+    def choose(self, name=None, min_seq=None):
+        """选择一个读库, 如果没有可用的读库返回None
+        min_seq: 读库至少需要同步到的binlog位置
+        """
+        if min_seq != None or self.max_lag != None:
+            self.refresh()
+        if name != None:
+            replica = self.get(name)
+            if min_seq != None and replica.applied_id < min_seq:
+                return None
+            return replica
+
+        candidates = []
+        for replica in self.replicas:
+            if replica.dedicated:
+                continue
+            if min_seq != None:
+                if replica.applied_id < min_seq:
+                    continue
+            elif self.max_lag != None and replica.lag > self.max_lag:
+                continue
+            candidates.append(replica)
+
+        if len(candidates) == 0:
+            return None
+        if self.policy == ROUTE_LEAST_BUSY:
+            return min(candidates, key = lambda x: x.busy)
+        self._index = (self._index + 1) % len(candidates)
+        return candidates[self._index]
+
+    def wait(self, min_seq, timeout, name=None):
+        """等待任意一个可用的读库同步到min_seq, 超时返回None"""
+        deadline = time.time() + timeout
+        while True:
+            # choose会按照refresh_interval刷新其他进程同步的位置
+            replica = self.choose(name, min_seq)
+            if replica != None:
+                return replica
+            wait_time = deadline - time.time()
+            if wait_time <= 0:
+                return None
+            # 等待第一个候选读库, 其他读库的进度在下一轮检查
+            if name != None:
+                candidate = self.get(name)
+            else:
+                candidate = max(self.replicas, key = lambda x: (not x.dedicated, x.applied_id))
+            candidate.position.wait(min_seq, min(wait_time, 0.05))
@@ -0,0 +1,618 @@
+# encoding=utf-8
+"""binlog复制引擎
+
+批量拉取binlog, 在读库的单个事务里用executemany批量应用, 写入使用幂等的upsert,
+读库中记录已经应用到的binlog位置(applied_id), 重复执行不会产生副作用.
+一个读库可以是多个写库的读库, applied_id按照写库的路径分别记录
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from .lock import LockManager
+from .election import FileLeaderLock
+from .cache import RowCacheRegistry
+from .schema import SchemaCache
+from .backend import connect
+from . import binlog
+from . import counter
+from .metrics import MetricsRegistry, SIZE_BUCKETS
+
+logger = logging.getLogger("sqlite-rw")
+
+STATE_TABLE = "_sqlite_rw_state"
+APPLIED_ID_KEY = "applied_id"
+PIN_TABLE = "_sqlite_rw_binlog_pin" # 写库中不能被清理的binlog位置, 比如在线迁移需要重放的binlog
+
+BinlogRecord = namedtuple("BinlogRecord", ["id", "table_name", "op_type", "data"])
+
+
+class _BackupRestarted(Exception):
+    pass
+
+
+def get_connection(db):
+    """获取db对象当前线程的sqlite3连接"""
+    return db.get_connection()
+
+
+def fetch_dicts(cursor):
+    """把sqlite3游标的结果转换成dict列表"""
+    names = [desc[0] for desc in cursor.description]
+    return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+
+def split_list(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i+size]
+
+
+class SafeTransaction:
+    """web.db的事务在commit失败(比如database is locked)时不会回滚, 连接会一直持有写锁,
+    这里在commit失败时执行回滚, 原生后端的事务本身也是这样处理的"""
+
+    def __init__(self, db):
+        self.transaction = db.transaction()
+
+    def commit(self):
+        try:
+            self.transaction.commit()
+        except Exception:
+            self.transaction.rollback()
+            raise
+
+    def rollback(self):
+        self.transaction.rollback()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type != None:
+            self.rollback()
+        else:
+            self.commit()
+
+
+def get_trigger_name(tablename, op_type):
+    return "_sqlite_rw_%s_%s" % (tablename, op_type)
+
+
+def build_trigger_sql(tablename, column_names, binlog_table="binlog"):
+    """生成写入binlog的触发器SQL, 返回SQL列表
+    json_object不能保存BLOB, BLOB的值转换成 ["<hex>"], 参考 binlog.decode_json
+    """
+    new_row = ",".join("'%s', CASE typeof(NEW.`%s`) WHEN 'blob' THEN json_array(hex(NEW.`%s`)) ELSE NEW.`%s` END" % (
+        name, name, name, name) for name in column_names)
+    sql_list = []
+    for op_type, event, data in (("insert", "INSERT", "json_object(%s)" % new_row),
+                                 ("update", "UPDATE", "json_object(%s)" % new_row),
+                                 ("delete", "DELETE", "json_array(OLD.id)")):
+        trigger_name = get_trigger_name(tablename, op_type)
+        if op_type == "delete":
+            op_type = "delete_by_ids"
+        sql_list.append("DROP TRIGGER IF EXISTS `%s`" % trigger_name)
+        sql_list.append("CREATE TRIGGER `%s` AFTER %s ON `%s` BEGIN "
+                        "INSERT INTO `%s` (table_name, op_type, data) VALUES (%r, %r, %s); END" % (
+                            trigger_name, event, tablename, binlog_table, tablename, op_type, data))
+    return sql_list
+
+
+def load_records(rows, conn, path=None):
+    """把binlog表的记录 [(id, table_name, op_type, data)] 转换成BinlogRecord
+    conn是写库的连接, 用于读取compact格式的字段列表
+    """
+    records = []
+    for binlog_id, table_name, op_type, data in rows:
+        records.append(BinlogRecord(binlog_id, table_name, op_type, binlog.decode(conn, data, path)))
+    return records
+
+
+def init_state_table(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS `%s` (name text primary key, value integer)" % STATE_TABLE)
+
+
+def get_applied_id_key(dbpath):
+    """不同写库的binlog位置互相独立, 状态按照写库的绝对路径区分"""
+    return "%s:%s" % (APPLIED_ID_KEY, os.path.abspath(dbpath))
+
+
+def get_applied_id(conn, dbpath):
+    """读库已经应用的dbpath(写库)的binlog位置"""
+    row = conn.execute("SELECT value FROM `%s` WHERE name = ?" % STATE_TABLE,
+                       (get_applied_id_key(dbpath),)).fetchone()
+    if row is None:
+        return 0
+    return row[0]
+
+
+def set_applied_id(conn, dbpath, value):
+    conn.execute("INSERT OR REPLACE INTO `%s` (name, value) VALUES (?, ?)" % STATE_TABLE,
+                 (get_applied_id_key(dbpath), value))
+
+
+def init_pin_table(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS `%s` (name text primary key, binlog_id integer, expire_time real)" % PIN_TABLE)
+    if "expire_time" not in get_table_columns(conn, PIN_TABLE):
+        conn.execute("ALTER TABLE `%s` ADD COLUMN expire_time real" % PIN_TABLE)
+
+
+def set_binlog_pin(conn, name, binlog_id, ttl=None):
+    """保留binlog_id之后的binlog, 直到remove_binlog_pin
+    ttl不为None时pin在ttl秒之后过期, 持有者需要定时续期, 进程退出之后不会一直阻止binlog清理
+    """
+    init_pin_table(conn)
+    expire_time = None if ttl == None else time.time() + ttl
+    conn.execute("INSERT OR REPLACE INTO `%s` (name, binlog_id, expire_time) VALUES (?, ?, ?)" % PIN_TABLE,
+                 (name, binlog_id, expire_time))
+
+
+def remove_binlog_pin(conn, name):
+    conn.execute("DELETE FROM `%s` WHERE name = ?" % PIN_TABLE, (name,))
+
+
+def get_table_columns(conn, tablename, path=None):
+    """表的字段列表, 传入path时使用SchemaCache"""
+    return SchemaCache.get_column_names(path, conn, tablename)
+
+
+def filter_columns(conn, records, path=None):
+    """去掉目标库中不存在的字段, 比如写库删除字段之后、读库完成迁移之前的binlog"""
+    columns_by_table = dict()
+    result = []
+    for record in records:
+        if record.op_type == "delete_by_ids":
+            result.append(record)
+            continue
+        columns = columns_by_table.get(record.table_name)
+        if columns is None:
+            columns = set(get_table_columns(conn, record.table_name, path))
+            columns_by_table[record.table_name] = columns
+        if len(columns) == 0 or columns.issuperset(record.data.keys()):
+            result.append(record)
+        else:
+            data = dict((key, value) for key, value in record.data.items() if key in columns)
+            result.append(BinlogRecord(record.id, record.table_name, record.op_type, data))
+    return result
+
+
+def _build_upsert_sql(tablename, columns):
+    return "INSERT OR REPLACE INTO `%s` (%s) VALUES (%s)" % (
+        tablename,
+        ",".join("`%s`" % name for name in columns),
+        ",".join("?" for name in columns))
+
+
+def group_records(records):
+    """把连续的、SQL形状相同的记录合并成一组, 保证应用顺序不变
+
+    返回 [(sql, params_list)]
+    """
+    groups = []
+    last_key = None
+    for record in records:
+        if record.op_type in ("insert", "update"):
+            columns = tuple(record.data.keys())
+            key = ("upsert", record.table_name, columns)
+            params = [tuple(record.data[name] for name in columns)]
+        elif record.op_type == "delete_by_ids":
+            key = ("delete", record.table_name)
+            params = [(data_id,) for data_id in record.data]
+        else:
+            raise Exception("unknown op_type:%s" % record.op_type)
+
+        if key != last_key:
+            if key[0] == "upsert":
+                sql = _build_upsert_sql(record.table_name, key[2])
+            else:
+                sql = "DELETE FROM `%s` WHERE id = ?" % record.table_name
+            groups.append((sql, []))
+            last_key = key
+        groups[-1][1].extend(params)
+    return groups
+
+
+def compact_records(records):
+    """合并同一个(table_name, id)上的冗余操作, 只保留窗口内的最终状态
+
+    - 多次insert/update只保留最后一次的完整数据
+    - 窗口内先insert后delete的数据直接丢弃
+    返回的记录按照(table_name, op_type)排列, 方便批量应用
+    """
+    # (table_name, id) -> [first_op_type, last_record]
+    final_states = dict()
+    for record in records:
+        if record.op_type in ("insert", "update"):
+            key = (record.table_name, record.data.get("id"))
+            state = final_states.get(key)
+            if state is None:
+                final_states[key] = [record.op_type, record]
+            else:
+                state[1] = record
+        elif record.op_type == "delete_by_ids":
+            for data_id in record.data:
+                key = (record.table_name, data_id)
+                state = final_states.get(key)
+                item = BinlogRecord(record.id, record.table_name, record.op_type, [data_id])
+                if state is None:
+                    final_states[key] = [record.op_type, item]
+                elif state[0] == "insert":
+                    # insert和delete抵消了
+                    del final_states[key]
+                else:
+                    state[1] = item
+        else:
+            raise Exception("unknown op_type:%s" % record.op_type)
+
+    upserts = []
+    deletes = dict()
+    for first_op_type, record in final_states.values():
+        if record.op_type == "delete_by_ids":
+            deletes.setdefault(record.table_name, []).extend(record.data)
+        else:
+            upserts.append(record)
+
+    upserts.sort(key = lambda x: (x.table_name, tuple(x.data.keys())))
+    result = upserts
+    for tablename in deletes:
+        result.append(BinlogRecord(0, tablename, "delete_by_ids", deletes[tablename]))
+    return result
+
+
+def apply_records(conn, records):
+    """在conn的当前事务中应用records, 事务由调用方控制"""
+    for sql, params_list in group_records(records):
+        conn.executemany(sql, params_list)
+
+
+def checksum_rows(rows):
+    """计算一批记录的校验值"""
+    md5 = hashlib.md5()
+    for row in rows:
+        md5.update(repr(sorted(row.items())).encode("utf-8"))
+    return md5.hexdigest()
+
+
+class BinlogReplicator:
+    """一个写库到它的所有读库的binlog同步通道"""
+
+    copy_batch_size = 1000 # 每次从binlog拉取的记录数
+    compact_binlog = True # 应用binlog之前合并冗余的操作
+    binlog_segment_size = None # binlog表达到这个记录数之后切换分段, None表示逐条删除已经应用的binlog
+    timeout = 5
+    memory_pin_ttl = 60 # 内存读库的binlog pin的有效期(秒), 同步时续期
+    memory_pin_interval = 1 # 内存读库的同步位置变化之后, 更新binlog pin的最小间隔(秒)
+    max_backup_restarts = 3 # 分步备份因为写库的写入重新开始的最大次数, 超过之后持有写锁一次复制完成
+
+    def __init__(self, dbpath, db, replicas, binlog_table="binlog", copy_batch_size=None, compact_binlog=None,
+                 binlog_segment_size=None):
+        self.dbpath = dbpath
+        self.db = db
+        self.replicas = replicas
+        self.binlog_table = binlog_table
+        if copy_batch_size != None:
+            self.copy_batch_size = copy_batch_size
+        if compact_binlog != None:
+            self.compact_binlog = compact_binlog
+        if binlog_segment_size != None:
+            self.binlog_segment_size = binlog_segment_size
+        self.leader_lock = FileLeaderLock.get(dbpath)
+        self._trimmed_id = 0
+        self._trim_lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+        self._data_version = None
+        self._memory_pins = dict() # replica.path -> (binlog_id, 更新时间)
+
+    def init_state_table(self):
+        with SafeTransaction(self.db):
+            init_pin_table(get_connection(self.db))
+            binlog.init_schema_table(get_connection(self.db))
+        binlog.BinlogSchemaRegistry.load(self.dbpath, get_connection(self.db))
+        last_binlog_id = self.get_last_binlog_id()
+        for replica in self.replicas:
+            with SafeTransaction(replica.db):
+                read_conn = get_connection(replica.db)
+                init_state_table(read_conn)
+                counter.init_tables(read_conn)
+                replica.update_position(get_applied_id(read_conn, self.dbpath), last_binlog_id)
+
+    def is_leader(self):
+        return self.leader_lock.try_acquire()
+
+    def has_new_data(self):
+        """写库是否被其他连接修改过, 用于leader低成本地轮询"""
+        data_version = self.db.query("PRAGMA data_version").first().data_version
+        if data_version == self._data_version:
+            return False
+        self._data_version = data_version
+        return True
+
+    def has_backlog(self):
+        """还有读库没有应用的binlog, 比如上一次同步遇到了 database is locked"""
+        return (self.get_last_binlog_id() or 0) > self.replicas.get_min_applied_id()
+
+    def copy_to_read(self, replicas=None):
+        """把binlog同步到读库(默认所有的读库), 直到binlog为空"""
+        if replicas == None:
+            replicas = self.replicas
+        for replica in replicas:
+            if replica.memory and self._has_gap(replica):
+                # 其他进程清理了内存读库还没有应用的binlog, 重新从写库备份
+                logger.warning("binlog gap found, resync memory replica:%s", replica.name)
+                self.resync_replica(replica)
+            while True:
+                count = self.copy_batch_to_read(replica)
+                if count < self.copy_batch_size:
+                    break
+            if replica.memory:
+                self.pin_memory_replica(replica)
+        # 清理binlog之前处理缓存, 避免缓存失效的时候binlog已经被删除
+        self.sync_row_cache()
+        self.trim_binlog()
+
+    def copy_batch_to_read(self, replica=None):
+        """同步一批binlog到读库, 返回处理的记录数
+        读库的写入在一个事务中完成, 并记录已经应用的binlog位置, 所以重复执行是幂等的
+        """
+        if replica == None:
+            replica = self.replicas.replicas[0]
+        # 同步不阻塞写库的DML, 但是同一个读库同时只能有一个同步任务
+        with LockManager.get_read_lock(self.dbpath), LockManager.get_lock(replica.path):
+            try:
+                start_time = time.time()
+                db = self.db
+                read_db = replica.db
+                with SafeTransaction(read_db):
+                    read_conn = get_connection(read_db)
+                    applied_id = get_applied_id(read_conn, self.dbpath)
+                    conn = get_connection(db)
+                    rows = binlog.read_rows(conn, self.binlog_table, applied_id, self.copy_batch_size)
+                    records = load_records(rows, conn, self.dbpath)
+                    count = len(records)
+                    if count > 0:
+                        applied_id = records[-1].id
+                        if self.compact_binlog:
+                            records = compact_records(records)
+                        records = filter_columns(read_conn, records, replica.path)
+                        counter_defs = counter.load_defs(read_conn)
+                        deltas = None
+                        if counter_defs:
+                            # 计数的增量需要读库中变化之前的数据
+                            deltas = counter.compute_deltas(read_conn, records, counter_defs)
+                        apply_records(read_conn, records)
+                        if deltas:
+                            counter.apply_deltas(read_conn, deltas)
+                        set_applied_id(read_conn, self.dbpath, applied_id)
+                # 提交之后再失效缓存, 保证之后的读请求可以读到新数据
+                RowCacheRegistry.invalidate_records(self.dbpath, records)
+                if count > 0:
+                    MetricsRegistry.observe("sqlite_rw_apply_batch_size", count, SIZE_BUCKETS,
+                                            db = self.dbpath, replica = replica.name)
+                    MetricsRegistry.observe("sqlite_rw_apply_seconds", time.time() - start_time,
+                                            db = self.dbpath, replica = replica.name)
+                replica.update_position(applied_id, self.get_last_binlog_id())
+                return count
+            except sqlite3.OperationalError as e:
+                logger.error("copy_to_read failed, replica:%s, err:%s", replica.name, e)
+                MetricsRegistry.inc("sqlite_rw_apply_errors", db = self.dbpath, replica = replica.name)
+                return 0
+
+    def sync_row_cache(self):
+        """按照所有读库都已经应用的位置失效当前进程的行缓存
+        binlog可能由其他进程应用, 这里从写库重新读取 (上次失效的位置, 当前位置] 之间的binlog,
+        这部分binlog已经被清理或者数量太多时直接清空缓存
+        """
+        if not RowCacheRegistry.has_caches(self.dbpath):
+            return
+        with self._cache_lock:
+            applied_id = self.replicas.get_min_applied_id()
+            synced_id = RowCacheRegistry.get_synced_id(self.dbpath)
+            if synced_id != None and applied_id <= synced_id:
+                return
+            if synced_id == None or applied_id - synced_id > self.copy_batch_size:
+                RowCacheRegistry.clear(self.dbpath)
+            else:
+                conn = get_connection(self.db)
+                rows = binlog.read_rows(conn, self.binlog_table, synced_id, applied_id - synced_id, end_id = applied_id)
+                if len(rows) == 0 or rows[0][0] != synced_id + 1:
+                    RowCacheRegistry.clear(self.dbpath)
+                else:
+                    RowCacheRegistry.invalidate_records(self.dbpath, load_records(rows, conn, self.dbpath))
+            RowCacheRegistry.set_synced_id(self.dbpath, applied_id)
+
+    def get_memory_pin_name(self, replica):
+        return "memory:%s:%s" % (os.getpid(), replica.path)
+
+    def pin_memory_replica(self, replica, force=False):
+        """内存读库只由所在的进程同步, 其他进程(leader)看不到它的位置,
+        通过有过期时间的binlog pin保留它还没有应用的binlog, 避免每次落后都要从写库完整备份
+        """
+        now = time.time()
+        binlog_id, update_time = self._memory_pins.get(replica.path, (None, 0))
+        if not force:
+            if binlog_id == replica.applied_id and now - update_time < self.memory_pin_ttl / 3:
+                return
+            if now - update_time < self.memory_pin_interval:
+                return
+        try:
+            with LockManager.get_read_lock(self.dbpath), SafeTransaction(self.db):
+                conn = get_connection(self.db)
+                set_binlog_pin(conn, self.get_memory_pin_name(replica), replica.applied_id, self.memory_pin_ttl)
+                # 顺便清理已经退出的进程留下的pin
+                conn.execute("DELETE FROM `%s` WHERE expire_time < ?" % PIN_TABLE, (now,))
+            self._memory_pins[replica.path] = (replica.applied_id, now)
+        except sqlite3.OperationalError as e:
+            logger.error("pin memory replica failed, replica:%s, err:%s", replica.name, e)
+
+    def _has_gap(self, replica):
+        min_id = binlog.get_first_id(get_connection(self.db), self.binlog_table)
+        return min_id != None and min_id > replica.applied_id + 1
+
+    def get_last_binlog_id(self):
+        return binlog.get_last_id(get_connection(self.db), self.binlog_table)
+
+    def trim_binlog(self):
+        """清理所有读库都已经应用的binlog"""
+        applied_id = self.replicas.get_min_applied_id()
+        if applied_id <= self._trimmed_id:
+            return
+        if self.binlog_segment_size != None:
+            return self._trim_segments(applied_id)
+        with LockManager.get_read_lock(self.dbpath), self._trim_lock:
+            try:
+                applied_id = self._get_trim_id(applied_id)
+                # 关闭分段之前留下的分段
+                if len(binlog.list_segments(get_connection(self.db), self.binlog_table)) > 0:
+                    binlog.drop_segments(get_connection(self.db), self.binlog_table, applied_id)
+                min_id = self.db.query("SELECT MIN(id) AS min_id FROM %s" % self.binlog_table).first().min_id
+                if min_id == None or min_id > applied_id:
+                    # 已经被其他线程或者进程清理了, 避免无意义的写锁
+                    self._trimmed_id = applied_id
+                    return
+                self.db.query("DELETE FROM %s WHERE id <= $applied_id" % self.binlog_table,
+                              vars = dict(applied_id = applied_id))
+                self._trimmed_id = applied_id
+            except sqlite3.OperationalError as e:
+                logger.error("trim_binlog failed, err:%s", e)
+
+    def _get_trim_id(self, applied_id):
+        """可以清理的binlog位置, 不超过没有过期的binlog pin"""
+        pin_id = self.db.query("SELECT MIN(binlog_id) AS pin_id FROM `%s` WHERE expire_time IS NULL OR expire_time >= $now"
+                               % PIN_TABLE, vars = dict(now = time.time())).first().pin_id
+        if pin_id != None and pin_id < applied_id:
+            return pin_id
+        return applied_id
+
+    def _trim_segments(self, applied_id):
+        """当前的binlog表写满之后切换分段, 删除已经全部应用的分段"""
+        if LockManager.get_db_lock(self.dbpath).is_read_locked():
+            # 当前线程持有写库的读锁(比如在DML中同步执行了同步任务), 不能获取独占锁, 下次再处理
+            return
+        with self._trim_lock:
+            try:
+                conn = get_connection(self.db)
+                applied_id = self._get_trim_id(applied_id)
+                segments = binlog.list_segments(conn, self.binlog_table)
+                need_drop = len(segments) > 0 and segments[0][1] <= applied_id
+                need_rotate = binlog.get_active_size(conn, self.binlog_table) >= self.binlog_segment_size
+                if need_drop or need_rotate:
+                    # 切换分段是DDL, 独占写库, 使用独立的连接显式控制事务
+                    with LockManager.get_lock(self.dbpath):
+                        ddl_conn = connect(self.dbpath, timeout = self.timeout, isolation_level = None)
+                        try:
+                            if need_rotate:
+                                segment = binlog.rotate(ddl_conn, self.binlog_table)
+                                logger.info("rotate binlog segment:%s", segment)
+                            for name in binlog.drop_segments(ddl_conn, self.binlog_table, applied_id):
+                                logger.info("drop binlog segment:%s", name)
+                        finally:
+                            ddl_conn.close()
+                self._trimmed_id = applied_id
+            except sqlite3.OperationalError as e:
+                logger.error("trim_binlog failed, err:%s", e)
+
+    def resync_replica(self, replica=None, pages=256, sleep=0.005):
+        """使用sqlite3的在线备份接口把写库复制到读库, 用于新增读库或者修复不一致的读库
+
+        备份按照pages分步执行, 每一步之间写库可以正常写入, 写入之后备份会从头开始;
+        持续写入时重新开始超过max_backup_restarts次, 改为在写库的短事务中一次复制完成, 期间写库的写入需要等待;
+        复制完成后读库记录快照对应的binlog位置, 后续从这个位置继续同步
+        """
+        if replica == None:
+            replica = self.replicas.replicas[0]
+        with LockManager.get_lock(replica.path):
+            src = sqlite3.connect(self.dbpath, timeout = self.timeout)
+            dst = connect(replica.path)
+            try:
+                # 备份会覆盖读库的计数表, 复制完成后按照原来的定义重新计算
+                counter.init_tables(dst)
+                counter_defs = counter.load_defs(dst)
+                dst.commit()
+                self._backup(src, dst, replica, pages, sleep)
+                # 快照中的binlog自增序号就是快照包含的最后一条binlog
+                row = dst.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (self.binlog_table,)).fetchone()
+                applied_id = 0 if row == None else row[0]
+                # 读库不需要binlog和写库的触发器
+                for name, in dst.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'").fetchall():
+                    if name.startswith("_sqlite_rw_"):
+                        dst.execute("DROP TRIGGER IF EXISTS `%s`" % name)
+                dst.execute("DELETE FROM `%s`" % self.binlog_table)
+                for name, last_id in binlog.list_segments(dst, self.binlog_table):
+                    dst.execute("DROP TABLE `%s`" % name)
+                init_state_table(dst)
+                set_applied_id(dst, self.dbpath, applied_id)
+                counter.init_tables(dst)
+                for tablename, columns in counter_defs.items():
+                    counter.register(dst, tablename, columns)
+                dst.commit()
+            finally:
+                dst.close()
+                src.close()
+            RowCacheRegistry.clear(self.dbpath)
+            replica.update_position(applied_id, self.get_last_binlog_id())
+            logger.info("resync replica:%s, applied_id:%s", replica.name, applied_id)
+        if replica.memory:
+            self.pin_memory_replica(replica, force = True)
+        return applied_id
+
+    def _backup(self, src, dst, replica, pages, sleep):
+        state = dict(restarts = 0, remaining = None)
+
+        def progress(status, remaining, total):
+            if state["remaining"] != None and remaining > state["remaining"]:
+                # 剩余的页数变多说明写库被修改了, 备份从头开始
+                state["restarts"] += 1
+                logger.info("resync replica:%s restarted, restarts:%s, total pages:%s",
+                            replica.name, state["restarts"], total)
+                if state["restarts"] > self.max_backup_restarts:
+                    raise _BackupRestarted()
+            state["remaining"] = remaining
+
+        try:
+            src.backup(dst, pages = pages, progress = progress, sleep = sleep)
+            return
+        except _BackupRestarted:
+            logger.warning("resync replica:%s restarted too many times, copy in one step", replica.name)
+        # 用另外一个连接持有写库的写锁, 复制期间不会有其他写入;
+        # 备份的源连接自己处于写事务中时sqlite会一直返回busy
+        lock_conn = sqlite3.connect(self.dbpath, timeout = self.timeout)
+        try:
+            lock_conn.execute("BEGIN IMMEDIATE")
+            src.backup(dst, pages = -1)
+        finally:
+            lock_conn.rollback()
+            lock_conn.close()
+
+    def checksum_diff(self, tablename, replica=None, chunk_size=1000):
+        """按照id分块比较写库和读库的数据, 返回不一致的id范围 [(start_id, end_id)]
+        end_id为None表示读库中多出来的数据
+        """
+        if replica == None:
+            replica = self.replicas.replicas[0]
+        result = []
+        last_id = None
+        while True:
+            # 每一块的范围是 (上一块的最大id, 本块的最大id], 保证id之间的空隙也会被比较
+            where = "" if last_id == None else "WHERE id > %d" % last_id
+            rows = list(self.db.query("SELECT * FROM `%s` %s ORDER BY id LIMIT %d" % (tablename, where, chunk_size)))
+            if len(rows) == 0:
+                break
+            end_id = rows[-1].id
+            range_where = "id <= %d" % end_id
+            if last_id != None:
+                range_where += " AND id > %d" % last_id
+            read_rows = replica.db.query("SELECT * FROM `%s` WHERE %s ORDER BY id" % (tablename, range_where))
+            if checksum_rows(rows) != checksum_rows(read_rows):
+                result.append((rows[0].id, end_id))
+            last_id = end_id
+        # 写库的数据范围之外, 读库多出来的数据
+        extra_sql = "SELECT COUNT(1) AS amount FROM `%s`" % tablename
+        if last_id != None:
+            extra_sql += " WHERE id > %d" % last_id
+        if replica.db.query(extra_sql).first().amount > 0:
+            result.append((last_id, None))
+        return result
@@ -0,0 +1,63 @@
+# encoding=utf-8
+"""独立的binlog同步进程
+
+用法: sqlite-rw-replicator write.db read.db [read2.db ...] [--interval 0.5]
+或者: python -m sqlite_rw.replicator write.db read.db
+
+业务进程使用 replication_mode=REPLICATION_EXTERNAL 时只写binlog, 由这个进程负责同步,
+多个同步进程同时运行时通过文件锁选举, 只有一个进程工作
+"""
+
+import argparse
+import logging
+import time
+
+from . import replication
+from . import init_binlog_table
+from .replica import ReadReplica, ReplicaSet
+from .backend import create_db
+
+logger = logging.getLogger("sqlite-rw")
+
+
+def create_replicator(dbpath, read_db_paths, timeout=5, copy_batch_size=None, backend=None, binlog_segment_size=None):
+    init_binlog_table(dbpath)
+    db = create_db(dbpath, timeout, backend)
+    replicas = []
+    for path in read_db_paths:
+        replicas.append(ReadReplica(path, path, create_db(path, timeout, backend), dbpath = dbpath))
+    replicator = replication.BinlogReplicator(dbpath, db, ReplicaSet(replicas), copy_batch_size = copy_batch_size,
+                                              binlog_segment_size = binlog_segment_size)
+    replicator.init_state_table()
+    return replicator
+
+
+def run_forever(replicator, interval=0.5):
+    while True:
+        try:
+            if replicator.is_leader() and replicator.has_new_data():
+                replicator.copy_to_read()
+        except Exception as e:
+            logger.exception("replicate failed, err:%s", e)
+        time.sleep(interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description = "sqlite-rw binlog replicator")
+    parser.add_argument("dbpath", help = "write db path")
+    parser.add_argument("read_db_path", nargs = "+", help = "read db paths")
+    parser.add_argument("--interval", type = float, default = 0.5, help = "poll interval in seconds")
+    parser.add_argument("--batch-size", type = int, default = None, help = "binlog records per batch")
+    parser.add_argument("--backend", default = None, help = "webpy or sqlite3")
+    parser.add_argument("--segment-size", type = int, default = None, help = "binlog records per segment")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level = logging.INFO,
+                        format = '%(asctime)s|%(levelname)s|%(filename)s:%(lineno)d|%(message)s')
+    replicator = create_replicator(args.dbpath, args.read_db_path, copy_batch_size = args.batch_size,
+                                   backend = args.backend, binlog_segment_size = args.segment_size)
+    run_forever(replicator, args.interval)
+
+
+if __name__ == "__main__":
+    main()
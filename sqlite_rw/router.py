@@ -0,0 +1,112 @@
+# encoding=utf-8
+"""基于执行计划的读路由
+
+default_read_type="auto" 时, 读请求先用 EXPLAIN QUERY PLAN 判断查询的类型, 结果按照SQL的形状缓存:
+- lookup: 主键或者索引的等值查询, 代价很小, 发到最新的数据源(没有延迟的读库, 没有就用写库)
+- scan: 全表扫描、范围查询、排序分组、聚合(COUNT/SUM/GROUP BY等)等, 总是发到读库, 避免拖慢写库
+"""
+
+import logging
+import re
+import threading
+from collections import OrderedDict
+
+from .metrics import MetricsRegistry
+
+logger = logging.getLogger("sqlite-rw")
+
+QUERY_LOOKUP = "lookup"
+QUERY_SCAN = "scan"
+
+_AGGREGATE_PATTERN = re.compile(r"\b(count|sum|avg|min|max|total|group_concat)\s*\(|\bgroup\s+by\b", re.IGNORECASE)
+
+
+def is_aggregate_sql(sql):
+    """聚合查询即使使用了索引, 也可能读取大量的行, 执行计划中不一定有SCAN"""
+    return _AGGREGATE_PATTERN.search(sql) != None
+
+
+def classify_plan(details):
+    """根据执行计划的detail列表判断查询类型"""
+    is_lookup = False
+    for detail in details:
+        if detail.startswith("SCAN") or "TEMP B-TREE" in detail:
+            return QUERY_SCAN
+        if detail.startswith("SEARCH"):
+            if "<" in detail or ">" in detail:
+                # 范围查询
+                return QUERY_SCAN
+            is_lookup = True
+    if is_lookup:
+        return QUERY_LOOKUP
+    return QUERY_SCAN
+
+
+class QueryRouter:
+
+    plan_cache_size = 1024 # 缓存的SQL形状数量
+
+    def __init__(self, db, replicas, tablename=""):
+        self.db = db
+        self.replicas = replicas
+        self.tablename = tablename
+        self.plan_cache = OrderedDict()
+        self.stats = dict(plan_cache_hits = 0, plan_cache_misses = 0, plan_errors = 0)
+        self._lock = threading.Lock()
+
+    def classify(self, sql_query):
+        """返回查询类型, 无法分析时返回None"""
+        sql = sql_query.query(paramstyle = "qmark")
+        with self._lock:
+            if sql in self.plan_cache:
+                self.plan_cache.move_to_end(sql)
+                self.stats["plan_cache_hits"] += 1
+                return self.plan_cache[sql]
+            self.stats["plan_cache_misses"] += 1
+        try:
+            if is_aggregate_sql(sql):
+                query_type = QUERY_SCAN
+            else:
+                conn = self.db.get_connection()
+                rows = conn.execute("EXPLAIN QUERY PLAN " + sql, list(sql_query.values())).fetchall()
+                query_type = classify_plan([row[3] for row in rows])
+        except Exception as e:
+            logger.error("explain failed, sql:%s, err:%s", sql, e)
+            query_type = None
+            self.stats["plan_errors"] += 1
+        with self._lock:
+            self.plan_cache[sql] = query_type
+            while len(self.plan_cache) > self.plan_cache_size:
+                self.plan_cache.popitem(last = False)
+        return query_type
+
+    def route(self, sql_query):
+        """返回 (db, replica), replica为None表示写库"""
+        query_type = self.classify(sql_query)
+        if query_type == QUERY_LOOKUP:
+            # 已经追平写库的读库, 都有延迟时直接读写库
+            replica = self.replicas.choose(min_seq = self.replicas.last_binlog_id)
+        elif query_type == QUERY_SCAN:
+            replica = self.replicas.choose()
+            if replica == None:
+                replica = self.replicas.get_least_lagging()
+        else:
+            replica = self.replicas.choose()
+        self._record(query_type, replica)
+        if replica == None:
+            return self.db, None
+        return replica.db, replica
+
+    def _record(self, query_type, replica):
+        target = "write" if replica == None else "read"
+        key = "%s_%s" % (query_type or "unknown", target)
+        with self._lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+        MetricsRegistry.inc("sqlite_rw_route", table = self.tablename, query_type = query_type or "unknown",
+                            target = target)
+
+    def get_stats(self):
+        with self._lock:
+            result = dict(self.stats)
+            result["plan_cache_size"] = len(self.plan_cache)
+        return result
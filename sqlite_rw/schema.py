@@ -0,0 +1,72 @@
+# encoding=utf-8
+"""表结构的缓存
+
+每个数据库文件缓存一份 pragma table_info 的结果, 以 PRAGMA schema_version 作为版本:
+任何连接(包括其他进程)执行了DDL, schema_version都会变化, 缓存随之失效.
+检查版本只需要读取文件头, 比重复执行 table_info 和查询 sqlite_master 便宜得多
+"""
+
+import os
+import threading
+
+
+class SchemaCache:
+    """进程内全局的表结构缓存, key是数据库文件的绝对路径"""
+
+    enabled = True
+
+    _lock = threading.Lock()
+    _entries = dict() # path -> [schema_version, {tablename: columns}]
+    hits = 0
+    misses = 0
+
+    @classmethod
+    def get_columns(cls, path, conn, tablename):
+        """返回 table_info 的结果 [dict(cid, name, type, notnull, dflt_value, pk)], 表不存在时返回空列表
+        conn 是 path 对应的sqlite3连接
+        """
+        if not cls.enabled or path == None:
+            return _load_columns(conn, tablename)
+        key = os.path.abspath(path)
+        version = conn.execute("PRAGMA schema_version").fetchone()[0]
+        with cls._lock:
+            entry = cls._entries.get(key)
+            if entry != None and entry[0] == version and tablename in entry[1]:
+                cls.hits += 1
+                return entry[1][tablename]
+            cls.misses += 1
+        columns = _load_columns(conn, tablename)
+        with cls._lock:
+            entry = cls._entries.get(key)
+            if entry == None or entry[0] != version:
+                entry = [version, dict()]
+                cls._entries[key] = entry
+            entry[1][tablename] = columns
+        return columns
+
+    @classmethod
+    def get_column_names(cls, path, conn, tablename):
+        return [column["name"] for column in cls.get_columns(path, conn, tablename)]
+
+    @classmethod
+    def has_table(cls, path, conn, tablename):
+        return len(cls.get_columns(path, conn, tablename)) > 0
+
+    @classmethod
+    def invalidate(cls, path=None):
+        """主动失效, path为None时清空所有的缓存"""
+        with cls._lock:
+            if path == None:
+                cls._entries = dict()
+            else:
+                cls._entries.pop(os.path.abspath(path), None)
+
+    @classmethod
+    def get_stats(cls):
+        return dict(hits = cls.hits, misses = cls.misses, size = len(cls._entries))
+
+
+def _load_columns(conn, tablename):
+    cursor = conn.execute("pragma table_info('%s')" % tablename)
+    names = [desc[0] for desc in cursor.description]
+    return [dict(zip(names, row)) for row in cursor.fetchall()]
@@ -0,0 +1,232 @@
+# encoding=utf-8
+"""按照哈希分片的表
+
+一个写库同一时间只能有一个写入, ShardedSqliteTable 把一张表的数据按照分片键的哈希分散到多个写库文件,
+每个分片是独立的 SqliteRWDatabase(有自己的binlog和读库), 不同分片的写入可以并行:
+
+- insert/insert_many: 按照分片键路由, 数据中必须包含分片键, 分片键为id时需要调用方生成id;
+  分片键不是id时每个分片的id是独立自增的, 不同分片的id会重复, 返回 (分片序号, id)
+- select/count/update/delete: where是包含分片键的dict时只访问一个分片, 否则并行访问所有分片;
+  分片键不是id时, 按照id修改数据(update_many, where中有id)必须同时指定分片键
+- select 的多分片结果按照order归并排序, limit/offset在归并之后处理, 不支持group和聚合查询
+
+    table = ShardedSqliteTable([("user-0.db", "user-0-read.db"), ("user-1.db", "user-1-read.db")],
+                               "user", shard_key = "id")
+    table.insert(id = 1, name = "test")
+    table.select(order = "id desc", limit = 10)
+"""
+
+import heapq
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from . import SqliteRWDatabase
+from .backend import ResultSet
+
+
+def get_shard_index(value, shard_count):
+    """稳定的哈希, 不受进程的hash随机化影响"""
+    if isinstance(value, bytes):
+        data = value
+    else:
+        data = str(value).encode("utf-8")
+    return zlib.crc32(data) % shard_count
+
+
+def parse_order(order):
+    """把 "name desc, id" 转换成 [("name", True), ("id", False)], True表示倒序"""
+    result = []
+    if order == None or order == "":
+        return result
+    for item in order.split(","):
+        parts = item.split()
+        if len(parts) == 0:
+            continue
+        name = parts[0].strip("`")
+        reverse = len(parts) > 1 and parts[1].lower() == "desc"
+        result.append((name, reverse))
+    return result
+
+
+class _SortKey:
+    """多个字段、不同方向的排序键, None排在最前面(和sqlite一致)"""
+
+    __slots__ = ("values", "columns")
+
+    def __init__(self, row, columns):
+        self.values = [row[name] for name, reverse in columns]
+        self.columns = columns
+
+    def __lt__(self, other):
+        for (name, reverse), a, b in zip(self.columns, self.values, other.values):
+            if a == b:
+                continue
+            if a == None:
+                less = True
+            elif b == None:
+                less = False
+            else:
+                less = a < b
+            return less != reverse
+        return False
+
+
+class ShardedSqliteTable:
+    """多个写库分片上的同一张表, 分片的其他参数和SqliteTable一致"""
+
+    max_workers = None # 并行查询的线程数, None表示分片数量
+
+    def __init__(self, shards, tablename, shard_key="id", max_workers=None, **kw):
+        """shards 是 [(dbpath, read_db_path), ...], 分片的顺序决定了数据的位置, 创建之后不能调整
+        其他参数传给每个分片的 SqliteTable
+        """
+        assert len(shards) > 0, "shards is empty"
+        database_kw = dict()
+        for name in ("timeout", "copy_batch_size", "copy_cron_interval", "read_route_policy", "max_read_lag",
+                     "dedicated_replicas", "replication_mode", "backend", "memory_limit",
+                     "binlog_format", "binlog_segment_size"):
+            if name in kw:
+                database_kw[name] = kw.pop(name)
+        self.tablename = tablename
+        self.shard_key = shard_key
+        self.databases = []
+        self.tables = []
+        for dbpath, read_db_path in shards:
+            database = SqliteRWDatabase(dbpath, read_db_path, **database_kw)
+            self.databases.append(database)
+            self.tables.append(database.table(tablename, **kw))
+        if max_workers != None:
+            self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers = self.max_workers or len(self.tables),
+                                           thread_name_prefix = "sqlite-rw-shard-%s" % tablename)
+
+    def get_shard(self, value):
+        """分片键的值对应的分片表(SqliteTable)"""
+        return self.tables[get_shard_index(value, len(self.tables))]
+
+    def _get_shard_value(self, row):
+        value = row.get(self.shard_key)
+        assert value != None, "shard key %r is required" % self.shard_key
+        return value
+
+    def _route_where(self, where):
+        """where中有分片键的等值条件时返回对应的分片, 否则返回所有分片"""
+        if isinstance(where, dict) and self.shard_key in where:
+            value = where[self.shard_key]
+            if not isinstance(value, (list, tuple, set)):
+                return [self.get_shard(value)]
+        return self.tables
+
+    def _check_id_where(self, where):
+        """id只在分片内唯一, 按照id修改时必须通过分片键确定分片, 避免修改其他分片中id相同的数据"""
+        if self.shard_key != "id" and isinstance(where, dict) and "id" in where:
+            assert self.shard_key in where, "shard key %r is required when id is used" % self.shard_key
+
+    def _make_id(self, shard_index, data_id):
+        if self.shard_key == "id":
+            return data_id
+        return (shard_index, data_id)
+
+    def _scatter(self, tables, func, *args, **kw):
+        """在多个分片上并行执行 func(table, ...), 按照分片的顺序返回结果"""
+        if len(tables) == 1:
+            return [func(tables[0], *args, **kw)]
+        futures = [self.executor.submit(func, table, *args, **kw) for table in tables]
+        return [future.result() for future in futures]
+
+    def insert(self, **values):
+        """写入分片键对应的分片, 分片键不是id时返回 (分片序号, id), 分片表是 table.tables[分片序号]
+        读到自己的写入需要使用分片的 get_last_seq: table.get_shard(value).get_last_seq()
+        """
+        shard_index = get_shard_index(self._get_shard_value(values), len(self.tables))
+        return self._make_id(shard_index, self.tables[shard_index].insert(**values))
+
+    def insert_many(self, rows):
+        """按照分片分组后并行写入, 返回每一行的id, 格式和insert一致"""
+        groups = dict()
+        for index, row in enumerate(rows):
+            shard_index = get_shard_index(self._get_shard_value(row), len(self.tables))
+            groups.setdefault(shard_index, []).append(index)
+
+        def insert_group(table, indexes):
+            return table.insert_many([rows[i] for i in indexes])
+
+        futures = [self.executor.submit(insert_group, self.tables[shard_index], indexes)
+                   for shard_index, indexes in groups.items()]
+        ids = [None] * len(rows)
+        for future, (shard_index, indexes) in zip(futures, groups.items()):
+            for i, data_id in zip(indexes, future.result()):
+                ids[i] = self._make_id(shard_index, data_id)
+        return ids
+
+    def update(self, where, vars=None, **values):
+        assert self.shard_key not in values, "shard key can not be updated"
+        self._check_id_where(where)
+        results = self._scatter(self._route_where(where), self._update, where, vars, **values)
+        return sum(result or 0 for result in results)
+
+    def _update(self, table, where, vars, **values):
+        return table.update(where, vars, **values)
+
+    def update_many(self, rows):
+        """每一行必须包含id和分片键(分片键是id时只需要id), 只更新分片键对应的分片"""
+        groups = dict()
+        for row in rows:
+            shard_index = get_shard_index(self._get_shard_value(row), len(self.tables))
+            groups.setdefault(shard_index, []).append(row)
+        futures = [self.executor.submit(self.tables[shard_index].update_many, group)
+                   for shard_index, group in groups.items()]
+        return sum(future.result() for future in futures)
+
+    def delete(self, where, vars=None):
+        self._check_id_where(where)
+        results = self._scatter(self._route_where(where), self._delete, where, vars)
+        return sum(result or 0 for result in results)
+
+    def _delete(self, table, where, vars):
+        return table.delete(where = where, vars = vars)
+
+    def select(self, where=None, vars=None, what="*", order=None, limit=None, offset=None, replica=None):
+        """并行查询所有相关的分片, 每个分片最多返回limit+offset条, 归并之后再处理limit和offset"""
+        tables = self._route_where(where)
+        if len(tables) == 1:
+            return ResultSet(tables[0].select(where = where, vars = vars, what = what, order = order,
+                                              limit = limit, offset = offset, replica = replica))
+        shard_limit = None
+        if limit != None:
+            shard_limit = limit + (offset or 0)
+        results = self._scatter(tables, self._select, where = where, vars = vars, what = what, order = order,
+                                limit = shard_limit, replica = replica)
+        columns = parse_order(order)
+        if len(columns) > 0:
+            rows = heapq.merge(*results, key = lambda row: _SortKey(row, columns))
+        else:
+            rows = (row for result in results for row in result)
+        start = offset or 0
+        end = None if limit == None else start + limit
+        result = ResultSet()
+        for index, row in enumerate(rows):
+            if end != None and index >= end:
+                break
+            if index >= start:
+                result.append(row)
+        return result
+
+    def _select(self, table, **kw):
+        return list(table.select(**kw))
+
+    def select_first(self, where=None, vars=None, order=None, replica=None):
+        return self.select(where = where, vars = vars, order = order, limit = 1, replica = replica).first()
+
+    def count(self, where=None, vars=None, replica=None):
+        tables = self._route_where(where)
+        return sum(self._scatter(tables, self._count, where, vars, replica))
+
+    def _count(self, table, where, vars, replica):
+        return table.count(where = where, vars = vars, replica = replica)
+
+    def copy_to_read(self):
+        self._scatter(self.tables, self._copy_to_read)
+
+    def _copy_to_read(self, table):
+        table.copy_to_read()
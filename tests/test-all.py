@@ -1,5 +1,7 @@
 from __future__ import absolute_import
 import sys
+import os
+import subprocess
 sys.path.insert(0, "./")
 import sqlite_rw
 import threading
@@ -7,6 +9,7 @@ import time
 import sqlite3
 import traceback
 import termcolor
+import asyncio
 from sqlite_rw import _async_thread
 
 def get_db_file():
@@ -25,6 +28,10 @@ def get_table(timeout = 5, default_read_type = "read"):
                                  read_db_path = get_read_file(), timeout = timeout,
                                  default_read_type = default_read_type)
 
+def get_table_with_mode(replication_mode):
+    return sqlite_rw.SqliteTable(get_db_file(), "user", read_db_path = get_read_file(),
+                                 replication_mode = replication_mode)
+
 def start_new_thread(target) -> threading.Thread:
     t = threading.Thread(target = target)
     t.start()
@@ -63,6 +70,7 @@ class Result:
         self.is_locked = False
         self.is_executed = False
         self.is_read_locked = False
+        self.is_other_table_executed = False
 
 def print_start(msg):
     print(termcolor.colored(">>> " + msg, "cyan"))
@@ -159,5 +167,843 @@ def test_copy_cron():
 
     
 
-init_user_table()
+def test_copy_to_read_batch():
+    print("\n\n=== test_copy_to_read_batch")
+    table = sqlite_rw.SqliteTable(get_db_file(), "user", read_db_path = get_read_file(), copy_batch_size = 7)
+    table.copy_to_read()
+    table.delete(where = "name like $name", vars = dict(name = "batch-%"))
+    with table.transaction():
+        for i in range(20):
+            table.insert(name = "batch-%d" % i, age = i)
+    table.update(where = dict(name = "batch-3"), age = 100)
+    table.delete(where = dict(name = "batch-4"))
+
+    table.copy_to_read()
+    # 重复执行是幂等的
+    table.copy_to_read()
+
+    assert table.count(where = "name like 'batch-%'") == 19
+    assert table.select_first(where = dict(name = "batch-3")).age == 100
+    assert table.db.query("SELECT COUNT(1) AS amount FROM binlog").first().amount == 0
+
+def test_compact_records():
+    print("\n\n=== test_compact_records")
+    from sqlite_rw.replication import BinlogRecord, compact_records
+    records = [
+        BinlogRecord(1, "user", "insert", dict(id = 1, name = "a", age = 1)),
+        BinlogRecord(2, "user", "update", dict(id = 1, name = "a", age = 2)),
+        BinlogRecord(3, "user", "insert", dict(id = 2, name = "b", age = 1)),
+        BinlogRecord(4, "user", "update", dict(id = 3, name = "c", age = 3)),
+        BinlogRecord(5, "user", "update", dict(id = 1, name = "a", age = 3)),
+        BinlogRecord(6, "user", "delete_by_ids", [2, 4]),
+    ]
+    result = compact_records(records)
+    upserts = [x for x in result if x.op_type != "delete_by_ids"]
+    deletes = [x for x in result if x.op_type == "delete_by_ids"]
+    assert sorted([x.data["id"] for x in upserts]) == [1, 3]
+    assert [x.data["age"] for x in upserts if x.data["id"] == 1] == [3]
+    # id=2 的insert和delete抵消了
+    assert len(deletes) == 1
+    assert deletes[0].data == [4]
+
+def test_async_thread_coalesce():
+    print("\n\n=== test_async_thread_coalesce")
+    from sqlite_rw.async_task import AsyncThread, OVERFLOW_DROP
+    thread = AsyncThread(name = "TestAsyncThread", overflow_policy = OVERFLOW_DROP)
+    thread.MAX_TASK_QUEUE = 2
+    result = []
+
+    # 线程还没启动, 任务都在队列中
+    for i in range(100):
+        thread.put_unique_task("copy", result.append, "copy")
+    assert thread.qsize() == 1
+    assert thread.put_task(result.append, "a") == True
+    assert thread.put_task(result.append, "b") == False
+
+    event = threading.Event()
+    thread.put_cron_func("cron", event.set, interval = 0.1)
+    thread.start()
+    assert event.wait(2)
+    assert result == ["copy", "a"]
+
+def test_lock_manager():
+    print("\n\n=== test_lock_manager")
+    from sqlite_rw import LockManager
+    result = Result()
+
+    def write_other_db():
+        # 不同的数据库文件之间不会互相阻塞
+        with LockManager.get_lock("./test_other.db", "user"):
+            result.is_executed = True
+
+    def write_other_table():
+        # 同一个文件的不同表之间不会互相阻塞
+        with LockManager.get_lock(get_db_file(), "user_order"):
+            result.is_other_table_executed = True
+
+    with LockManager.get_lock(get_db_file(), "user"):
+        # 可重入
+        with LockManager.get_lock(get_db_file(), "user"):
+            t = start_new_thread(write_other_db)
+            t.join(2)
+            t = start_new_thread(write_other_table)
+            t.join(2)
+            assert result.is_other_table_executed
+    assert result.is_executed
+
+    def lock_whole_db():
+        with LockManager.get_lock(get_db_file()):
+            result.is_locked = True
+
+    with LockManager.get_read_lock(get_db_file()):
+        t = start_new_thread(lock_whole_db)
+        time.sleep(0.2)
+        # 独占锁需要等待读锁释放
+        assert result.is_locked == False
+    t.join(2)
+    assert result.is_locked
+
+    stats = LockManager.get_stats()
+    db_stat = stats[os.path.abspath(get_db_file())]
+    assert db_stat["wait_count"] >= 1
+    assert db_stat["total_wait_time"] > 0
+
+def test_multi_replicas():
+    print("\n\n=== test_multi_replicas")
+    read_db_path = dict(main = get_read_file(), report = "./test_read_report.db")
+    with sqlite_rw.TableManager(get_db_file(), "user", read_db_path = list(read_db_path.values())) as manager:
+        manager.add_column("name", "text", "")
+        manager.add_column("age", "int", 0)
+
+    table = sqlite_rw.SqliteTable(get_db_file(), "user", read_db_path = read_db_path,
+                                  max_read_lag = 0, dedicated_replicas = ["report"])
+    table.copy_to_read()
+    # 持有写库的独占锁, 阻止异步同步任务执行
+    with sqlite_rw.LockManager.get_lock(get_db_file()):
+        table.delete(where = dict(name = "replica"))
+        table.insert(name = "replica", age = 10)
+
+        # 读库都有延迟, 从写库读取
+        assert table.get_read_db()[1] == None
+        assert table.count(where = dict(name = "replica")) == 1
+
+    table.copy_to_read()
+    for replica in table.replicas:
+        assert replica.lag == 0
+        assert table.count(where = dict(name = "replica"), replica = replica.name) == 1
+    # 专用的读库不参与默认的路由
+    assert table.get_read_db()[1].name == "main"
+
+def test_read_your_writes():
+    print("\n\n=== test_read_your_writes")
+    table = get_table()
+    table.delete(where = dict(name = "ryw"))
+    table.insert(name = "ryw", age = 10)
+    seq = table.get_last_seq()
+    assert seq > 0
+
+    # 等待读库同步或者从写库读取, 都能读到自己的写入
+    record = table.select_first(where = dict(name = "ryw"), min_seq = seq)
+    assert record.age == 10
+    assert table.count(where = dict(name = "ryw"), min_seq = seq) == 1
+
+    assert table.wait_replicated(seq, timeout = 2)
+    db, replica = table.get_read_db(min_seq = seq)
+    assert replica != None
+    assert replica.applied_id >= seq
+
+def test_insert_many():
+    print("\n\n=== test_insert_many")
+    table = get_table()
+    table.delete(where = "name like $name", vars = dict(name = "many-%"))
+    rows = [dict(name = "many-%d" % i, age = i) for i in range(50)]
+    rows.append(dict(name = "many-noage"))
+    ids = table.insert_many(rows)
+    assert len(ids) == 51
+    assert table.select_first_from_write(where = dict(id = ids[10])).name == "many-10"
+    assert table.select_first_from_write(where = dict(id = ids[50])).name == "many-noage"
+
+    updated = table.update_many([dict(id = ids[0], age = 100), dict(id = ids[1], age = 101, name = "many-x")])
+    assert updated == 2
+
+    table.copy_to_read()
+    assert table.count(where = "name like 'many-%'") == 51
+    assert table.select_first(where = dict(id = ids[0])).age == 100
+    assert table.select_first(where = dict(id = ids[1])).name == "many-x"
+    assert table.select_first(where = dict(id = ids[50])).age == 0
+
+def test_trigger_capture():
+    print("\n\n=== test_trigger_capture")
+    with sqlite_rw.TableManager(get_db_file(), "user_trigger", read_db_path = get_read_file()) as manager:
+        manager.add_column("name", "text", "")
+    table = sqlite_rw.SqliteTable(get_db_file(), "user_trigger", read_db_path = get_read_file(),
+                                  capture_mode = sqlite_rw.CAPTURE_TRIGGER)
+    with sqlite_rw.TableManager(get_db_file(), "user_trigger", read_db_path = get_read_file()) as manager:
+        # 新增的字段会自动加入触发器
+        manager.add_column("age", "int", 0)
+
+    table.delete(where = "1=1")
+    table.insert(name = "trigger-1", age = 10)
+    table.insert_many([dict(name = "trigger-2", age = 20), dict(name = "trigger-3", age = 30)])
+    table.update(where = dict(name = "trigger-1"), age = 11)
+    # 直接执行的SQL也会被同步
+    table.query_from_write("DELETE FROM user_trigger WHERE name = 'trigger-3'")
+    assert table.get_last_seq() > 0
+
+    table.copy_to_read()
+    rows = list(table.select(order = "name"))
+    assert [x.name for x in rows] == ["trigger-1", "trigger-2"]
+    assert rows[0].age == 11
+
+    # BLOB字段
+    with sqlite_rw.TableManager(get_db_file(), "user_trigger", read_db_path = get_read_file()) as manager:
+        manager.add_column("avatar", "blob")
+    data_id = table.insert(name = "trigger-blob", avatar = b"\x00\xff")
+    table.update(where = dict(id = data_id), avatar = sqlite3.Binary(b"\x01\x02"))
+    table.copy_to_read()
+    assert table.select_first(where = dict(id = data_id)).avatar == b"\x01\x02"
+
+    # 字段没有变化时不会重新安装触发器
+    schema_version = table.query_from_write("PRAGMA schema_version").first().schema_version
+    sqlite_rw.SqliteTable(get_db_file(), "user_trigger", read_db_path = get_read_file(),
+                          capture_mode = sqlite_rw.CAPTURE_TRIGGER)
+    assert table.query_from_write("PRAGMA schema_version").first().schema_version == schema_version
+
+def test_leader_election():
+    print("\n\n=== test_leader_election")
+    from sqlite_rw.election import FileLeaderLock
+    table = get_table()
+    assert table.replicator.is_leader()
+
+    # 另一个进程无法成为leader
+    code = "import fcntl; fp = open(%r, 'a+'); fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)"
+    lock_path = FileLeaderLock.get(get_db_file()).lock_path
+    if os.name == "posix":
+        assert subprocess.call([sys.executable, "-c", code % lock_path], stderr = subprocess.DEVNULL) != 0
+
+    # 外部同步模式下进程内不执行同步
+    external = get_table_with_mode(sqlite_rw.REPLICATION_EXTERNAL)
+    external.copy_to_read()
+    with sqlite_rw.LockManager.get_lock(get_db_file()):
+        external.insert(name = "external", age = 1)
+        assert _async_thread.qsize() == 0 or all(x[0] != ("copy_to_read", external.dbpath) for x in _async_thread.task_queue)
+
+    from sqlite_rw.replicator import create_replicator
+    replicator = create_replicator(get_db_file(), [get_read_file()])
+    assert replicator.has_new_data()
+    replicator.copy_to_read()
+    assert external.count(where = dict(name = "external")) >= 1
+    external.delete(where = dict(name = "external"))
+
+def test_resync_read_db():
+    print("\n\n=== test_resync_read_db")
+    table = get_table()
+    table.insert(name = "resync", age = 1)
+    table.copy_to_read()
+    assert table.check_read_db(chunk_size = 5) == []
+
+    # 制造读库和写库的不一致
+    with sqlite_rw.LockManager.get_lock(get_read_file()):
+        table.read_db.query("UPDATE user SET age = age + 1 WHERE name = 'resync'")
+        table.read_db.query("INSERT INTO user (id, name) VALUES (100000000, 'resync-extra')")
+    diff = table.check_read_db(chunk_size = 5)
+    assert len(diff) == 2
+    assert diff[-1][1] == None
+
+    applied_id = table.resync_read_db()
+    assert applied_id > 0
+    assert table.check_read_db(chunk_size = 5) == []
+
+    # 重建之后继续同步binlog
+    table.insert(name = "resync-after", age = 2)
+    table.copy_to_read()
+    assert table.count(where = dict(name = "resync-after")) >= 1
+    assert table.check_read_db() == []
+
+def test_native_backend():
+    print("\n\n=== test_native_backend")
+    table = sqlite_rw.SqliteTable(get_db_file(), "user", read_db_path = get_read_file(),
+                                  backend = sqlite_rw.BACKEND_SQLITE3)
+    table.delete(where = "name like $name", vars = dict(name = "native-%"))
+    with table.transaction():
+        id1 = table.insert(name = "native-1", age = 10)
+        with table.transaction():
+            id2 = table.insert(name = "native-2", age = 20)
+    try:
+        with table.transaction():
+            table.insert(name = "native-3", age = 30)
+            raise Exception("rollback")
+    except Exception:
+        pass
+    table.update(where = dict(id = id1), age = 11)
+
+    rows = list(table.select_from_write(where = "id in $ids", vars = dict(ids = [id1, id2]), order = "id"))
+    assert [x.name for x in rows] == ["native-1", "native-2"]
+    assert rows[0]["age"] == 11
+    assert dict(rows[1])["age"] == 20
+
+    table.copy_to_read()
+    assert table.count(where = "name like 'native-%'") == 2
+    assert table.select_first(where = dict(id = id1)).age == 11
+    assert table.select_first(where = dict(name = "native-3")) == None
+
+def test_row_cache():
+    print("\n\n=== test_row_cache")
+    table = sqlite_rw.SqliteTable(get_db_file(), "user", read_db_path = get_read_file(), cache_size = 100)
+    data_id = table.insert(name = "cache", age = 1)
+    table.copy_to_read()
+
+    assert table.select_first(where = dict(id = data_id)).age == 1
+    assert table.select_first(where = dict(id = data_id)).age == 1
+    stats = table.get_cache_stats()
+    assert stats["hits"] >= 1
+
+    # 同步binlog之后缓存失效
+    table.update(where = dict(id = data_id), age = 2)
+    table.copy_to_read()
+    assert table.select_first(where = dict(id = data_id)).age == 2
+    assert table.get_cache_stats()["invalidations"] >= 1
+
+    table.delete(where = dict(id = data_id))
+    table.copy_to_read()
+    assert table.select_first(where = dict(id = data_id)) == None
 
+
+def test_count_cache():
+    print("\n\n=== test_count_cache")
+    table = sqlite_rw.SqliteTable(get_db_file(), "user", read_db_path = get_read_file(), count_columns = ["name"])
+    table.copy_to_read()
+    table.delete(where = dict(name = "counter"))
+    ids = table.insert_many([dict(name = "counter", age = i) for i in range(5)])
+    table.update(where = dict(id = ids[0]), name = "counter2")
+    table.delete(where = dict(id = ids[1]))
+    table.copy_to_read()
+
+    # 计数和扫描读库的结果一致
+    sql = "SELECT COUNT(1) AS amount FROM user"
+    assert table.count() == table.count(sql = sql)
+    assert table.count(where = dict(name = "counter")) == 3
+    assert table.count(where = dict(name = "counter2")) == 1
+    table.delete(where = dict(id = ids[0]))
+    table.copy_to_read()
+    assert table.count(where = dict(name = "counter2")) == 0
+    assert table.count() == table.count(sql = sql)
+
+
+def test_iter_select():
+    print("\n\n=== test_iter_select")
+    for backend in (sqlite_rw.BACKEND_WEBPY, sqlite_rw.BACKEND_SQLITE3):
+        table = sqlite_rw.SqliteTable(get_db_file(), "user", read_db_path = get_read_file(), backend = backend)
+        table.delete(where = dict(name = "stream"))
+        table.insert_many([dict(name = "stream", age = i) for i in range(25)])
+        table.copy_to_read()
+
+        rows = list(table.iter_select(where = dict(name = "stream"), order = "age", size = 10))
+        assert len(rows) == 25
+        assert rows[3].age == 3
+        assert rows[3]["name"] == "stream"
+        rows = list(table.iter_select(where = dict(name = "stream"), as_dict = True))
+        assert isinstance(rows[0], dict)
+
+    with sqlite_rw.SqliteTableManager(get_db_file(), "user") as manager:
+        rows = list(manager.iter_query("SELECT * FROM user WHERE name = ?", ("stream",), size = 7))
+        assert len(rows) == 25
+
+
+def test_metrics():
+    print("\n\n=== test_metrics")
+    events = []
+    hook = lambda name, value, labels: events.append(name)
+    sqlite_rw.MetricsRegistry.add_hook(hook)
+    try:
+        table = get_table()
+        data_id = table.insert(name = "metrics", age = 1)
+        table.select_first(where = dict(id = data_id))
+        table.copy_to_read()
+    finally:
+        sqlite_rw.MetricsRegistry.remove_hook(hook)
+    assert "sqlite_rw_op_seconds" in events
+
+    metrics = sqlite_rw.MetricsRegistry.collect()
+    ops = [item["labels"]["op"] for item in metrics["sqlite_rw_op_seconds"]]
+    assert "insert" in ops and "select_first" in ops
+    assert metrics["sqlite_rw_apply_batch_size"][0]["count"] > 0
+    assert "sqlite_rw_binlog_backlog" in metrics
+    assert "sqlite_rw_replica_lag_seconds" in metrics
+    assert "sqlite_rw_async_queue_size" in metrics
+    assert "sqlite_rw_lock_wait_seconds" in metrics
+
+
+def test_async_table():
+    print("\n\n=== test_async_table")
+    from sqlite_rw.aio import AsyncSqliteTable
+
+    async def run():
+        table = AsyncSqliteTable(get_db_file(), "user", read_db_path = get_read_file())
+        await table.delete(where = dict(name = "aio"))
+        ids = await asyncio.gather(*[table.insert(name = "aio", age = i) for i in range(20)])
+        assert len(set(ids)) == 20
+        # gather中的任务有各自的上下文, 这里的位置是当前协程最后一次写入的
+        await table.insert_many([dict(name = "aio", age = i) for i in range(30)])
+        assert await table.wait_replicated(table.get_last_seq(), timeout = 5)
+        assert await table.count(where = dict(name = "aio"), min_seq = table.get_last_seq()) == 50
+        rows = [row async for row in table.iter_select(where = dict(name = "aio"), size = 7)]
+        assert len(rows) == 50
+        # 提前结束迭代
+        async for row in table.iter_select(where = dict(name = "aio"), size = 1):
+            break
+        assert (await table.select_first(where = dict(id = ids[0]))).name == "aio"
+
+        # 刷新同步位置会访问sqlite, 不能在事件循环的线程中执行
+        loop_thread = threading.get_ident()
+        refresh_threads = []
+        refresh_func = table.table.replicas.refresh_func
+        def record_refresh():
+            refresh_threads.append(threading.get_ident())
+            return refresh_func()
+        table.table.replicas.refresh_func = record_refresh
+        try:
+            assert not await table.wait_replicated(table.get_last_seq() + 1000, timeout = 0.2)
+        finally:
+            table.table.replicas.refresh_func = refresh_func
+        assert len(refresh_threads) > 0 and loop_thread not in refresh_threads
+
+    asyncio.run(run())
+
+
+def test_drop_column_online():
+    print("\n\n=== test_drop_column_online")
+    with sqlite_rw.TableManager(get_db_file(), "user_migrate", read_db_path = get_read_file()) as manager:
+        manager.add_column("name", "text", "")
+        manager.add_column("age", "int", 0)
+        manager.add_column("extra", "text", "")
+        manager.add_index("age")
+        manager.add_index("extra")
+    table = sqlite_rw.SqliteTable(get_db_file(), "user_migrate", read_db_path = get_read_file())
+    table.insert_many([dict(name = "migrate", age = i, extra = "x") for i in range(250)])
+    table.copy_to_read()
+
+    # 迁移期间持续写入
+    stop = threading.Event()
+    def writer():
+        while not stop.is_set():
+            data_id = table.insert(name = "concurrent", age = 1)
+            table.update(where = dict(id = data_id), age = 2)
+    t = start_new_thread(writer)
+    try:
+        with sqlite_rw.TableManager(get_db_file(), "user_migrate", read_db_path = get_read_file()) as manager:
+            manager.drop_column("extra", chunk_size = 50)
+    finally:
+        stop.set()
+        t.join()
+    table.copy_to_read()
+
+    with sqlite_rw.TableManager(get_db_file(), "user_migrate", read_db_path = get_read_file()) as manager:
+        for db in manager._get_db_list():
+            columns = [column["name"] for column in manager.do_execute(db, "pragma table_info('user_migrate')", silent = True)]
+            assert "extra" not in columns
+            indexes = [row["name"] for row in manager.do_execute(db, "pragma index_list('user_migrate')", silent = True)]
+            assert "idx_user_migrate_age" in indexes
+            assert "idx_user_migrate_extra" not in indexes
+    assert table.count_from_write(where = dict(name = "concurrent")) == table.count_from_write(where = dict(name = "concurrent", age = 2))
+    assert table.check_read_db() == []
+    assert table.count_from_write() >= 250
+
+
+def test_auto_route():
+    print("\n\n=== test_auto_route")
+    table = get_table(default_read_type = "auto")
+    table.copy_to_read()
+
+    # 持有写库的锁, 阻止异步同步, 让读库保持延迟
+    with sqlite_rw.LockManager.get_lock(table.dbpath):
+        data_id = table.insert(name = "route", age = 1)
+        # 主键查询发到最新的数据源, 读库有延迟时读写库
+        assert table.select_first(where = dict(id = data_id)).name == "route"
+        # 全表扫描总是发到读库
+        table.query("SELECT name, COUNT(1) AS amount FROM user GROUP BY name")
+        table.count(where = "age > 0")
+        # 聚合查询即使使用了主键也按照scan处理
+        table.count(where = dict(id = data_id))
+        table.query("SELECT MAX(id) AS max_id FROM user")
+        stats = table.get_route_stats()
+        assert stats["lookup_write"] == 1
+        assert stats["scan_read"] >= 4
+
+    table.copy_to_read()
+    table.select_first(where = dict(id = data_id))
+    table.select_first(where = dict(id = data_id))
+    stats = table.get_route_stats()
+    assert stats["lookup_read"] >= 1
+    assert stats["plan_cache_hits"] >= 1
+
+
+def test_database_tables():
+    print("\n\n=== test_database_tables")
+    with sqlite_rw.TableManager(get_db_file(), "user_order", read_db_path = get_read_file()) as manager:
+        manager.add_column("user_id", "int", 0)
+    database = sqlite_rw.SqliteRWDatabase(get_db_file(), read_db_path = get_read_file())
+    user = database.table("user")
+    order = database.table("user_order")
+    # 共享连接和同步通道
+    assert database.table("user") is user
+    assert user.db is order.db and user.replicator is order.replicator
+
+    user_id = user.insert(name = "database", age = 1)
+    order_id = order.insert(user_id = user_id)
+    database.copy_to_read()
+    assert user.select_first(where = dict(id = user_id)).name == "database"
+    assert order.select_first(where = dict(id = order_id)).user_id == user_id
+
+
+def test_group_commit():
+    print("\n\n=== test_group_commit")
+    database = sqlite_rw.SqliteRWDatabase(get_db_file(), read_db_path = get_read_file())
+    table = database.table("user", group_commit = True)
+    table.delete(where = dict(name = "group"))
+    # 8个线程同时开始, 每个批次凑满8个操作才提交
+    committer = database.get_group_committer()
+    committer.max_delay = 1
+    committer.max_batch = 8
+    barrier = threading.Barrier(8)
+    ids = []
+    errors = []
+
+    def writer():
+        barrier.wait()
+        for i in range(20):
+            data_id = table.insert(name = "group", age = i)
+            assert table.get_last_seq() > 0
+            ids.append(data_id)
+        try:
+            table.insert(name = "group", no_such_column = 1)
+        except sqlite3.OperationalError as e:
+            errors.append(e)
+
+    threads = [start_new_thread(writer) for i in range(8)]
+    for t in threads:
+        t.join()
+    # 每个调用方拿到自己的结果, 失败的操作不影响同一批次的其他操作
+    assert len(set(ids)) == 160
+    assert len(errors) == 8
+    assert table.count_from_write(where = dict(name = "group")) == 160
+    stats = database.get_group_committer().get_stats()
+    assert stats["avg_batch_size"] > 1
+
+    table.update(where = dict(name = "group"), age = 100)
+    assert table.wait_replicated(table.get_last_seq(), timeout = 5)
+    assert table.count(where = dict(name = "group", age = 100), min_seq = table.get_last_seq()) == 160
+
+    # 批次只持有涉及的表的锁, 不阻塞同一个文件中其他表的写入
+    from sqlite_rw import LockManager
+    committer.max_delay = 0.001
+    started = threading.Event()
+    release = threading.Event()
+    def slow_op():
+        started.set()
+        release.wait(2)
+    t = start_new_thread(lambda: committer.submit("user", slow_op))
+    assert started.wait(2)
+    result = Result()
+    def write_other_table():
+        with LockManager.get_lock(get_db_file(), "user_order"):
+            result.is_other_table_executed = True
+    start_new_thread(write_other_table).join(1)
+    release.set()
+    t.join()
+    assert result.is_other_table_executed
+
+
+def test_sharded_table():
+    print("\n\n=== test_sharded_table")
+    from sqlite_rw.shard import ShardedSqliteTable
+    shards = [("./test_shard_%d.db" % i, "./test_shard_%d_read.db" % i) for i in range(3)]
+    for dbpath, read_db_path in shards:
+        with sqlite_rw.TableManager(dbpath, "user", read_db_path = read_db_path) as manager:
+            manager.add_column("name", "text", "")
+            manager.add_column("age", "int", 0)
+    table = ShardedSqliteTable(shards, "user", shard_key = "id")
+    table.delete(where = "1=1")
+    ids = table.insert_many([dict(id = i, name = "shard", age = i % 7) for i in range(1, 101)])
+    assert ids == list(range(1, 101))
+    # 数据分散在所有的分片中
+    assert all(shard.count_from_write() > 0 for shard in table.tables)
+    table.copy_to_read()
+
+    assert table.count() == 100
+    assert table.count(where = dict(id = 5)) == 1
+    rows = table.select(order = "age desc, id", limit = 10, offset = 5)
+    expected = sorted(range(1, 101), key = lambda i: (-(i % 7), i))[5:15]
+    assert [row.id for row in rows] == expected
+
+    # 点查询只访问一个分片
+    table.update(where = dict(id = 5), name = "updated")
+    table.copy_to_read()
+    assert table.select_first(where = dict(id = 5)).name == "updated"
+    assert table.get_shard(5).count(where = dict(name = "updated")) == 1
+    assert table.delete(where = dict(age = 0)) == 14
+    table.copy_to_read()
+    assert table.count() == 86
+
+    # 分片键不是id时, 每个分片的id独立自增, 需要通过分片键定位数据
+    for dbpath, read_db_path in shards:
+        with sqlite_rw.TableManager(dbpath, "user_order", read_db_path = read_db_path) as manager:
+            manager.add_column("user_id", "int", 0)
+            manager.add_column("status", "text", "")
+    orders = ShardedSqliteTable(shards, "user_order", shard_key = "user_id")
+    orders.delete(where = "1=1")
+    ids = orders.insert_many([dict(user_id = i, status = "new") for i in range(10)])
+    assert len(set(ids)) == 10
+    shard_index, data_id = ids[0]
+    assert orders.tables[shard_index].select_first_from_write(where = dict(id = data_id)).user_id == 0
+    rejected = False
+    try:
+        orders.update_many([dict(id = data_id, status = "paid")])
+    except AssertionError:
+        rejected = True
+    assert rejected
+    assert orders.update_many([dict(id = data_id, user_id = 0, status = "paid")]) == 1
+    assert sum(shard.count_from_write(where = dict(status = "paid")) for shard in orders.tables) == 1
+
+
+def test_lazy_start_and_schema_cache():
+    print("\n\n=== test_lazy_start_and_schema_cache")
+    # 只导入和创建表对象不会启动后台线程
+    code = ("import sqlite_rw; table = sqlite_rw.SqliteTable(%r, 'user', read_db_path = %r); "
+            "table.count(); assert not sqlite_rw._async_thread.is_alive(); "
+            "table.insert(name = 'lazy'); assert sqlite_rw._async_thread.is_alive()") % (get_db_file(), get_read_file())
+    subprocess.check_call([sys.executable, "-c", code])
+
+    from sqlite_rw.schema import SchemaCache
+    init_user_table()
+    hits = SchemaCache.get_stats()["hits"]
+    init_user_table()
+    assert SchemaCache.get_stats()["hits"] > hits
+    # 其他连接执行的DDL会让缓存失效
+    conn = sqlite3.connect(get_db_file())
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_test (id integer primary key)")
+    conn.execute("ALTER TABLE schema_test ADD COLUMN name text")
+    conn.commit()
+    conn.close()
+    with sqlite_rw.TableManager(get_db_file(), "schema_test") as manager:
+        assert [column["name"] for column in manager.get_columns()] == ["id", "name"]
+        manager.execute("DROP TABLE schema_test")
+
+
+def test_memory_replica():
+    print("\n\n=== test_memory_replica")
+    from sqlite_rw.replica import MemoryReplicaRegistry, get_memory_uri
+    table = get_table()
+    data_id = table.insert(name = "before_memory", age = 1)
+    table.copy_to_read()
+    memory_table = sqlite_rw.SqliteTable(get_db_file(), "user",
+                                         read_db_path = dict(disk = get_read_file(), hot = "memory:test_hot"))
+    # 创建时从写库备份
+    assert memory_table.select_first(where = dict(id = data_id), replica = "hot").name == "before_memory"
+    new_id = memory_table.insert(name = "memory", age = 2)
+    memory_table.copy_to_read()
+    assert memory_table.select_first(where = dict(id = new_id), replica = "hot").name == "memory"
+    assert memory_table.count(where = dict(id = new_id), replica = "hot") == 1
+
+    # 超过内存限制之后停止同步
+    uri = get_memory_uri("test_hot")
+    MemoryReplicaRegistry.set_memory_limit(uri, MemoryReplicaRegistry.get_memory_size(uri) + 4096)
+    # 备份带过来的空闲页也可以写入数据, 写入的数据需要超过空闲页的大小
+    hot_db = memory_table.replicas.get("hot").db
+    free_bytes = hot_db.query("PRAGMA freelist_count").first().freelist_count * \
+        hot_db.query("PRAGMA page_size").first().page_size
+    memory_table.insert_many([dict(name = "x" * 1000, age = i) for i in range(100 + free_bytes // 1000)])
+    memory_table.copy_to_read()
+    assert memory_table.replicas.get("hot").applied_id < memory_table.get_last_seq()
+    assert memory_table.replicas.get("disk").applied_id >= memory_table.get_last_seq()
+    MemoryReplicaRegistry.set_memory_limit(uri, 1 << 30)
+    memory_table.copy_to_read()
+    assert memory_table.replicas.get("hot").applied_id >= memory_table.get_last_seq()
+
+
+def test_compact_binlog_segments():
+    print("\n\n=== test_compact_binlog_segments")
+    import json
+    from sqlite_rw import binlog
+    dbpath = "./test_binlog_write.db"
+    read_path = "./test_binlog_read.db"
+    with sqlite_rw.TableManager(dbpath, "user", read_db_path = read_path) as manager:
+        manager.add_column("name", "text", "")
+        manager.add_column("age", "int", 0)
+        manager.add_column("score", "real", None)
+    database = sqlite_rw.SqliteRWDatabase(dbpath, read_db_path = read_path, binlog_format = "compact",
+                                          binlog_segment_size = 50,
+                                          replication_mode = sqlite_rw.REPLICATION_EXTERNAL)
+    table = database.table("user")
+    conn = sqlite_rw.replication.get_connection(database.db)
+
+    row = dict(id = 1, name = "中文", age = -3, score = 1.5)
+    data = binlog.encode(dbpath, conn, "user", "insert", row)
+    assert len(data) < len(json.dumps(row))
+    assert binlog.decode(conn, data) == row
+    assert binlog.decode(conn, binlog.encode(dbpath, conn, "user", "delete_by_ids", [1, 2])) == [1, 2]
+
+    ids = table.insert_many([dict(name = "compact", age = i, score = i / 2) for i in range(120)])
+    assert conn.execute("SELECT typeof(data) FROM binlog ORDER BY id DESC LIMIT 1").fetchone()[0] == "blob"
+    # 读库只应用了一部分, 写满的binlog表切换成分段, 但是不能删除
+    database.replicator.copy_batch_size = 30
+    database.replicator.copy_batch_to_read()
+    database.replicator.trim_binlog()
+    assert len(binlog.list_segments(conn)) == 1
+    table.update(where = dict(id = ids[0]), age = 1000)
+    table.delete(where = dict(id = ids[1]))
+    last_seq = table.get_last_seq()
+    assert table.get_last_binlog_id() == last_seq
+
+    # 跨分段读取, 全部应用之后整段删除
+    database.copy_to_read()
+    assert binlog.list_segments(conn) == []
+    assert table.check_read_db() == []
+    assert table.count(where = dict(name = "compact")) == 119
+    assert table.select_first(where = dict(id = ids[0])).age == 1000
+    assert table.select_first(where = dict(id = ids[5])).score == 2.5
+
+
+def test_follower_positions():
+    print("\n\n=== test_follower_positions")
+    dbpath = "./test_follower_write.db"
+    read_path = "./test_follower_read.db"
+    with sqlite_rw.TableManager(dbpath, "user", read_db_path = read_path) as manager:
+        manager.add_column("name", "text", "")
+    # 当前进程不执行同步, 由其他进程推进读库的位置
+    table = sqlite_rw.SqliteTable(dbpath, "user", read_db_path = read_path,
+                                  replication_mode = sqlite_rw.REPLICATION_EXTERNAL)
+    data_id = table.insert(name = "follower")
+    seq = table.get_last_seq()
+    assert not table.wait_replicated(seq, timeout = 0.05)
+    code = "from sqlite_rw.replicator import create_replicator; create_replicator(%r, [%r]).copy_to_read()" % (
+        dbpath, read_path)
+    subprocess.check_call([sys.executable, "-c", code])
+    assert table.wait_replicated(seq, timeout = 1)
+    db, replica = table.get_read_db(min_seq = seq)
+    assert replica != None
+    assert table.select_first(where = dict(id = data_id), min_seq = seq).name == "follower"
+
+
+def test_shared_read_db():
+    print("\n\n=== test_shared_read_db")
+    # 两个写库同步到同一个读库, binlog位置互相独立
+    read_path = "./test_shared_read.db"
+    tables = []
+    for name in ("a", "b"):
+        dbpath = "./test_shared_%s.db" % name
+        tablename = "shared_%s" % name
+        with sqlite_rw.TableManager(dbpath, tablename, read_db_path = read_path) as manager:
+            manager.add_column("name", "text", "")
+        tables.append(sqlite_rw.SqliteTable(dbpath, tablename, read_db_path = read_path))
+    table_a, table_b = tables
+    for i in range(5):
+        table_a.insert(name = "a")
+    table_a.copy_to_read()
+    table_b.insert(name = "b")
+    table_b.copy_to_read()
+    assert table_b.count() == table_b.count_from_write()
+    assert table_a.count() == table_a.count_from_write()
+    assert table_b.replicas.replicas[0].applied_id == table_b.get_last_binlog_id()
+
+
+def test_row_cache_follower():
+    print("\n\n=== test_row_cache_follower")
+    dbpath = "./test_cache_write.db"
+    read_path = "./test_cache_read.db"
+    with sqlite_rw.TableManager(dbpath, "user", read_db_path = read_path) as manager:
+        manager.add_column("name", "text", "")
+    # 当前进程不执行同步, 缓存按照其他进程推进的读库位置失效
+    table = sqlite_rw.SqliteTable(dbpath, "user", read_db_path = read_path, cache_size = 100,
+                                  replication_mode = sqlite_rw.REPLICATION_EXTERNAL)
+    code = "from sqlite_rw.replicator import create_replicator; create_replicator(%r, [%r]).copy_to_read()" % (
+        dbpath, read_path)
+    data_id = table.insert(name = "v1")
+    subprocess.check_call([sys.executable, "-c", code])
+    assert table.wait_replicated(table.get_last_seq(), timeout = 1)
+    assert table.select_first(where = dict(id = data_id)).name == "v1"
+
+    table.update(where = dict(id = data_id), name = "v2")
+    subprocess.check_call([sys.executable, "-c", code])
+    time.sleep(0.05)
+    assert table.select_first(where = dict(id = data_id)).name == "v2"
+
+
+def test_copy_cron_retry():
+    print("\n\n=== test_copy_cron_retry")
+    dbpath = "./test_retry_write.db"
+    read_path = "./test_retry_read.db"
+    with sqlite_rw.TableManager(dbpath, "user", read_db_path = read_path) as manager:
+        manager.add_column("name", "text", "")
+    database = sqlite_rw.SqliteRWDatabase(dbpath, read_db_path = read_path, timeout = 0.1,
+                                          leader_poll_interval = 0.1)
+    table = database.table("user")
+    # 读库被锁住时同步失败, 解锁之后定时任务需要继续同步, 不依赖新的写入
+    conn = sqlite3.connect(read_path)
+    conn.execute("BEGIN EXCLUSIVE")
+    table.insert(name = "retry")
+    seq = table.get_last_seq()
+    time.sleep(0.5)
+    assert table.replicas.get_min_applied_id() < seq
+    conn.rollback()
+    conn.close()
+    # 只等待, 不触发同步
+    assert table.replicas.wait(seq, 3) != None
+
+
+def test_memory_replica_pin():
+    print("\n\n=== test_memory_replica_pin")
+    dbpath = "./test_pin_write.db"
+    read_path = "./test_pin_read.db"
+    with sqlite_rw.TableManager(dbpath, "user", read_db_path = read_path) as manager:
+        manager.add_column("name", "text", "")
+    database = sqlite_rw.SqliteRWDatabase(dbpath, read_db_path = dict(disk = read_path, hot = "memory:test_pin_hot"),
+                                          replication_mode = sqlite_rw.REPLICATION_EXTERNAL)
+    table = database.table("user")
+    hot = database.replicas.get("hot")
+    # 其他进程写入并同步文件读库, 清理binlog时需要保留当前进程的内存读库还没有应用的部分
+    code = ("import sqlite_rw; from sqlite_rw.replicator import create_replicator; "
+            "table = sqlite_rw.SqliteTable(%r, 'user', read_db_path = %r, replication_mode = 'external'); "
+            "[table.insert(name = 'pin') for i in range(5)]; "
+            "create_replicator(%r, [%r]).copy_to_read()") % (dbpath, read_path, dbpath, read_path)
+    subprocess.check_call([sys.executable, "-c", code])
+    assert not database.replicator._has_gap(hot)
+    database.copy_to_memory()
+    assert hot.applied_id == table.get_last_binlog_id()
+    assert table.count(where = dict(name = "pin"), replica = "hot") == 5
+
+
+def test_resync_restart_limit():
+    print("\n\n=== test_resync_restart_limit")
+    table = get_table()
+    table.insert_many([dict(name = "resync-restart" * 100, age = i) for i in range(2000)])
+    table.copy_to_read()
+
+    # 备份过程中其他连接持续写入写库, 分步备份会不断重新开始
+    stop = threading.Event()
+    writer_table = get_table()
+    deadline = time.time() + 20
+
+    def write_loop():
+        while not stop.is_set() and time.time() < deadline:
+            writer_table.insert(name = "resync-writer", age = 1)
+            time.sleep(0.001)
+
+    writer = threading.Thread(target = write_loop)
+    writer.start()
+    replicator = table.replicator
+    replicator.max_backup_restarts = 2
+    try:
+        start = time.time()
+        applied_id = replicator.resync_replica(pages = 1, sleep = 0.01)
+        assert time.time() - start < 10
+    finally:
+        stop.set()
+        writer.join()
+        replicator.max_backup_restarts = sqlite_rw.replication.BinlogReplicator.max_backup_restarts
+    assert applied_id > 0
+    table.copy_to_read()
+    assert table.check_read_db() == []
+
+
+init_user_table()
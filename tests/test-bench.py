@@ -7,6 +7,8 @@ import time
 import sqlite3
 import traceback
 import random
+import json
+import os
 
 def get_db_file():
     return "./test_write.db"
@@ -31,6 +33,46 @@ def start_new_thread(target) -> threading.Thread:
 
 init_user_bench_table()
 
+# 测试结果输出到JSON文件, 用于对比不同版本的性能
+# SQLITE_RW_BENCH_OUTPUT: 结果文件路径, 不设置时不写结果文件
+# SQLITE_RW_BENCH_BASELINE: 之前的结果文件, 输出对比
+_bench_results = dict()
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+def record_result(name, total, cost_time, latencies=None, **extra):
+    """记录一个测试场景的结果, latencies的单位是秒"""
+    result = dict(total = total, cost_time = round(cost_time, 4), qps = int(total / max(cost_time, 1e-9)))
+    if latencies:
+        result["p50_ms"] = round(percentile(latencies, 50) * 1000, 3)
+        result["p99_ms"] = round(percentile(latencies, 99) * 1000, 3)
+    result.update(extra)
+    _bench_results[name] = result
+    print("%s: %s" % (name, json.dumps(result, sort_keys = True)))
+
+def teardown_module(module):
+    # 只有指定了输出路径时才写结果文件, 避免在工作目录留下文件
+    output = os.environ.get("SQLITE_RW_BENCH_OUTPUT")
+    if output:
+        with open(output, "w") as fp:
+            json.dump(_bench_results, fp, indent = 2, sort_keys = True)
+        print("\n结果文件: %s" % output)
+
+    baseline = os.environ.get("SQLITE_RW_BENCH_BASELINE")
+    if baseline and os.path.exists(baseline):
+        with open(baseline) as fp:
+            old_results = json.load(fp)
+        for name, result in sorted(_bench_results.items()):
+            old = old_results.get(name)
+            if old == None or not old.get("qps"):
+                continue
+            print("%s: qps %s -> %s (%.2fx)" % (name, old["qps"], result["qps"], result["qps"] / old["qps"]))
+
 def rand_str(length):
     v = ""
     a = ord('A')
@@ -45,20 +87,185 @@ def test_insert_large():
     table = get_table()
 
     max_count = 1000
+    count = 0
     start_time = time.time()
 
-    for i in range(1000):
-        count = table.count_from_write()
-        if count >= max_count:
-            cost_time = time.time() - start_time
-            print("插入数据: ", count)
-            print("耗时: %.4fs" % cost_time)
-            print("QPS: %d" % (count/cost_time))
-            return
+    while count < max_count:
         try:
             # 使用事务提升insert速度
             with table.transaction():
                 for j in range(100):
                     table.insert(name = "name-" + rand_str(30), age = random.randint(10,50))
+            count += 100
         except sqlite3.OperationalError:
             traceback.print_exc()
+    cost_time = time.time() - start_time
+    print("插入数据: ", count)
+    print("耗时: %.4fs" % cost_time)
+    print("QPS: %d" % (count/cost_time))
+    record_result("insert_large", count, cost_time)
+
+def test_copy_to_read_throughput():
+    """binlog同步到读库的吞吐量"""
+    print("\n\n=== test_copy_to_read_throughput")
+    table = get_table()
+    table.copy_to_read()
+
+    # 持有锁, 阻止异步同步任务执行, 让binlog积压下来
+    total = 10000
+    with sqlite_rw.LockManager.get_lock(table.dbpath):
+        with table.transaction():
+            for i in range(total):
+                table.insert(name = "name-" + rand_str(30), age = random.randint(10,50))
+
+        start_time = time.time()
+        table.copy_to_read()
+        cost_time = time.time() - start_time
+    print("同步数据: ", total)
+    print("耗时: %.4fs" % cost_time)
+    print("同步吞吐: %d rows/s" % (total/cost_time))
+    record_result("copy_to_read_throughput", total, cost_time)
+
+def test_insert_many():
+    """使用insert_many批量插入"""
+    print("\n\n=== test_insert_many")
+    table = get_table()
+    total = 10000
+    rows = [dict(name = "name-" + rand_str(30), age = random.randint(10,50)) for i in range(total)]
+
+    start_time = time.time()
+    for i in range(0, total, 1000):
+        table.insert_many(rows[i:i+1000])
+    cost_time = time.time() - start_time
+    print("插入数据: ", total)
+    print("耗时: %.4fs" % cost_time)
+    print("QPS: %d" % (total/cost_time))
+    record_result("insert_many", total, cost_time)
+
+def get_random_ids(table, size):
+    ids = [row.id for row in table.query("SELECT id FROM user_bench ORDER BY RANDOM() LIMIT %d" % size)]
+    assert len(ids) > 0
+    return ids
+
+def test_mixed_workload():
+    """读写混合(80%读 20%写), 分别使用1/4/8个线程"""
+    print("\n\n=== test_mixed_workload")
+    table = get_table()
+    table.copy_to_read()
+    ids = get_random_ids(table, 1000)
+
+    for thread_count in (1, 4, 8):
+        latencies = []
+        errors = []
+        ops_per_thread = 500
+
+        def worker():
+            local_latencies = []
+            for i in range(ops_per_thread):
+                start = time.time()
+                try:
+                    if random.random() < 0.8:
+                        table.select_first(where = dict(id = random.choice(ids)))
+                    else:
+                        table.insert(name = "mixed-" + rand_str(10), age = random.randint(10,50))
+                except sqlite3.OperationalError as e:
+                    errors.append(e)
+                local_latencies.append(time.time() - start)
+            latencies.extend(local_latencies)
+
+        start_time = time.time()
+        threads = [start_new_thread(worker) for i in range(thread_count)]
+        for t in threads:
+            t.join()
+        cost_time = time.time() - start_time
+        record_result("mixed_workload_%d_threads" % thread_count, len(latencies), cost_time, latencies,
+                      errors = len(errors))
+
+def test_update_heavy():
+    """逐条更新已有的数据"""
+    print("\n\n=== test_update_heavy")
+    table = get_table()
+    ids = get_random_ids(table, 2000)
+    latencies = []
+    start_time = time.time()
+    for data_id in ids:
+        start = time.time()
+        table.update(where = dict(id = data_id), age = random.randint(10,50))
+        latencies.append(time.time() - start)
+    cost_time = time.time() - start_time
+    record_result("update_heavy", len(ids), cost_time, latencies)
+
+    rows = [dict(id = data_id, age = random.randint(10,50)) for data_id in ids]
+    start_time = time.time()
+    for i in range(0, len(rows), 500):
+        table.update_many(rows[i:i+500])
+    record_result("update_many", len(rows), time.time() - start_time)
+
+def test_delete_heavy():
+    """批量插入之后逐条删除"""
+    print("\n\n=== test_delete_heavy")
+    table = get_table()
+    ids = table.insert_many([dict(name = "delete-" + rand_str(10), age = 1) for i in range(2000)])
+    latencies = []
+    start_time = time.time()
+    for data_id in ids:
+        start = time.time()
+        table.delete(where = dict(id = data_id))
+        latencies.append(time.time() - start)
+    cost_time = time.time() - start_time
+    record_result("delete_heavy", len(ids), cost_time, latencies)
+
+SLOW_QUERY = """WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 3000000)
+SELECT COUNT(1) AS amount FROM c, (SELECT id FROM user_bench LIMIT 1)"""
+
+def run_writes_with_slow_query(table, slow_db, duration = 1.0):
+    """slow_db上持续执行慢查询的同时写入, 返回 (写入次数, 耗时, 延迟列表, 失败次数)"""
+    stop = threading.Event()
+
+    def slow_reader():
+        while not stop.is_set():
+            slow_db.query(SLOW_QUERY)
+
+    reader = start_new_thread(slow_reader)
+    time.sleep(0.05)
+    latencies = []
+    errors = 0
+    start_time = time.time()
+    while time.time() - start_time < duration:
+        start = time.time()
+        try:
+            table.insert(name = "slow-" + rand_str(10), age = 1)
+        except sqlite3.OperationalError:
+            errors += 1
+        latencies.append(time.time() - start)
+    cost_time = time.time() - start_time
+    stop.set()
+    reader.join()
+    return len(latencies), cost_time, latencies, errors
+
+def test_slow_read_while_writing():
+    """读库上的慢查询不影响写库, 对比慢查询直接跑在写库上的情况"""
+    print("\n\n=== test_slow_read_while_writing")
+    table = get_table(timeout = 1)
+    total, cost_time, latencies, errors = run_writes_with_slow_query(table, table.read_db)
+    record_result("slow_query_on_read_db", total, cost_time, latencies, errors = errors)
+
+    total, cost_time, latencies, errors = run_writes_with_slow_query(table, table.db)
+    record_result("slow_query_on_write_db", total, cost_time, latencies, errors = errors)
+
+def test_replication_lag():
+    """从写入到读库可见的延迟"""
+    print("\n\n=== test_replication_lag")
+    table = get_table()
+    table.copy_to_read()
+    lags = []
+    start_time = time.time()
+    for i in range(200):
+        start = time.time()
+        table.insert(name = "lag-" + rand_str(10), age = 1)
+        seq = table.get_last_seq()
+        # 同步由写入触发的异步任务完成
+        assert table.replicas.wait(seq, 5) != None
+        lags.append(time.time() - start)
+    cost_time = time.time() - start_time
+    record_result("replication_lag", len(lags), cost_time, lags)